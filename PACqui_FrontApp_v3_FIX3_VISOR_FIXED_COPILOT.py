@@ -428,11 +428,41 @@ class AppRoot(tk.Tk):
         self._is_admin = False
         self.data = DataAccess(db_path or DEFAULT_DB)
         self.llm = LLMService(self.data.db_path)
+        # caché de respuestas (pregunta normalizada + huella de la recuperación) en la BD del índice
+        try:
+            from answer_cache import AnswerCache
+            self.answer_cache = AnswerCache(self.data.db_path)
+        except Exception:
+            self.answer_cache = None
         self.llm.warmup_async()  # precalienta modelo/índice para evitar lag en la 1ª respuesta
 
         # --- Event bus (ring buffer de 500 eventos) ---
         self._events = []
         self._event_listeners = []
+        # buzón para hilos de trabajo (LLM, NLP): Tk no admite self.after() fuera de su hilo,
+        # así que publican aquí y _drain_events lo vuelca al bus desde el bucle de Tk
+        import queue as _queue
+        self._event_inbox = _queue.SimpleQueue()
+        self.after(100, self._drain_events)
+
+        # Métricas por turno del LLM (tokens de prefijo reaprovechados, TTFT) al bus de eventos
+        try:
+            self.llm.add_turn_listener(lambda st: self._log_threadsafe("llm_turn", **st))
+            # latencia de "Detener" (cancel → el bucle de tokens para de verdad)
+            self.llm.add_cancel_listener(lambda st: self._log_threadsafe("llm_cancel", **st))
+            # por respuesta: tok/s efectivos y aceptación del borrador (PACQUI_SPECULATIVE)
+            self.llm.add_answer_listener(lambda st: self._log_threadsafe("llm_answer", **st))
+        except Exception:
+            pass
+
+        # --- NLP (spaCy) perezoso: se carga en segundo plano tras el arranque y publica
+        #     tiempo de carga y docs/s en el bus (nlp_load / nlp_batch) ---
+        try:
+            import nlp_es
+            nlp_es.add_listener(self._log_threadsafe)
+            self.after(3000, nlp_es.warmup_async)
+        except Exception:
+            pass
 
         # --- UI PRINCIPAL (estaba dentro de subscribe_events por error) ---
         top = ttk.Frame(self, padding=(10, 10, 10, 6))
@@ -516,6 +546,10 @@ class AppRoot(tk.Tk):
                 c = con.cursor()
                 n_chunks = c.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
                 n_embs = c.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                try:  # almacén por contenido (vectores deduplicados por hash de chunk)
+                    n_embs += c.execute("SELECT COUNT(*) FROM chunk_vecs").fetchone()[0]
+                except Exception:
+                    pass
             print(f"[RAG] chunks={n_chunks} embeddings={n_embs} en {self.data.db_path}")
         except Exception as e:
             print(f"[RAG] No se pudo comprobar: {e}")
@@ -534,6 +568,22 @@ class AppRoot(tk.Tk):
             except Exception:
                 pass
 
+    def _log_threadsafe(self, typ: str, **data):
+        """_log desde cualquier hilo: el evento (con su hora) espera en el buzón hasta el próximo _drain_events."""
+        self._event_inbox.put((time.time(), typ, data))
+
+    def _drain_events(self):
+        try:
+            while True:
+                ts, typ, data = self._event_inbox.get_nowait()
+                self._log(typ, **{"ts": ts, **data})
+        except Exception:
+            pass
+        try:
+            self.after(100, self._drain_events)
+        except Exception:
+            pass
+
     def _on_close(self):
         try:
             # Cierra modelo LLM si está cargado (libera recursos nativos)
@@ -596,9 +646,10 @@ class AppRoot(tk.Tk):
             return
 
         # Si no está instalado llama_cpp en este intérprete, no molestamos al usuario
+        # (con PACQUI_LLM_WORKER=1 el modelo lo carga llm_worker.py y aquí no hace falta)
         try:
             import importlib.util
-            if importlib.util.find_spec("llama_cpp") is None:
+            if os.getenv("PACQUI_LLM_WORKER", "0") != "1" and importlib.util.find_spec("llama_cpp") is None:
                 print("Auto-carga omitida: 'llama_cpp' no está instalado en este intérprete.")
                 return
         except Exception:
@@ -1276,6 +1327,11 @@ class AdminPanel(ttk.Notebook):
         self.var_diag = tk.StringVar()
         ttk.Entry(right, textvariable=self.var_diag, width=28).pack(anchor="w", pady=(2,4))
         ttk.Button(right, text="Probar recuperación", command=self._run_diag).pack(anchor="w")
+
+        ttk.Label(right, text="Caché de respuestas", style="Header.TLabel").pack(anchor="w", pady=(10, 0))
+        self.var_acache = tk.StringVar(value="—")
+        ttk.Label(right, textvariable=self.var_acache, justify="left").pack(anchor="w")
+        ttk.Button(right, text="Vaciar caché", command=self._clear_answer_cache).pack(anchor="w", pady=(2, 0))
         # ---- Auto refresh ----
         self.var_auto_logs = tk.BooleanVar(value=True)
         ttk.Checkbutton(right, text="Auto", variable=self.var_auto_logs).pack(anchor="w", pady=(8, 0))
@@ -2424,7 +2480,7 @@ class AdminPanel(ttk.Notebook):
 
         # Tu LLMService expone .chat(...). Lo estás usando así en el banco de pruebas. :contentReference[oaicite:2]{index=2}
         if hasattr(mdl, "chat"):
-            out = mdl.chat(messages=messages, temperature=0.2, stream=False)
+            out = mdl.chat(messages=messages, temperature=0.2, stream=False, priority="eval")
             return out["choices"][0]["message"]["content"]
 
         # Compatibilidad si expusieras el objeto llama-cpp por debajo:
@@ -3783,10 +3839,31 @@ class AdminPanel(ttk.Notebook):
 
     # <<< PATCH LOGS
     # >>> PATCH LOGS: temporizador a prueba de bombas (pegar íntegro)
+    def _refresh_answer_cache_label(self):
+        cache = getattr(self.app, "answer_cache", None)
+        var = getattr(self, "var_acache", None)
+        if var is None:
+            return
+        if cache is None:
+            var.set("desactivada")
+            return
+        st = cache.stats()
+        rate = f"{st['hit_rate']:.0%}" if st["hit_rate"] is not None else "—"
+        var.set(f"aciertos {st['hits']} · fallos {st['misses']} · sin caché {st['bypassed']}\n"
+                f"tasa {rate} · entradas {st['entries']}")
+
+    def _clear_answer_cache(self):
+        cache = getattr(self.app, "answer_cache", None)
+        if cache is not None:
+            cache.clear()
+            self.app._log("answer_cache_clear")
+        self._refresh_answer_cache_label()
+
     def _tick_logs(self):
         """Temporiza la recarga de logs sin permitir que una excepción mate el loop."""
         try:
             self._refresh_logs_tab()
+            self._refresh_answer_cache_label()
         except Exception as e:
             # Capturamos todo para evitar bucles de callback fallidos
             try:
@@ -4683,6 +4760,10 @@ class ChatWithLLM(ChatFrame):
         )
         chk.pack(side="left", padx=(8, 0))
 
+        # --- Checkbox "Sin caché": fuerza generar aunque la respuesta esté en la caché ---
+        self.var_no_cache = tk.BooleanVar(value=False)
+        ttk.Checkbutton(parent, text="Sin caché", variable=self.var_no_cache).pack(side="left", padx=(8, 0))
+
         # --- Selector de agente (PACqui / Copilot importado) ---
         try:
             self.var_agent = tk.StringVar(value=getattr(self, "_active_agent", "PACqui"))
@@ -4838,7 +4919,7 @@ class ChatWithLLM(ChatFrame):
             )
             msgs = [{"role": "system", "content": system},
                     {"role": "user", "content": user}]
-            resp = self.llm.chat(msgs, temperature=0.2, max_tokens=64, stream=False)
+            resp = self.llm.chat(msgs, temperature=0.2, max_tokens=64, stream=False, priority="persona")
             line = ((resp.get("choices") or [{}])[0].get("message") or {}).get("content", "") or ""
             line = line.strip().replace("\n", " ")
             # Saneado final: si el modelo se pasa, recortamos.
@@ -4857,51 +4938,31 @@ class ChatWithLLM(ChatFrame):
         # Política estricta: FRAGMENTOS > CONCEPTOS > (si nada) solo rutas
         base_sys = self._system_policy_rag()
 
-# Contexto inicial (auto-escala con el ctx del modelo)
+        # Contexto inicial (auto-escala con el ctx del modelo)
         ctx = int(getattr(self.llm, "ctx", 2048) or 2048)
         idx_top, idx_note_chars = 2, 160  # menos índice -> menos prompt
         rag_k, rag_frag_chars = 3, 240  # frags RAG algo más cortos
 
-        def shrink(text: str, max_chars: int) -> str:
-            t = (text or "").strip()
-            return t if len(t) <= max_chars else t[:max_chars].rstrip() + "…"
-
         def toklen(s: str) -> int:
+            # LLMService.count_tokens memoiza por bloque: SYSTEM y fragmentos sin cambios no se re-tokenizan
             try:
-                return len(self.llm.model.tokenize(s.encode("utf-8"), add_bos=False)) if self.llm.model else max(1,
-                                                                                                                 int(len(
-                                                                                                                     s) / 4))
+                return self.llm.count_tokens(s) if self.llm.model else max(1, int(len(s) / 4))
             except Exception:
                 return max(1, int(len(s) / 4))
 
-        # 1) Construcción de contextos
-        # 1) Construcción de contextos (RECUPERACIÓN con rewrite)
+        # 1) Recuperación UNA vez, con candidatos de sobra (el empaquetador decide qué entra)
         retrieval_q = self._rewrite_query_for_retrieval(user_text)
         self._last_retrieval_q = retrieval_q  # diagnóstico opcional
 
-        idx_ctx, hits = self.llm.build_index_context(
-            retrieval_q, top_k=idx_top, max_note_chars=idx_note_chars
+        _idx_txt, idx_cand = self.llm.build_index_context(
+            retrieval_q, top_k=idx_top + 2, max_note_chars=idx_note_chars
         )
 
         rag_ctx = self.llm._rag_retrieve(
-            retrieval_q, k=rag_k, max_chars=rag_frag_chars
+            retrieval_q, k=rag_k * 2, max_chars=rag_frag_chars
         )
 
-        # contexto muy breve de conversación (no es fuente, sólo guía)
-        prev_q = (getattr(self, "_last_user_q", "") or "").strip()
-        prev_a = (getattr(self, "_last_bot_a", "") or "").strip()
-        if prev_q and prev_a and prev_q != user_text:
-            chat_hint = f"Contexto de conversación (NO es fuente, sólo guía):\n- Pregunta anterior: {prev_q[:240]}\n- Resumen respuesta previa: {prev_a[:240]}\n\n"
-        else:
-            chat_hint = ""
-
         # 2) Bloques secundarios
-        try:
-            obs_block, rutas_block, _ = self._build_obs_and_routes_blocks(hits, max_items=2, max_obs_chars=160)
-
-        except Exception:
-            obs_block, rutas_block = "", ""
-
         try:
             concept_block = self.llm.concept_context(retrieval_q, max_chars=300, top_k=3) or ""
 
@@ -4914,67 +4975,20 @@ class ChatWithLLM(ChatFrame):
                         _frags.append(f"[{i}] {ln}\n    Fuente: Concepto")
                     rag_ctx = "\n".join(_frags)
 
-
         except Exception:
             concept_block = ""
 
-
-
-        # 3) Ensamblado: política en SYSTEM, evidencia en USER
-        def build_user_text():
-            parts = [f"Pregunta del usuario:\n{user_text}"]
-            # FRAGMENTOS (principal ancla factual)
-            if rag_ctx and rag_ctx.strip():
-                parts += ["=== FRAGMENTOS (cítalos como [1], [2], …) ===", rag_ctx]
-            # ÍNDICE (solo apoyo contextual)
-            if idx_ctx and idx_ctx.strip():
-                parts += ["=== ÍNDICE (observaciones/rutas del índice) ===", idx_ctx]
-            # CONCEPTOS (solo si no hay FRAGMENTOS; ya hicimos fusión concepto→fragmento arriba)
-            if (not rag_ctx or not rag_ctx.strip()) and concept_block and concept_block.strip():
-                parts += ["=== CONCEPTOS (semántica corta) ===", concept_block]
-
-            parts += [
-                "Instrucciones de uso:",
-                "- Responde a la PREGUNTA usando exclusivamente los FRAGMENTOS; el ÍNDICE es apoyo contextual.",
-                "- No pidas más datos ni hagas listas genéricas. Responde directamente.",
-                "- Cita con [n] cada punto que derives de un fragmento.",
-                "- Si no hay datos suficientes en los fragmentos para algún apartado, dilo."
-            ]
-            return "\n\n".join(parts).strip()
-
-        ucontent = build_user_text()
+        # 3) Empaquetado en una pasada: política en SYSTEM, evidencia en USER, presupuesto SYSTEM+USER+respuesta
+        from context_packer import pack, split_fragments
         sys_full = base_sys  # ← El SYSTEM queda SOLO con la política
-
-        # 4) Presupuesto: contamos SYSTEM + USER (no solo system)
-        def used_effective():
-            # margen prudente (chat-format) + pequeño fijo
-            return int(1.15 * (toklen(sys_full) + toklen(ucontent))) + 10
-
-        used = used_effective()
-        resp_budget = int(max_tokens)
-
-        # 5) Ajuste iterativo hasta encajar en ctx
-        for _ in range(10):
-            if used + resp_budget <= ctx - 64:
-                break
-            if rag_ctx and len(rag_ctx) > 180:
-                rag_frag_chars = max(180, int(rag_frag_chars * 0.80))
-                rag_ctx = shrink(rag_ctx, rag_frag_chars)
-            elif hits and idx_top > 1:
-                idx_top = max(1, idx_top - 1)
-                idx_note_chars = max(120, int(idx_note_chars * 0.85))
-                idx_ctx, hits = self.llm.build_index_context(
-                    retrieval_q, top_k=idx_top, max_note_chars=idx_note_chars
-
-
-                )
-            elif resp_budget > 96:
-                resp_budget = max(96, int(resp_budget * 0.85))
-            else:
-                break
-            # reensamblar USER después de recortes
-            ucontent = build_user_text()
-            used = used_effective()
+        packed = pack(user_text, sys_full, split_fragments(rag_ctx), idx_cand or [], toklen,
+                      ctx=ctx, max_tokens=int(max_tokens), concept_block=concept_block,
+                      frag_max=rag_k, idx_max=idx_top)
+        ucontent = packed["user"]
+        used = packed["used"]
+        resp_budget = packed["resp_budget"]
+        hits = packed["hits"] or list(idx_cand or [])[:1]
+        self._last_pack = packed["decision"]  # diagnóstico: qué entró, qué se recortó y por qué
 
         # Límite final dinámico (respeta variable de entorno y contexto)
         import os as _os_tokcap
@@ -4990,8 +5004,9 @@ class ChatWithLLM(ChatFrame):
         try:
             import os as _os
             if _os.getenv("PACQUI_DIAG_RAG", "0") == "1":
-                _frags = (rag_ctx or "").count("\n    Fuente:")
+                _frags = ucontent.count("\n    Fuente:")
                 print(f"[CTX] frags={_frags}  idx_hits={len(hits)}  tok(system)={toklen(sys_full)}  tok(user)={toklen(ucontent)}")
+                print(f"[CTX] pack={self._last_pack}")
         except Exception:
             pass
 
@@ -5160,6 +5175,12 @@ class ChatWithLLM(ChatFrame):
         # Bloquea la UI desde ya (aunque aún no haya stream)
         self._spinner_start()
 
+        # "Sin caché" se lee aquí (hilo de Tk), no en el worker
+        try:
+            no_cache = bool(self.var_no_cache.get())
+        except Exception:
+            no_cache = False
+
         # worker: construye contexto corto y lanza streaming
         # worker: construye contexto corto y lanza streaming (versión unificada SIN has_idx/has_rag)
         def worker():
@@ -5176,6 +5197,27 @@ class ChatWithLLM(ChatFrame):
                     obs_block, rutas_block = "", ""
                 suffix = ("Rutas sugeridas:\n\n" + rutas_block) if rutas_block else ""
 
+                # 2b) Caché de respuestas: misma pregunta + misma recuperación + mismo modelo → al instante
+                self._acache_pending = None
+                cache = getattr(self.app, "answer_cache", None)
+                try:
+                    import answer_cache as _acache
+                    if cache is not None and _acache.ENABLED:
+                        fp = _acache.fingerprint(messages, hits, model=getattr(self.llm, "model_path", ""),
+                                                 params=f"{tok_out}|0.1")
+                        akey = cache.key(q, fp)
+                        if no_cache:
+                            cache.note_bypass()
+                        else:
+                            cached = cache.get(akey)
+                            if cached:
+                                self._turn_start_ts = time.time()
+                                self.after(0, lambda a=cached: self._serve_cached_answer(a, suffix))
+                                return
+                        self._acache_pending = (akey, q, fp)
+                except Exception:
+                    self._acache_pending = None
+
                 # 3) Lanzar streaming real (pintado progresivo + fallback integrados)
                 self._turn_start_ts = time.time()  # métrica para históricos
                 self.after(0, lambda: self._stream_llm_with_fallback(
@@ -5740,6 +5782,49 @@ class ChatWithLLM(ChatFrame):
             except Exception:
                 pass
 
+    def _serve_cached_answer(self, answer: str, suffix: str = ""):
+        """Pinta una respuesta de la caché como si acabara de generarse (sin tocar el modelo)."""
+        import time
+        try:
+            self._append_stream_text("")
+            self._append_stream_text(answer)
+            if suffix:
+                self._append_stream_text("\n" + suffix)
+            self._append_stream_text("", end_turn=True)
+        except Exception:
+            pass
+        self._last_bot_a = (answer or "").strip()
+        try:
+            self._spinner_stop()
+        except Exception:
+            pass
+        try:
+            t0 = getattr(self, "_turn_start_ts", None)
+            self.progress(f"Listo (caché, {int((time.time() - t0) * 1000) if t0 else 0} ms).")
+        except Exception:
+            pass
+        try:
+            self.app._log("answer_cache", hit=True, chars=len(answer or ""))
+        except Exception:
+            pass
+        try:
+            self._log_qa_if_possible(answer)
+        except Exception:
+            pass
+
+    def _answer_cache_store(self, answer: str):
+        pend = getattr(self, "_acache_pending", None)
+        self._acache_pending = None
+        cache = getattr(self.app, "answer_cache", None)
+        if not pend or cache is None or not (answer or "").strip():
+            return
+        akey, q, fp = pend
+        cache.put(akey, q, fp, answer.strip(), model=os.path.basename(getattr(self.llm, "model_path", "") or ""))
+        try:
+            self.app._log("answer_cache", hit=False, stored=True)
+        except Exception:
+            pass
+
     def _stream_llm_with_fallback(self, messages, max_tokens=768, temperature=0.2, suffix: str = ""):
         import threading, time, queue
         # UI: arranque
@@ -5838,6 +5923,7 @@ class ChatWithLLM(ChatFrame):
                     # ¿hay que continuar porque hemos tocado el límite?
                     if state.get("needs_continue") and not state.get("continued"):
                         state["continued"] = True
+                        self._acache_pending = None  # respuesta en dos tramos: no se cachea
                         try:
                             partial = "".join(out_buf).strip()
                         except Exception:
@@ -5884,6 +5970,12 @@ class ChatWithLLM(ChatFrame):
                         if t0: self.progress(f"Listo ({int((time.time() - t0) * 1000)} ms).")
                     except Exception:
                         pass
+                    try:
+                        if not state.get("timed_out") and not (getattr(self, "stop_event", None)
+                                                               and self.stop_event.is_set()):
+                            self._answer_cache_store("".join(out_buf))
+                    except Exception:
+                        pass
                     try:
                         self._log_qa_if_possible("".join(out_buf))
                     except Exception:
@@ -5925,15 +6017,17 @@ class ChatWithLLM(ChatFrame):
                 try:
                     # 1) completion STREAMING (prioritario por latencia de 1er token)
                     prompt = _to_instruct(_messages)
-                    model = getattr(self.llm, "model", None)
-                    if model is None:
+                    if getattr(self.llm, "model", None) is None:
                         raise RuntimeError("model no disponible")
 
                     out_chunks = []
-                    for chunk in model.create_completion(prompt=prompt, temperature=_temperature,
-                                                         max_tokens=_max_tokens, stream=True):
+                    # por el planificador como trabajo "chat": no se cuela a mitad de otra generación
+                    stream = self.llm.complete(prompt=prompt, temperature=_temperature,
+                                               max_tokens=_max_tokens, stream=True, priority="chat")
+                    for chunk in stream:
 
                         if getattr(self, "stop_event", None) and self.stop_event.is_set():
+                            stream.close()          # cancela el Job (se corta entre token y token)
                             break
                         delta = ""
                         try:
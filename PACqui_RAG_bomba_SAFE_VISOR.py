@@ -492,60 +492,10 @@ def hex_adjust(hexcolor: str, factor: float) -> str:
 
 
 # ============================ LINGÜÍSTICA / NLP (mínima) ============================
-SPANISH_STOPWORDS = {
-    'a','acá','ahí','al','algo','algún','alguna','algunas','alguno','algunos','allá','allí','ambas','ambos',
-    'ante','anteayer','antes','aquel','aquella','aquellas','aquello','aquellos','aquí','arriba','así','atrás',
-    'aun','aunque','bajo','bastante','bien','cada','casi','como','con','conmigo','contigo','contra','cual',
-    'cuales','cualquier','cualquiera','cuyas','cuyos','cuya','cuyo','de','dejar','del','demasiado','demás',
-    'dentro','deprisa','desde','despacio','donde','dos','el','él','ella','ellas','ello','ellos','emplear',
-    'en','encima','entonces','entre','era','eran','es','esa','esas','ese','eso','esos','esta','está','estaba',
-    'estaban','estado','estar','estará','estas','este','esto','estos','estoy','fin','fue','fueron','fui','fuimos',
-    'gracias','gran','grande','ha','haber','había','habían','hace','hacen','hacer','hacerlo','hacia','han','hasta',
-    'hay','hoy','la','las','le','lo','los','luego','mal','más','me','menos','mi','mis','mío','mía','míos','mías',
-    'mientras','muy','nada','nadie','ni','ningún','ninguna','ninguno','no','nos','nosotras','nosotros','nuestra',
-    'nuestras','nuestro','nuestros','nunca','o','os','otra','otras','otro','otros','para','pero','poco','por',
-    'porque','primero','puede','pueden','pues','qué','que','quien','quién','quienes','saber','se','según','ser',
-    'si','sí','siempre','siendo','sin','sobre','sois','solamente','solo','su','sus','tal','también','tampoco',
-    'tan','tanto','te','tenéis','tengo','tener','tiene','tienen','todo','todos','tras','tu','tus','tuya','tuyo',
-    'tuyos','tuyas','un','una','unas','uno','unos','usted','ustedes','va','vamos','van','varias','varios','vosotras',
-    'vosotros','voy','ya','yo'
-}
-
-def _simple_tokenize_es(text: str):
-    if not text:
-        return []
-    tokens = re.findall(r"[A-Za-zÁÉÍÓÚÜáéíóúüÑñ0-9]{3,}", text, flags=re.UNICODE)
-    return [t.lower() for t in tokens]
-
-def _is_probable_noun_es(token: str):
-    # Solo sustantivos (heurística). Excluimos verbos/tiempos comunes.
-    if not token or len(token) < 3:
-        return False
-    # No números puros
-    if token.isdigit():
-        return False
-    # Stopwords fuera
-    if token in SPANISH_STOPWORDS:
-        return False
-    # Adverbios y derivados largos
-    if token.endswith(("mente","amiento","imientos","imiento","aciones","ación","sión","mente")):
-        return False
-    # Gerundios y participios
-    if token.endswith(("ando","iendo","yendo","ado","ada","ados","adas","ido","ida","idos","idas")):
-        return False
-    # Infinitivos
-    if token.endswith(("ar","er","ir")):
-        return False
-    # Conjugaciones frecuentes (muy simple; puede sobrefiltrar algunos sustantivos cortos)
-    if token.endswith(("aré","arás","ará","aremos","arán",
-                       "eré","erás","erá","eremos","erán",
-                       "iré","irás","irá","iremos","irán",
-                       "aba","abas","aban","íamos","ías","ían",
-                       "aste","aron","iste","ieron","amos","imos",
-                       "aré","ería","erías","erían","iría","irías","irían")):
-        return False
-    # Aceptamos siglas/palabras alfanuméricas si no pasan filtros anteriores
-    return True
+# Stopwords y heurística de sustantivos viven en nlp_es (importables desde procesos hijo)
+from nlp_es import SPANISH_STOPWORDS, _simple_tokenize_es, _is_probable_noun_es
+
+
 class ScanWizardDialog(tk.Toplevel):
     """
     Wizard de escaneo:
@@ -1179,6 +1129,7 @@ class OrganizadorFrame(ttk.Frame):
 
         self._prev_img = None
         self._prev_pil = None
+        self._prev_lock = threading.Lock()   # un render a la vez (COM/tmp compartidos)
 
         self.tree.bind("<<TreeviewSelect>>", self._on_preview_select)
         self.tree.bind("<Double-1>", self._on_open_item)
@@ -1326,6 +1277,14 @@ class OrganizadorFrame(ttk.Frame):
     activebackground=self.colors.get("ok", "#d1f2eb"),
 )
         self.btn_scraper.grid(row=0, column=0, padx=(0, 6))
+        self.btn_kw_corpus = tk.Button(
+    grp_scr,
+    text="Keywords corpus (TF-IDF)",
+    command=lambda: self._corpus_keywords_async(open_review=True),
+    bg=self.colors.get("ok", "#d1f2eb"),
+    activebackground=self.colors.get("ok", "#d1f2eb"),
+)
+        self.btn_kw_corpus.grid(row=0, column=1, padx=(0, 6))
 
         ttk.Separator(row_buttons, orient="vertical").grid(row=0, column=5, sticky="ns", padx=8)
 
@@ -1583,6 +1542,10 @@ class OrganizadorFrame(ttk.Frame):
             self.queue.put(("msg", (f"SQLite insert error: {ex}", "WARN")))
 
     def _db_finalize_scan(self):
+        # RAG fichero a fichero durante el escaneo → el TF-IDF del corpus se lanza una vez, aquí
+        done = getattr(self, "_rag_index_done", None)
+        if callable(done):
+            done()
         if getattr(self, "_db_conn", None) is None:
             return
         try:
@@ -2767,13 +2730,137 @@ class OrganizadorFrame(ttk.Frame):
         vals = self.tree.item(iid, "values")
         ruta = vals[5] if len(vals) >= 6 else None
         if ruta:
-            threading.Thread(target=self._render_preview_safe, args=(ruta,), daemon=True).start()
+            self._preview_request(ruta)
+            self._preview_prefetch(iid)
+
+    # Presupuesto (s) por formato para renderizar la vista previa; PACQUI_PREVIEW_TIMEOUT_SCALE lo escala
+    _PREVIEW_BUDGETS = {".pdf": 8, ".doc": 25, ".docx": 25, ".xls": 25, ".xlsx": 25, ".xlsm": 25,
+                        ".xltx": 25, ".ppt": 25, ".pptx": 25}
+
+    def _preview_budget(self, ruta) -> float:
+        ext = os.path.splitext(str(ruta))[1].lower()
+        try:
+            scale = float(os.getenv("PACQUI_PREVIEW_TIMEOUT_SCALE", "1"))
+        except Exception:
+            scale = 1.0
+        return max(1.0, self._PREVIEW_BUDGETS.get(ext, 10) * scale)
+
+    def _preview_request(self, ruta):
+        """
+        Pide una vista previa sin bloquear la UI: muestra un marcador al instante y deja el trabajo
+        a un único hilo de vista previa. Sólo cuenta la última selección (las anteriores se descartan).
+        """
+        self._prev_seq = getattr(self, "_prev_seq", 0) + 1
+        self._prev_pending = (self._prev_seq, ruta)
+        try:
+            self._show_preview_text(f"Cargando vista previa…\n\n{os.path.basename(str(ruta))}")
+        except Exception:
+            pass
+        if getattr(self, "_prev_evt", None) is None:
+            self._prev_evt = threading.Event()
+            threading.Thread(target=self._preview_worker, name="preview", daemon=True).start()
+        self._prev_evt.set()
+
+    def _preview_worker(self):
+        while True:
+            self._prev_evt.wait()
+            self._prev_evt.clear()
+            seq, ruta = getattr(self, "_prev_pending", (None, None))
+            if ruta is None or seq != getattr(self, "_prev_seq", None):
+                continue
+            self._render_preview_safe(ruta, seq)
+
+    def _preview_is_current(self, seq) -> bool:
+        return seq is None or seq == getattr(self, "_prev_seq", None)
+
+    def _preview_post(self, seq, fn):
+        """Ejecuta fn en el hilo Tk sólo si la selección sigue siendo la misma."""
+        self.after(0, lambda: fn() if self._preview_is_current(seq) else None)
+
+    @staticmethod
+    def _com_init_thread():
+        # Office COM exige CoInitialize en cada hilo que lo use
+        try:
+            import pythoncom  # type: ignore
+            pythoncom.CoInitialize()
+        except Exception:
+            pass
+
+    def _preview_image_cached(self, ruta, timeout=None):
+        """Imagen de vista previa desde la caché en disco (preview_cache) o renderizada y guardada."""
+        lock = self._prev_lock       # cerrojo vigente; se libera este mismo aunque _render_preview lo sustituya
+        try:
+            from preview_cache import get_cache, ENABLED
+            cache = get_cache() if ENABLED else None
+        except Exception:
+            cache = None
+        if cache is not None:
+            found, img = cache.get(ruta)
+            if found:
+                return img
+        # si otro render (p. ej. una conversión de Office colgada) tiene el cerrojo, no esperar sin fin
+        if not lock.acquire(timeout=-1 if timeout is None else max(0.0, float(timeout))):
+            raise TimeoutError("render de vista previa ocupado")
+        try:
+            if cache is not None:
+                # mientras se esperaba el cerrojo el prefetch puede haberla dejado en caché (sin recontar)
+                found, img = cache.get(ruta, count=False)
+                if found:
+                    return img
+            img = self._preview_first_page_to_image(ruta)
+            if cache is not None:
+                cache.put(ruta, img)
+            return img
+        finally:
+            lock.release()
 
-    def _render_preview_safe(self, ruta):
+    def _preview_prefetch(self, iid, n=None):
+        """Pre-renderiza en segundo plano las siguientes filas de la lista (PACQUI_PREVIEW_PREFETCH)."""
         try:
-            self._render_preview(ruta)
+            n = int(os.getenv("PACQUI_PREVIEW_PREFETCH", "3")) if n is None else n
+            if n <= 0:
+                return
+            paths, nxt = [], iid
+            for _ in range(n):
+                nxt = self.tree.next(nxt)
+                if not nxt:
+                    break
+                vals = self.tree.item(nxt, "values")
+                if vals and len(vals) >= 6 and vals[5]:
+                    paths.append(vals[5])
+            if not paths:
+                return
+            import queue as _queue
+            if getattr(self, "_prefetch_q", None) is None:
+                self._prefetch_q = _queue.Queue()
+                self._prefetch_gen = 0
+                threading.Thread(target=self._preview_prefetch_worker, daemon=True).start()
+            self._prefetch_gen += 1            # la selección nueva deja obsoletas las pendientes
+            for p in paths:
+                self._prefetch_q.put((self._prefetch_gen, p))
+        except Exception:
+            pass
+
+    def _preview_prefetch_worker(self):
+        self._com_init_thread()
+        from preview_cache import get_cache
+        cache = get_cache()
+        while True:
+            gen, ruta = self._prefetch_q.get()
+            try:
+                if gen != self._prefetch_gen or cache.has(ruta):
+                    continue
+                with self._prev_lock:
+                    if gen == self._prefetch_gen and not cache.has(ruta):
+                        cache.put(ruta, self._preview_first_page_to_image(ruta))
+            except Exception:
+                pass
+
+    def _render_preview_safe(self, ruta, seq=None):
+        try:
+            self._render_preview(ruta, seq)
         except Exception as e:
-            self.after(0, lambda: self._show_preview_text(f"Previsualización no disponible.\n\n{e}"))
+            self._preview_post(seq, lambda: self._show_preview_text(f"Previsualización no disponible.\n\n{e}"))
 
     def _set_prev_text(self, text):
         text = self._normalize_text(text)
@@ -3129,118 +3216,76 @@ class OrganizadorFrame(ttk.Frame):
                 return None
 
         return None
+    # Los tres helpers de vista previa usan los extractores de doc_extract (misma lógica) a través
+    # de la caché persistente de texto: abrir otra vez el mismo fichero no vuelve a parsear el zip.
     def _extract_text_docx_zip(self, ruta, max_paras=60):
-        import zipfile, re
+        from doc_extract import cached_part, docx_text
         try:
-            with zipfile.ZipFile(ruta) as z:
-                xml = z.read("word/document.xml").decode("utf-8", errors="ignore")
+            out = cached_part(ruta, f"docx_zip:{max_paras}",
+                              lambda: docx_text(ruta, max_paras=max_paras, raise_errors=True), raise_errors=True)
         except Exception as e:
             return f"DOCX sin texto.\n{e}"
-        xml = xml.replace("</w:p>", "\n")
-        text = re.sub(r"<[^>]+>", "", xml)
-        text = text.replace("&amp;", "&").replace("&lt;", "<").replace("&gt;", ">")
-        lines = [ln.strip() for ln in text.splitlines()]
-        out = "\n".join([ln for ln in lines if ln][:max_paras])
         return out or "Sin texto"
 
     def _extract_text_xlsx_zip(self, ruta, max_rows=20, max_cols=8):
-        import zipfile, xml.etree.ElementTree as ET
+        from doc_extract import cached_part, xlsx_text
         try:
-            z = zipfile.ZipFile(ruta)
+            out = cached_part(ruta, f"xlsx_zip:{max_rows}:{max_cols}",
+                              lambda: xlsx_text(ruta, max_rows=max_rows, max_cols=max_cols, raise_errors=True),
+                              raise_errors=True)
         except Exception as e:
             return f"XLSX no legible.\n{e}"
-        # shared strings
-        sst = []
-        try:
-            sst_xml = z.read("xl/sharedStrings.xml")
-            root = ET.fromstring(sst_xml)
-            for si in root.iter():
-                if si.tag.endswith("t"):
-                    sst.append(si.text or "")
-        except Exception:
-            sst = []
-        # first sheet path
-        try:
-            wb = ET.fromstring(z.read("xl/workbook.xml"))
-            ns = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
-            first_sheet_id = wb.find(f".//{ns}sheet").attrib.get("{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id")
-            rels = ET.fromstring(z.read("xl/_rels/workbook.xml.rels"))
-            target = None
-            for rel in rels:
-                if rel.attrib.get("Id")==first_sheet_id:
-                    target = rel.attrib.get("Target"); break
-            sheet_xml = z.read("xl/"+target)
-            sh = ET.fromstring(sheet_xml)
-            rows=[]
-            for r in sh.iter():
-                if not r.tag.endswith("row"): continue
-                row_vals=[]
-                for c in r:
-                    if not c.tag.endswith("c"): continue
-                    t_attr = c.attrib.get("t")  # 's' (shared), 'inlineStr' o None
-                    v = c.find(f"{ns}v")
-                    val = ""
-                    if t_attr == "s" and v is not None:
-                        try:
-                            idx=int(v.text or "0"); val=sst[idx] if 0 <= idx < len(sst) else ""
-                        except Exception:
-                            val = v.text or ""
-                    elif t_attr == "inlineStr":
-                        is_node = c.find(f"{ns}is")
-                        texts = []
-                        if is_node is not None:
-                            for tnode in is_node.iter():
-                                if tnode.tag.endswith("t"):
-                                    texts.append(tnode.text or "")
-                        val = "".join(texts)
-                    else:
-                        val = v.text if v is not None else ""
-                    row_vals.append("" if val is None else str(val))
-                if row_vals:
-                    rows.append("\t".join(row_vals[:max_cols]))
-                if len(rows)>=max_rows: break
-            return "\n".join(rows) or "Sin datos"
-        except Exception as e:
-            return f"No se pudo leer hoja.\n{e}"
+        return out or "Sin datos"
 
     def _extract_text_pptx_zip(self, ruta, max_slides=6):
-        import zipfile, xml.etree.ElementTree as ET
+        from doc_extract import cached_part, pptx_text
         try:
-            z = zipfile.ZipFile(ruta)
-            slides = []
-            i = 1
-            while i<=max_slides:
-                name = f"ppt/slides/slide{i}.xml"
-                try:
-                    xml = z.read(name)
-                except Exception:
-                    break
-                root = ET.fromstring(xml)
-                texts=[]
-                for t in root.iter():
-                    if t.tag.endswith("t"):
-                        texts.append(t.text or "")
-                slide_text = " ".join(texts).strip()
-                slides.append(f"[{i}] {slide_text}")
-                i += 1
-            return "\n\n".join(slides) or "Sin texto"
+            out = cached_part(ruta, f"pptx_zip:{max_slides}",
+                              lambda: pptx_text(ruta, max_slides=max_slides, raise_errors=True), raise_errors=True)
         except Exception as e:
             return f"PPTX sin texto.\n{e}"
+        return out or "Sin texto"
 
-    def _render_preview(self, ruta):
+    def _render_preview(self, ruta, seq=None):
         """
         Obtiene una imagen de la primera página/diapositiva cuando sea posible.
         Si no se puede, muestra texto como fallback.
+        El render va en un hilo aparte con presupuesto por formato (_preview_budget): si se agota
+        se avisa y se sigue; el resultado tardío sólo alimenta la caché. Si el usuario ya ha
+        seleccionado otro fichero (seq obsoleto) no se pinta nada.
+        Un render abandonado (Office colgado, no se puede interrumpir) se queda con SU cerrojo: los
+        siguientes usan uno nuevo en vez de hacer cola detrás de él.
         """
-        try:
-            img = self._preview_first_page_to_image(ruta)
-        except Exception:
-            img = None
+        budget = self._preview_budget(ruta)
+        box = {}
+
+        def _job():
+            self._com_init_thread()
+            try:
+                box["img"] = self._preview_image_cached(ruta, timeout=budget)
+            except Exception:
+                box["img"] = None
+
+        th = threading.Thread(target=_job, name="preview-render", daemon=True)
+        th.start()
+        th.join(budget)
+        if th.is_alive():
+            lock = self._prev_lock
+            if lock.locked():
+                self._prev_lock = threading.Lock()
+        if not self._preview_is_current(seq):
+            return
+        if th.is_alive():
+            name = os.path.basename(str(ruta))
+            self._preview_post(seq, lambda: self._show_preview_text(
+                f"La vista previa de {name} ha superado {budget:.0f} s y se ha descartado.\n"
+                "Si termina en segundo plano quedará en caché para la próxima vez."))
+            return
+        img = box.get("img")
         if img is not None:
-            self.after(0, lambda: self._show_preview_image(img))
+            self._preview_post(seq, lambda: self._show_preview_image(img))
             return
         # Fallback a texto si procede
-        import os
         ext = os.path.splitext(ruta)[1].lower()
 
         # Aviso de dependencias (una vez) si no se pudo renderizar imagen real
@@ -3256,12 +3301,12 @@ class OrganizadorFrame(ttk.Frame):
             try:
                 with open(ruta, "r", encoding="utf-8", errors="ignore") as f:
                     chunk = f.read(65536)
-                self.after(0, lambda: self._show_preview_text(chunk))
+                self._preview_post(seq, lambda: self._show_preview_text(chunk))
                 return
             except Exception as e:
-                self.after(0, lambda: self._show_preview_text("No se pudo leer el texto.\n{}".format(e)))
+                self._preview_post(seq, lambda: self._show_preview_text("No se pudo leer el texto.\n{}".format(e)))
                 return
-        self.after(0, lambda: self._show_preview_text("Sin miniatura disponible."))
+        self._preview_post(seq, lambda: self._show_preview_text("Sin miniatura disponible."))
 
     def _show_keywords_for_file(self, ruta: str):
         try:
@@ -3308,79 +3353,18 @@ class OrganizadorFrame(ttk.Frame):
             self._append_msg(f"SQLite (keywords) error: {e}", "WARN")
 
     def _extract_text_generic(self, ruta: str, max_chars: int = 250_000) -> str:
-        ruta = str(ruta)
-        ext = os.path.splitext(ruta)[1].lower()
+        # Implementación en doc_extract (funciones de módulo → reutilizable desde procesos hijo)
         try:
-            if ext in {'.txt','.py','.md','.csv','.log','.ini','.json','.xml','.yaml','.yml','.sql','.html','.htm'}:
-                with open(ruta, 'r', encoding='utf-8', errors='ignore') as f:
-                    return f.read(max_chars)
-            if ext == '.docx':
-                return self._extract_text_docx_zip(ruta)
-            if ext == '.pptx':
-                return self._extract_text_pptx_zip(ruta)
-            if ext in {'.xlsx','.xlsm','.xltx'}:
-                return self._extract_text_xlsx_zip(ruta)
-            if ext == '.pdf':
-                try:
-                    import fitz
-                    doc = fitz.open(ruta)
-                    texts = []
-                    for i, page in enumerate(doc):
-                        if i >= 8: break
-                        t = page.get_text()
-                        if t: texts.append(t)
-                    return "\n".join(texts)[:max_chars] if texts else ""
-                except Exception:
-                    try:
-                        import PyPDF2
-                        with open(ruta, 'rb') as f:
-                            reader = PyPDF2.PdfReader(f)
-                            texts = []
-                            for i, p in enumerate(reader.pages):
-                                if i >= 8: break
-                                try:
-                                    texts.append(p.extract_text() or "")
-                                except Exception:
-                                    pass
-                            return "\n".join(texts)[:max_chars]
-                    except Exception:
-                        return ""
-            if ext in {'.doc','.xls','.ppt'}:
-                return ""
+            from doc_extract import extract_text
+            return extract_text(ruta, max_chars=max_chars)
         except Exception as e:
             self._append_msg(f"Error extrayendo texto de {ruta}: {e}", "WARN")
         return ""
 
     def _extract_noun_frequencies(self, text: str, use_spacy: bool = True) -> dict:
-        freqs = collections.Counter()
-        if not text or len(text) < 10:
-            return freqs
-        if use_spacy:
-            try:
-                import spacy
-                nlp = None
-                try:
-                    nlp = spacy.load("es_core_news_sm")
-                except Exception:
-                    try:
-                        nlp = spacy.load("es_core_news_md")
-                    except Exception:
-                        nlp = None
-                if nlp is not None:
-                    doc = nlp(text[:200_000])
-                    for tok in doc:
-                        if tok.pos_ in ("NOUN","PROPN"):
-                            w = tok.lemma_.lower().strip()
-                            if w and w not in SPANISH_STOPWORDS and len(w) >= 3 and not w.endswith("mente"):
-                                freqs[w] += 1
-                    return dict(freqs)
-            except Exception:
-                pass
-        tokens = _simple_tokenize_es(text)
-        for t in tokens:
-            if _is_probable_noun_es(t):
-                freqs[t] += 1
-        return dict(freqs)
+        # spaCy se carga una sola vez por proceso (nlp_es.load_spacy); sin spaCy → heurística
+        from nlp_es import noun_frequencies
+        return noun_frequencies(text, use_spacy=use_spacy)
 
     def cmd_scraper(self):
         targets = []
@@ -3399,7 +3383,7 @@ class OrganizadorFrame(ttk.Frame):
             messagebox.showinfo(APP_NAME, "No hay ficheros seleccionados ni visibles para analizar.")
             return
         if len(targets) > 1:
-            self._append_msg(f"Scraper: {len(targets)} archivos detectados; procesando el primero ahora (versión inicial).", "INFO")
+            return self._scraper_batch(targets)
         ruta = targets[0]
         nombre = os.path.basename(ruta)
         ext = os.path.splitext(nombre)[1].lstrip('.').lower()
@@ -3417,6 +3401,187 @@ class OrganizadorFrame(ttk.Frame):
         self._task_close()
         self._open_keywords_dialog(ruta, nombre, ext, freqs)
 
+    def _scraper_batch(self, targets, min_freq: int = 2, top_n: int = 30):
+        """
+        Scraper por lotes: extrae el texto de todos los ficheros (pool de procesos, caché de texto),
+        saca sustantivos con spaCy cargado una vez (nlp.pipe) o la heurística en paralelo y deja las
+        sugerencias en la cola de revisión de MetaStore (sin diálogo modal por fichero).
+        """
+        targets = list(dict.fromkeys(targets))
+        self._task_open(f"Scraper por lotes ({len(targets)} archivos)…", total=2 * len(targets))
+
+        def _work():
+            t0 = time.perf_counter()
+            try:
+                from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+                from doc_extract import extract_text
+                from nlp_es import noun_frequencies_many
+                from meta_store import MetaStore
+
+                self.queue.put(("task_status", "Extrayendo texto…"))
+                workers = max(1, (os.cpu_count() or 2) - 1)
+                texts = []
+                try:
+                    pool = ProcessPoolExecutor(max_workers=workers)
+                except Exception:
+                    pool = ThreadPoolExecutor(max_workers=workers)
+                with pool as ex:
+                    for t in ex.map(extract_text, targets, chunksize=4):
+                        texts.append(t or "")
+                        self.queue.put(("task_inc", 1))
+                t_ext = time.perf_counter() - t0
+
+                self.queue.put(("task_status", "Determinando sustantivos…"))
+                freqs = noun_frequencies_many(texts, progress=lambda _n: self.queue.put(("task_inc", 1)))
+                items = []
+                for ruta, fr in zip(targets, freqs):
+                    fr = sorted(((k, v) for k, v in fr.items() if v >= min_freq), key=lambda kv: (-kv[1], kv[0]))
+                    if fr:
+                        items.append((ruta, dict(fr[:top_n])))
+                MetaStore(self._db_path()).queue_keyword_suggestions(items, source="scraper")
+                dt = time.perf_counter() - t0
+                self.queue.put(("msg", (f"Scraper: {len(items)}/{len(targets)} archivos con sugerencias en "
+                                        f"{dt:0.1f}s (extracción {t_ext:0.1f}s · "
+                                        f"{len(targets) / max(dt, 1e-6):0.1f} docs/s). Pendientes de revisión.", "OK")))
+                self.after(0, self._open_keywords_review)
+            except Exception as e:
+                self.queue.put(("msg", (f"Scraper por lotes: error {e}", "WARN")))
+            finally:
+                self.queue.put(("task_close", None))
+
+        threading.Thread(target=_work, daemon=True).start()
+
+    def _corpus_keywords_async(self, open_review: bool = False):
+        """
+        Keywords por TF-IDF sobre todos los chunks indexados (corpus_keywords): DF del corpus guardado
+        e incremental, sólo se recalculan los ficheros reindexados; las propuestas van a la misma cola
+        de revisión que el scraper. En segundo plano y nunca dos a la vez.
+        """
+        if getattr(self, "_kw_corpus_running", False):
+            if open_review:
+                self._append_msg("Keywords TF-IDF: ya hay un cálculo en curso.", "INFO")
+            return
+        self._kw_corpus_running = True
+
+        def _progress(kind, payload):
+            if kind == "status":
+                self.queue.put(("msg", (str(payload), "DEBUG")))
+
+        def _work():
+            try:
+                import corpus_keywords
+                st = corpus_keywords.run(self._db_path(), cancel_event=getattr(self, "cancel_event", None),
+                                         progress=_progress)
+                if st["docs"] or open_review:
+                    self.queue.put(("msg", (f"Keywords TF-IDF: {st['docs']} archivos recalculados, "
+                                            f"{st['queued']} sugerencias nuevas en {st['seconds']:0.1f}s.", "OK")))
+                if open_review:
+                    self.after(0, self._open_keywords_review)
+            except Exception as e:
+                self.queue.put(("msg", (f"Keywords TF-IDF: error {e}", "WARN")))
+            finally:
+                self._kw_corpus_running = False
+
+        threading.Thread(target=_work, daemon=True).start()
+
+    def _open_keywords_review(self):
+        """Cola de revisión (no modal) de keywords sugeridas por el scraper por lotes."""
+        from meta_store import MetaStore
+        store = MetaStore(self._db_path())
+        if getattr(self, "_kw_review_win", None) is not None:
+            try:
+                self._kw_review_win.destroy()
+            except Exception:
+                pass
+        pend = store.list_keyword_suggestions()
+        if not pend:
+            self._append_msg("No hay sugerencias de palabras clave pendientes.", "INFO")
+            return
+
+        win = tk.Toplevel(self)
+        self._kw_review_win = win
+        win.title(f"Revisión de palabras clave – {len(pend)} archivos")
+        win.minsize(860, 520)
+        frm = ttk.Frame(win, padding=8); frm.pack(fill="both", expand=True)
+        frm.columnconfigure(0, weight=1); frm.columnconfigure(1, weight=2); frm.rowconfigure(1, weight=1)
+
+        try:
+            from corpus_keywords import MIN_SCORE as _tfidf_min
+        except Exception:
+            _tfidf_min = 4.0
+        var_umbral = tk.IntVar(value=2)
+        var_tfidf = tk.DoubleVar(value=_tfidf_min)       # las del TF-IDF traen puntuación, no frecuencia
+        top = ttk.Frame(frm); top.grid(row=0, column=0, columnspan=2, sticky="we", pady=(0, 6))
+        ttk.Label(top, text="Marcar por defecto si freq ≥").pack(side="left")
+        ttk.Spinbox(top, from_=1, to=20, width=4, textvariable=var_umbral).pack(side="left", padx=(6, 0))
+        ttk.Label(top, text="o TF-IDF ≥").pack(side="left", padx=(12, 0))
+        ttk.Spinbox(top, from_=0.5, to=20, increment=0.5, width=5, textvariable=var_tfidf).pack(side="left", padx=(6, 0))
+        status = ttk.Label(top, text=""); status.pack(side="right")
+
+        lst = tk.Listbox(frm, exportselection=False)
+        lst.grid(row=1, column=0, sticky="nsew", padx=(0, 8))
+        box = ttk.Frame(frm); box.grid(row=1, column=1, sticky="nsew")
+        paths = sorted(pend)
+        for p in paths:
+            lst.insert("end", f"{os.path.basename(p)}  ({len(pend[p])})")
+        checks = {}
+
+        def _current():
+            sel = lst.curselection()
+            return paths[sel[0]] if sel else None
+
+        def _default_on(f, sc) -> bool:
+            return (f is not None and f >= var_umbral.get()) or (sc is not None and sc >= var_tfidf.get())
+
+        def _show(_e=None):
+            for w in list(box.children.values()):
+                w.destroy()
+            checks.clear()
+            p = _current()
+            if not p:
+                return
+            ttk.Label(box, text=p, wraplength=520).grid(row=0, column=0, columnspan=3, sticky="w", pady=(0, 4))
+            for i, (kw, f, sc) in enumerate(pend.get(p, [])):
+                v = tk.IntVar(value=1 if _default_on(f, sc) else 0)
+                checks[kw] = v
+                txt = f"{kw} ({f})" if f is not None else f"{kw} (tf-idf {sc or 0:0.1f})"
+                ttk.Checkbutton(box, text=txt, variable=v).grid(row=1 + i // 3, column=i % 3, sticky="w", padx=4)
+
+        def _resolve(paths_decided):
+            dec = []
+            for p in paths_decided:
+                if p == _current() and checks:
+                    acc = [k for k, v in checks.items() if v.get()]
+                else:
+                    acc = [k for k, f, sc in pend.get(p, []) if _default_on(f, sc)]
+                rej = [k for k, *_v in pend.get(p, []) if k not in acc]
+                dec.append((p, acc, rej))
+            n = store.resolve_keyword_suggestions(dec)
+            for p in paths_decided:
+                i = paths.index(p); paths.pop(i); lst.delete(i); pend.pop(p, None)
+            status.config(text=f"{n} palabras guardadas · quedan {len(paths)} archivos")
+            if paths:
+                lst.selection_clear(0, "end"); lst.selection_set(0); _show()
+            else:
+                _show()
+
+        def _reject_file():
+            p = _current()
+            if p:
+                store.resolve_keyword_suggestions([(p, [], [k for k, *_v in pend.get(p, [])])])
+                i = paths.index(p); paths.pop(i); lst.delete(i); pend.pop(p, None)
+                if paths:
+                    lst.selection_set(min(i, len(paths) - 1))
+                _show()
+
+        lst.bind("<<ListboxSelect>>", _show)
+        bot = ttk.Frame(frm); bot.grid(row=2, column=0, columnspan=2, sticky="we", pady=(8, 0))
+        ttk.Button(bot, text="Aceptar selección", command=lambda: _current() and _resolve([_current()])).pack(side="left")
+        ttk.Button(bot, text="Descartar archivo", command=_reject_file).pack(side="left", padx=(6, 0))
+        ttk.Button(bot, text="Aceptar todos (umbral)", command=lambda: _resolve(list(paths))).pack(side="left", padx=(6, 0))
+        ttk.Button(bot, text="Cerrar", command=win.destroy).pack(side="right")
+        lst.selection_set(0); _show()
+
     def _open_keywords_dialog(self, fullpath: str, nombre: str, ext: str, freqs: dict):
         import tkinter as tk
         from tkinter import ttk, messagebox
@@ -4132,6 +4297,11 @@ class HelpDialog(tk.Toplevel):
             c.execute("CREATE INDEX IF NOT EXISTS idx_chunks_path ON chunks(file_path)")
             c.execute("CREATE INDEX IF NOT EXISTS idx_chunks_mtime ON chunks(mtime)")
             conn.commit()
+            try:
+                from rag_retrieval import ensure_fts
+                ensure_fts(conn)  # índice BM25 (FTS5) sincronizado por triggers
+            except Exception:
+                pass
         except Exception as e:
             self._append_msg(f"SQLite (RAG) error: {e}", "WARN")
 
@@ -4172,6 +4342,7 @@ class HelpDialog(tk.Toplevel):
         # 1) Preferir Sentence-Transformers si está instalado
         try:
             from sentence_transformers import SentenceTransformer  # pip install sentence-transformers
+            from text_chunker import st_token_counter
             model_path = model_dir or model_id
             st_model = SentenceTransformer(model_path)
             dim = int(getattr(st_model, "get_sentence_embedding_dimension", lambda: 384)())
@@ -4180,8 +4351,16 @@ class HelpDialog(tk.Toplevel):
                 v = st_model.encode(text or "", normalize_embeddings=True)
                 return v.tolist() if hasattr(v, "tolist") else list(map(float, v))
 
+            def _encode_st_many(texts):
+                M = st_model.encode([t or "" for t in texts], normalize_embeddings=True,
+                                    batch_size=int(os.getenv("PACQUI_EMBED_BATCH", "64")),
+                                    show_progress_bar=False)
+                return [v.tolist() if hasattr(v, "tolist") else list(map(float, v)) for v in M]
+
             sig = f"st:{dim}:{model_path}"
-            self._embedder_cached = {"encode": _encode_st, "dim": dim, "backend": "st", "sig": sig}
+            self._embedder_cached = {"encode": _encode_st, "encode_many": _encode_st_many,
+                                     "dim": dim, "backend": "st", "sig": sig,
+                                     "count_tokens": st_token_counter(st_model)}
             return self._embedder_cached
         except Exception:
             pass
@@ -4190,36 +4369,29 @@ class HelpDialog(tk.Toplevel):
         def _encode_hash(text: str, _dim=256):
             return self._hash_embedder(text, dim=_dim)
 
+        def _encode_hash_many(texts, _dim=256):
+            from hash_embedder import encode_many
+            return encode_many(texts, dim=_dim, stopwords=SPANISH_STOPWORDS)
+
         sig = "hash:256"
-        self._embedder_cached = {"encode": _encode_hash, "dim": 256, "backend": "hash", "sig": sig}
+        self._embedder_cached = {"encode": _encode_hash, "encode_many": _encode_hash_many,
+                                 "dim": 256, "backend": "hash", "sig": sig}
         return self._embedder_cached
 
     # ============================================================================
 
     def _hash_embedder(self, text: str, dim: int = 256):
-        v = [0.0]*dim
         if not text:
-            return v
-        for tok in re.findall(r"[A-Za-zÁÉÍÓÚÜáéíóúüÑñ0-9]{2,}", text.lower()):
-            if tok in SPANISH_STOPWORDS:
-                continue
-            h = int(hashlib.md5(tok.encode('utf-8')).hexdigest(), 16)
-            i = h % dim
-            s = 1.0 if (h >> 1) & 1 else -1.0
-            v[i] += s
-        import math as _m
-        norm = _m.sqrt(sum(x*x for x in v)) or 1.0
-        return [x/norm for x in v]
+            return [0.0]*dim
+        from hash_embedder import hash_embed
+        return hash_embed(text, dim=dim, stopwords=SPANISH_STOPWORDS)
 
     def _text_chunks(self, txt: str, max_chars=1200, overlap=200):
-        txt = (txt or "").replace("\r\n","\n").replace("\r","\n")
-        parts = []
-        step = max(1, max_chars - overlap)
-        i = 0; N = len(txt)
-        while i < N:
-            parts.append(txt[i:i+max_chars])
-            i += step
-        return parts
+        # Troceado semántico (párrafos/títulos/frases, objetivo en tokens del embedder);
+        # PACQUI_CHUNKER=fixed vuelve al corte fijo por caracteres.
+        from text_chunker import chunk_text
+        return chunk_text(txt, max_chars=max_chars, overlap=overlap,
+                          embedder=getattr(self, "_embedder_cached", None))
 
     def _index_file_chunks(self, fullpath: str, mtime_ts: float):
         try:
@@ -4227,134 +4399,45 @@ class HelpDialog(tk.Toplevel):
             if conn is None:
                 conn = sqlite3.connect(self._db_path(), check_same_thread=False)
             self._db_rag_ensure(conn)
-            c = conn.cursor()
-            # --- comprobar firma de embeddings y purgar si cambia ---
-            embed = self._get_embedder()
-            current_sig = embed["sig"]
-            stored_sig = self._rag_meta_get(conn, "embedding_sig")
-            if stored_sig != current_sig:
-                # Limpiamos embeddings para reindexar con el nuevo backend/dim
-                c.execute("DELETE FROM embeddings")
-                self._rag_meta_set(conn, "embedding_sig", current_sig)
-                try:
-                    self.queue.put(('msg', (f'RAG: firma embeddings cambiada → {current_sig}. Reindexando…', 'INFO')))
-                except Exception:
-                    pass
+            from rag_indexer import index_files
+            from text_chunker import chunker_sig as _chunker_sig
 
-            try:
-                c.execute("DELETE FROM embeddings WHERE chunk_id IN (SELECT id FROM chunks WHERE file_path=?)", (fullpath,))
-                c.execute("DELETE FROM chunks WHERE file_path=?", (fullpath,))
-            except Exception:
-                pass
-            txt = self._extract_text_generic(fullpath)
-            if not txt:
-                return 0
-            count = 0
-            for ch in self._text_chunks(txt, max_chars=1200, overlap=200):
-                c.execute("INSERT INTO chunks(file_path, mtime, text) VALUES(?,?,?)", (fullpath, float(mtime_ts), ch))
-                cid = c.lastrowid
-                vec = self._get_embedder()["encode"](ch)
-                c.execute("INSERT OR REPLACE INTO embeddings(chunk_id, vec) VALUES(?,?)", (cid, self._vec_to_blob(vec)))
-
-                count += 1
-            conn.commit()
-            return count
+            def _progress(kind, payload):
+                if kind == "msg":
+                    try: self.queue.put(('msg', (str(payload), 'INFO')))
+                    except Exception: pass
+
+            st = index_files(conn, [(fullpath, mtime_ts)], extract=self._extract_text_generic,
+                             chunker=lambda t: self._text_chunks(t, max_chars=1200, overlap=200),
+                             chunker_sig=_chunker_sig(),
+                             embedder=self._get_embedder(), progress=_progress)
+            return int(st.get("chunks", 0))
         except Exception as e:
             self._append_msg(f"RAG index error en {os.path.basename(fullpath)}: {e}", "WARN")
             return 0
     # === Recuperación de contexto (RAG) ===
     def _retrieve_context(self, query: str, k: int = 6) -> str:
-        # Devuelve un bloque con los k fragmentos más relevantes en toda la base RAG.
-        import sqlite3, math, struct
+        # Devuelve un bloque con los k fragmentos más relevantes en toda la base RAG (motor rag_retrieval).
         try:
-            conn = self._rag__conn()
-            c = conn.cursor()
-            rows = c.execute(
-                'SELECT c.id, c.text, c.file_path, e.vec '
-                'FROM chunks c JOIN embeddings e ON e.chunk_id=c.id'
-            ).fetchall()
-            total = len(rows)
-            if not rows:
+            from rag_retrieval import RetrievalEngine, format_quoted
+            engine = RetrievalEngine(conn=self._rag__conn(), encode=self._get_embedder()["encode"],
+                                     candidates="hybrid", reranker="rrf")
+            top = engine.search(query or "", k=k)
+            if not top:
                 try: self._append_msg("RAG retrieve: 0 candidatos en DB.", "DEBUG")
                 except Exception: pass
                 return ""
-            vq = self._hash_embedder(query or "", dim=256)
-            def blob_to_vec(b: bytes):
-                n = len(b)//4
-                return list(struct.unpack('<'+'f'*n, b)) if n>0 else []
-            def dot(a,b): return sum((x*y for x,y in zip(a,b)))
-            def norm(a):
-                s = math.sqrt(sum((x*x for x in a))) or 1.0
-                return [x/s for x in a]
-            vq = norm(vq)
-            scored = []
-            for cid, txt, fp, blob in rows:
-                vv = norm(blob_to_vec(blob))
-                s = dot(vq, vv)
-                scored.append((s, txt, fp))
-            scored.sort(reverse=True, key=lambda t: t[0])
-            top = scored[:max(1,int(k))]
             try:
-                self._append_msg(f"RAG retrieve: {total} candidatos, top={len(top)}.", "DEBUG")
-                if top:
-                    self._append_msg(f"RAG top1: {top[0][2]}", "DEBUG")
+                self._append_msg(f"RAG retrieve: top={len(top)}.", "DEBUG")
+                self._append_msg(f"RAG top1: {top[0]['path']}", "DEBUG")
             except Exception:
                 pass
-            partes = []
-            for i, (_, frag, fp) in enumerate(top, start=1):
-                partes.append(f"[{i}] {fp}\n\"\"\"\n{frag}\n\"\"\"")
-            return "\n\n".join(partes)
+            return format_quoted(top, max_chars=0)
         except Exception as e:
             try: self._append_msg(f"RAG retrieve error: {e}", "WARN")
             except Exception: pass
             return ""
 
-            if conn is None:
-                conn = sqlite3.connect(self._db_path(), check_same_thread=False)
-            self._db_rag_ensure(conn)
-            c = conn.cursor()
-            base = getattr(self, 'base_path', None)
-            if base:
-                base_str = str(base).rstrip('/\\')
-                like_param = base_str + '%'
-                rows = c.execute(
-                    'SELECT c.id, c.text, c.file_path, e.vec FROM chunks c '
-                    'JOIN embeddings e ON e.chunk_id=c.id '
-                    'WHERE c.file_path LIKE ?',
-                    (like_param,)
-                ).fetchall()
-            else:
-                rows = c.execute(
-                    'SELECT c.id, c.text, c.file_path, e.vec FROM chunks c '
-                    'JOIN embeddings e ON e.chunk_id=c.id'
-                ).fetchall()
-            if not rows:
-                return ""
-            qv = _hash_embedder(query or '', dim=256)
-            # cosine sim
-            import math as _m
-            def _cos(a,b):
-                num = sum(x*y for x,y in zip(a,b))
-                na = _m.sqrt(sum(x*x for x in a)) or 1.0
-                nb = _m.sqrt(sum(y*y for y in b)) or 1.0
-                return num/(na*nb)
-            scored = []
-            for cid, txt, fp, blob in rows:
-                v = self._blob_to_vec(blob)
-                s = _cos(qv, v)
-                scored.append((s, cid, txt, fp))
-            scored.sort(reverse=True)
-            top = scored[:max(1, int(k))]
-            partes = []
-            for i, (_s, _cid, txt, fp) in enumerate(top, 1):
-                frag = (txt or '').strip()
-                if len(frag) > 1200: frag = frag[:1200] + '…'
-                partes.append(f'[{i}] {fp}\n"""\n{frag}\n"""')
-            return "\n\n".join(partes)
-        except Exception as e:
-            self._append_msg(f'RAG retrieve error: {e}', 'WARN')
-            return ""
-
 
 class LLMChatDialog(tk.Toplevel):
     """Chat con modelo GGUF local usando llama-cpp-python.
@@ -5232,98 +5315,126 @@ try:
             c.execute("CREATE INDEX IF NOT EXISTS idx_chunks_path ON chunks(file_path)")
             c.execute("CREATE INDEX IF NOT EXISTS idx_chunks_mtime ON chunks(mtime)")
             conn.commit()
+            try:
+                from rag_retrieval import ensure_fts
+                ensure_fts(conn)  # índice BM25 (FTS5) sincronizado por triggers
+            except Exception:
+                pass
         except Exception as e:
             try: self._append_msg(f"SQLite (RAG) error: {e}", "WARN")
             except Exception: pass
     def __RAG__vec_to_blob(self, v):
         import array; return array.array('f', [float(x) for x in v]).tobytes()
     def __RAG__hash_embedder(self, text, dim=256):
-        import hashlib, re
-        v = [0.0]*dim
-        if text:
-            for tok in re.findall(r"[A-Za-zÁÉÍÓÚÜáéíóúüÑñ0-9]{2,}", str(text).lower()):
-                h = int(hashlib.md5(tok.encode('utf-8')).hexdigest(), 16)
-                i = h % dim; s = 1.0 if (h >> 1) & 1 else -1.0; v[i] += s
-        n = (sum(x*x for x in v) ** 0.5) or 1.0; return [x/n for x in v]
+        from hash_embedder import hash_embed
+        return hash_embed(text, dim=dim)
+    def __RAG__get_embedder(self):
+        # UN embedder para indexar y para consultar (mismo criterio que LLMService/rag_indexer:
+        # PACQUI_FORCE_HASH=1 → hash:256; si no, Sentence-Transformers local)
+        emb = getattr(self, "_embedder_cached", None)
+        if not emb:
+            from rag_indexer import default_embedder
+            emb = self._embedder_cached = default_embedder()
+        return emb
     def __RAG__text_chunks(self, txt: str, max_chars=1200, overlap=200):
-        txt = (txt or '').replace('\r\n','\n').replace('\r','\n')
-        parts=[]; step=max(1, max_chars-overlap); i=0; N=len(txt)
-        while i<N: parts.append(txt[i:i+max_chars]); i+=step
-        return parts
+        from text_chunker import chunk_text
+        return chunk_text(txt, max_chars=max_chars, overlap=overlap,
+                          embedder=getattr(self, "_embedder_cached", None))
     def __RAG__extract_text_generic(self, path, max_chars=300_000):
-        import os, zipfile, re
+        import os
+        path = str(path); ext = os.path.splitext(path)[1].lower()
+        if ext in ('.txt','.md','.py','.csv','.log','.ini','.json','.xml','.yaml','.yml','.sql','.html','.htm'):
+            return __RAG__extract_text_raw(path, max_chars)
+        from doc_extract import cached_part
+        return cached_part(path, f"rag_patch:{max_chars}", lambda: __RAG__extract_text_raw(path, max_chars))
+    def __RAG__extract_text_raw(path, max_chars=300_000):
+        import os
         path = str(path); ext = os.path.splitext(path)[1].lower()
         if ext in ('.txt','.md','.py','.csv','.log','.ini','.json','.xml','.yaml','.yml','.sql','.html','.htm'):
             try:
                 with open(path,'r',encoding='utf-8',errors='ignore') as f: return f.read(max_chars)
             except Exception: return ''
+        # OOXML: extractores iterparse de doc_extract (párrafo/diapositiva/fila, parada en max_chars)
         if ext == '.docx':
-            try:
-                z = zipfile.ZipFile(path); t=[]
-                for n in z.namelist():
-                    if n.startswith('word/') and n.endswith('.xml'):
-                        s = z.read(n).decode('utf-8','ignore'); t.append(re.sub(r'<[^>]+>',' ',s))
-                return ' '.join(t)[:max_chars]
-            except Exception: return ''
-        if ext in ('.pptx','.ppsx','.pps','.pptm','.pps'):
-            try:
-                z = zipfile.ZipFile(path); t=[]
-                for n in z.namelist():
-                    if n.startswith('ppt/slides/') and n.endswith('.xml'):
-                        s = z.read(n).decode('utf-8','ignore'); t.append(re.sub(r'<[^>]+>',' ',s))
-                return ' '.join(t)[:max_chars]
-            except Exception: return ''
+            from doc_extract import docx_text
+            return docx_text(path, max_paras=None, max_chars=max_chars)
+        if ext in ('.pptx','.ppsx','.pps','.pptm'):
+            from doc_extract import pptx_text
+            return pptx_text(path, max_slides=None, max_chars=max_chars)
         if ext in ('.xlsx','.xlsm','.xltx'):
+            from doc_extract import xlsx_text
+            return xlsx_text(path, max_rows=None, max_cols=None, max_chars=max_chars, sheets=None)
+        if ext == '.pdf':
+            # extractor en streaming por páginas (presupuesto de caracteres/tiempo, subproceso matable);
+            # antes se recalculaba sum(len(x) for x in t) tras cada página → cuadrático
             try:
-                z = zipfile.ZipFile(path); t=[]
-                if 'xl/sharedStrings.xml' in z.namelist():
-                    s = z.read('xl/sharedStrings.xml').decode('utf-8','ignore'); t.append(re.sub(r'<[^>]+>',' ',s))
-                for n in z.namelist():
-                    if n.startswith('xl/worksheets/') and n.endswith('.xml'):
-                        s = z.read(n).decode('utf-8','ignore'); t.append(re.sub(r'<[^>]+>',' ',s))
-                return ' '.join(t)[:max_chars]
+                from doc_extract import pdf_text
+                return pdf_text(path, max_chars=max_chars)
             except Exception: return ''
-        if ext == '.pdf':
+        return ''
+    def __RAG__index_files(self, items, cancel_event=None, keywords: bool = True):
+        """
+        Indexa en RAG muchos (ruta, mtime) de una vez con el pipeline de rag_indexer
+        (extracción en procesos → embeddings por lotes → escritor único) y publica
+        el ritmo (chunks/s) y los tiempos por etapa en el progreso.
+        keywords=False deja el TF-IDF del corpus pendiente para _rag_index_done() (fin del escaneo).
+        """
+        from rag_indexer import index_files
+        from text_chunker import chunker_sig as _chunker_sig
+        from doc_extract import extract_text
+        embedder = self._get_embedder()
+
+        def _progress(kind, payload):
             try:
-                import fitz
-                doc = fitz.open(path); t=[]
-                for p in doc:
-                    t.append(p.get_text() or '')
-                    if sum(len(x) for x in t) > max_chars: break
-                return '\n'.join(t)[:max_chars]
+                if kind == "status":
+                    self.queue.put(("task_status", str(payload)))
+                elif kind == "msg":
+                    self.queue.put(('msg', (str(payload), 'INFO')))
             except Exception:
-                try:
-                    from PyPDF2 import PdfReader
-                    r = PdfReader(path); t=[]
-                    for p in r.pages:
-                        t.append(p.extract_text() or '')
-                        if sum(len(x) for x in t) > max_chars: break
-                    return '\n'.join(t)[:max_chars]
-                except Exception: return ''
-        return ''
-    def __RAG__index_file_chunks(self, fullpath: str, mtime_ts: float):
-        import sqlite3, os
+                pass
+
         try:
-            conn = self._rag__conn(); c = conn.cursor()
-            try:
-                c.execute("DELETE FROM embeddings WHERE chunk_id IN (SELECT id FROM chunks WHERE file_path=?)", (fullpath,))
-                c.execute("DELETE FROM chunks WHERE file_path=?", (fullpath,))
-            except Exception: pass
-            txt = self._extract_text_generic(fullpath)
-            if not txt: return 0
-            count=0
-            for ch in self._text_chunks(txt, max_chars=1200, overlap=200):
-                c.execute("INSERT INTO chunks(file_path, mtime, text) VALUES(?,?,?)", (fullpath, float(mtime_ts or 0.0), ch))
-                cid = c.lastrowid; vec = self._hash_embedder(ch, dim=256)
-                c.execute("INSERT OR REPLACE INTO embeddings(chunk_id, vec) VALUES(?,?)", (cid, self._vec_to_blob(vec))); count+=1
-            conn.commit()
-            try: self.queue.put(('msg', (f'RAG: indexado {count} chunks — {os.path.basename(fullpath)}','DEBUG')))
+            # extract_text es función de módulo → la extracción va a un pool de procesos
+            st = index_files(self._rag__conn(), list(items), extract=extract_text,
+                             chunker=lambda t: self._text_chunks(t, max_chars=1200, overlap=200),
+                             chunker_sig=_chunker_sig(),
+                             embedder=embedder, cancel_event=cancel_event or getattr(self, "cancel_event", None),
+                             progress=_progress)
+            try: self.queue.put(('msg', (f"RAG: {st['files']} ficheros, {st['chunks']} chunks "
+                                         f"({st['chunks_per_s']:0.1f} chunks/s)", 'DEBUG')))
             except Exception: pass
-            return count
+            if st.get('files'):
+                self._rag_tfidf_dirty = True
+            if keywords:
+                self._rag_index_done()
+            return st
         except Exception as _e:
-            try: self.queue.put(('msg', (f'RAG: fallo indexando {os.path.basename(fullpath)}: {_e}','WARN')))
+            try: self.queue.put(('msg', (f'RAG: fallo indexando lote: {_e}', 'WARN')))
             except Exception: pass
-            return 0
+            return {"files": 0, "chunks": 0, "seconds": 0.0, "chunks_per_s": 0.0, "embed_s": 0.0}
+
+    def __RAG__index_done(self):
+        """
+        Fin de un escaneo/lote: DF del corpus + propuestas TF-IDF de lo reindexado, una sola vez y en
+        segundo plano (PACQUI_TFIDF_AUTO=0 lo apaga). Sin nada reindexado desde la última vez, no hace nada.
+        """
+        import os
+        if not getattr(self, '_rag_tfidf_dirty', False) or os.getenv('PACQUI_TFIDF_AUTO', '1') == '0':
+            return
+        self._rag_tfidf_dirty = False
+        try:
+            kw = getattr(self, '_corpus_keywords_async', None)
+            if callable(kw): kw()
+        except Exception: pass
+
+    def __RAG__index_file_chunks(self, fullpath: str, mtime_ts: float):
+        import os
+        # fichero a fichero (escaneo): el TF-IDF del corpus espera a _rag_index_done()
+        st = self._index_files([(fullpath, mtime_ts)], keywords=False)
+        count = int(st.get("chunks", 0))
+        try: self.queue.put(('msg', (f'RAG: indexado {count} chunks — {os.path.basename(fullpath)}','DEBUG')))
+        except Exception: pass
+        return count
 
     def __RAG__rewrite_query_from_messages(self, messages, fallback_query: str = "") -> str:
         """
@@ -5369,7 +5480,6 @@ try:
         return q.strip()
 
     def __RAG__retrieve_context(self, query: str, k: int = 6, messages=None) -> str:
-        import sqlite3, math, struct
         try:
             # --- 1) rewrite de query si hay historial ---
             effective_query = query or ""
@@ -5386,57 +5496,21 @@ try:
             except Exception:
                 pass
 
-            # --- 2) recuperar candidatos ---
+            # --- 2) recuperar candidatos (bajo la carpeta base) + rerank por coseno ---
+            from rag_retrieval import RetrievalEngine, format_quoted, rag_meta_get
+            emb = self._get_embedder()
             conn = self._rag__conn()
-            c = conn.cursor()
-            base = getattr(self, 'base_path', None)
-            if base:
-                like_param = str(base).rstrip('/\\') + '%'
-                rows = c.execute(
-                    'SELECT c.id, c.text, c.file_path, e.vec '
-                    'FROM chunks c JOIN embeddings e ON e.chunk_id=c.id '
-                    'WHERE c.file_path LIKE ?',
-                    (like_param,)
-                ).fetchall()
-            else:
-                rows = c.execute(
-                    'SELECT c.id, c.text, c.file_path, e.vec '
-                    'FROM chunks c JOIN embeddings e ON e.chunk_id=c.id'
-                ).fetchall()
-
-            if not rows:
+            # vectores del índice y de la consulta deben venir del mismo embedder (si no, el coseno es basura)
+            idx_sig = rag_meta_get(conn, "embedding_sig")
+            if idx_sig and idx_sig != emb.get("sig"):
+                if getattr(self, "_rag_sig_warned", None) != idx_sig:
+                    self._rag_sig_warned = idx_sig
+                    self._append_msg(f"RAG: el índice se creó con {idx_sig} y la consulta usa {emb.get('sig')}; "
+                                     "reindexa (o ajusta PACQUI_FORCE_HASH/PACQUI_EMBED_DIR). Sin contexto RAG.", "WARN")
                 return ""
-
-            def blob_to_vec(b: bytes):
-                n = len(b)//4
-                return list(struct.unpack('<' + 'f'*n, b)) if n > 0 else []
-
-            def dot(a, b):
-                return sum((x*y for x, y in zip(a, b)))
-
-            def norm(a):
-                s = math.sqrt(sum((x*x for x in a))) or 1.0
-                return [x/s for x in a]
-
-            vq = norm(self._get_embedder()["encode"](effective_query or ""))
-
-            scored = []
-            for _cid, txt, fp, blob in rows:
-                vv = norm(blob_to_vec(blob))
-                s = dot(vq, vv)
-                frag = (txt or "").strip()
-                if len(frag) > 1200:
-                    frag = frag[:1200] + "…"
-                scored.append((s, frag, fp))
-
-            scored.sort(reverse=True, key=lambda t: t[0])
-            top = scored[:max(1, int(k))]
-
-            partes = []
-            for i, (_s, frag, fp) in enumerate(top, start=1):
-                partes.append(f"[{i}] {fp}\n\"\"\"\n{frag}\n\"\"\"")
-
-            return "\n\n".join(partes) if partes else ""
+            engine = RetrievalEngine(conn=conn, encode=emb["encode"], candidates="hybrid", reranker="rrf")
+            top = engine.search(effective_query or "", k=k, path_prefix=getattr(self, 'base_path', None))
+            return format_quoted(top, max_chars=1200) if top else ""
         except Exception as e:
             try:
                 self._append_msg(f"RAG retrieve error: {e}", "WARN")
@@ -5451,9 +5525,12 @@ try:
             '_db_rag_ensure': __RAG__db_rag_ensure,
             '_vec_to_blob': __RAG__vec_to_blob,
             '_hash_embedder': __RAG__hash_embedder,
+            '_get_embedder': __RAG__get_embedder,
             '_text_chunks': __RAG__text_chunks,
             '_extract_text_generic': __RAG__extract_text_generic,
             '_index_file_chunks': __RAG__index_file_chunks,
+            '_index_files': __RAG__index_files,
+            '_rag_index_done': __RAG__index_done,
             '_retrieve_context': __RAG__retrieve_context,
         }.items():
             try:
@@ -5487,6 +5564,14 @@ def main():
     app.pack(fill="both", expand=True)
     app._append_msg("Selecciona la carpeta base y escanea. Usa 'Exportar ▾' para Excel (visibles o todo).", "INFO")
     root.bind('<F1>', lambda e: app.cmd_ayuda())
+    try:
+        # spaCy en segundo plano: el primer scraper ya no paga la carga del modelo
+        import nlp_es
+        nlp_es.add_listener(lambda typ, **d: typ == "nlp_load" and app.queue.put(
+            ("msg", (f"NLP: {d.get('model')} listo en {d.get('seconds')}s", "DEBUG"))))
+        root.after(3000, nlp_es.warmup_async)
+    except Exception:
+        pass
     root.mainloop()
 
 
@@ -0,0 +1,150 @@
+
+# answer_cache.py — caché de respuestas del LLM por pregunta normalizada + huella de la recuperación
+from __future__ import annotations
+import os, re, time, sqlite3, hashlib, threading, unicodedata
+from typing import Iterable, List, Optional
+#PACqui 1.3.0
+# En Históricos (qa_log) se ven las mismas preguntas una y otra vez, y cada una cuesta recuperación
+# + generación en CPU (decenas de segundos). La respuesta sólo puede cambiar si cambia la pregunta,
+# lo recuperado o el modelo, así que la clave es:
+#     pregunta normalizada (minúsculas, sin tildes ni signos, espacios colapsados)
+#   + huella de la recuperación: hash de la evidencia ya empaquetada (SYSTEM y, de los turnos de
+#     usuario, sólo los bloques "=== FRAGMENTOS/ÍNDICE/CONCEPTOS" tal como entran al prompt, nunca la
+#     pregunta literal: si no, la normalización no serviría) + rutas y mtime de los documentos citados
+#   + modelo y parámetros de generación.
+# Si se reindexa, se edita una observación o cambia un documento, la huella cambia y la entrada
+# vieja simplemente deja de encontrarse (se purga por antigüedad). Tabla answer_cache en la BD del
+# índice; PACQUI_ANSWER_CACHE=0 la desactiva; PACQUI_ANSWER_CACHE_MAX limita el nº de entradas.
+
+ENABLED = os.getenv("PACQUI_ANSWER_CACHE", "1") == "1"
+MAX_ENTRIES = int(os.getenv("PACQUI_ANSWER_CACHE_MAX", "500"))
+
+_FUENTE = re.compile(r"^\s*Fuente:\s*(.+?)\s*$", re.M)
+_BLOCK = re.compile(r"^=== ", re.M)             # cabeceras de context_packer (FRAGMENTOS, ÍNDICE…)
+_PAGE = re.compile(r"\s+\(p\.\s*\d+\)$")
+
+
+def normalize_query(q: str) -> str:
+    s = unicodedata.normalize("NFKD", (q or "").lower())
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    s = re.sub(r"[^\w\s]", " ", s)
+    return re.sub(r"\s+", " ", s).strip()
+
+
+def source_paths(messages: List[dict], hits: Iterable[dict] = ()) -> List[str]:
+    """Rutas de los fragmentos ('Fuente: …') y de los hits del índice usados en el prompt."""
+    paths = set()
+    for m in messages or []:
+        for p in _FUENTE.findall(m.get("content") or ""):
+            paths.add(_PAGE.sub("", p).strip())          # cite(): 'ruta (p. 3)' → 'ruta'
+    for h in hits or []:
+        if isinstance(h, dict) and h.get("path"):
+            paths.add(str(h["path"]).strip())
+    return sorted(p for p in paths if p)
+
+
+def evidence(m: dict) -> str:
+    """Parte de un mensaje que depende de la recuperación: en los de usuario, desde el primer bloque '=== '."""
+    c = m.get("content") or ""
+    if (m.get("role") or "") != "user":
+        return c
+    hit = _BLOCK.search(c)
+    return c[hit.start():] if hit else ""
+
+
+def fingerprint(messages: List[dict], hits: Iterable[dict] = (), model: str = "", params: str = "") -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{model}\0{params}\0".encode("utf-8", "ignore"))
+    for m in messages or []:
+        h.update((m.get("role") or "").encode()); h.update(b"\0")
+        h.update(evidence(m).encode("utf-8", "ignore")); h.update(b"\0")
+    for p in source_paths(messages, hits):
+        try:
+            mt = int(os.path.getmtime(p))
+        except Exception:
+            mt = 0
+        h.update(f"{p}\0{mt}\0".encode("utf-8", "ignore"))
+    return h.hexdigest()
+
+
+class AnswerCache:
+    def __init__(self, db_path: str, max_entries: int = MAX_ENTRIES):
+        self.db_path = db_path
+        self.max_entries = max(10, int(max_entries))
+        self.hits = self.misses = self.bypassed = 0
+        self.entries = 0                 # nº de filas, contado una vez en _ensure y llevado en put/clear
+        self._lock = threading.Lock()
+        self._ensure()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, check_same_thread=False)
+
+    def _ensure(self):
+        try:
+            with self._connect() as con:
+                con.execute("""CREATE TABLE IF NOT EXISTS answer_cache(
+                                   key TEXT PRIMARY KEY, query_norm TEXT, fingerprint TEXT, answer TEXT,
+                                   model TEXT, created REAL, last_hit REAL, hits INTEGER DEFAULT 0)""")
+                con.execute("CREATE INDEX IF NOT EXISTS idx_answer_cache_last ON answer_cache(last_hit)")
+                self.entries = int(con.execute("SELECT COUNT(*) FROM answer_cache").fetchone()[0])
+        except Exception:
+            pass
+
+    @staticmethod
+    def key(query: str, fp: str) -> str:
+        return hashlib.blake2b(f"{normalize_query(query)}\0{fp}".encode("utf-8"), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        row = None
+        try:
+            with self._connect() as con:
+                row = con.execute("SELECT answer FROM answer_cache WHERE key=?", (key,)).fetchone()
+                if row:
+                    con.execute("UPDATE answer_cache SET hits=hits+1, last_hit=? WHERE key=?", (time.time(), key))
+        except Exception:
+            row = None
+        with self._lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return row[0] if row else None
+
+    def put(self, key: str, query: str, fp: str, answer: str, model: str = ""):
+        if not (answer or "").strip():
+            return
+        now = time.time()
+        try:
+            with self._connect() as con:
+                new = con.execute("SELECT 1 FROM answer_cache WHERE key=?", (key,)).fetchone() is None
+                con.execute("""INSERT OR REPLACE INTO answer_cache(key,query_norm,fingerprint,answer,model,created,last_hit,hits)
+                               VALUES(?,?,?,?,?,?,?,0)""", (key, normalize_query(query), fp, answer, model, now, now))
+                pruned = 0
+                if self.entries + new > self.max_entries:
+                    pruned = con.execute("""DELETE FROM answer_cache WHERE key NOT IN
+                                            (SELECT key FROM answer_cache ORDER BY last_hit DESC LIMIT ?)""",
+                                         (self.max_entries,)).rowcount
+            with self._lock:
+                self.entries = max(0, self.entries + new - max(0, pruned))
+        except Exception:
+            pass
+
+    def note_bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    def clear(self):
+        try:
+            with self._connect() as con:
+                con.execute("DELETE FROM answer_cache")
+            with self._lock:
+                self.entries = 0
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        """Sin tocar la BD (se llama en cada refresco del panel de logs)."""
+        with self._lock:
+            tot = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "bypassed": self.bypassed, "entries": self.entries,
+                    "hit_rate": round(self.hits / tot, 3) if tot else None}
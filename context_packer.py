@@ -0,0 +1,167 @@
+
+# context_packer.py — reparto del presupuesto de tokens del prompt en una sola pasada
+from __future__ import annotations
+import os, re
+from typing import Callable, List, Optional, Sequence
+#PACqui 1.3.0
+# _compose_system_budgeted reconstruía el texto USER y recontaba tokens hasta 10 veces, y en cada
+# vuelta podía volver a lanzar build_index_context (otra pasada por _index_hits) con menos top_k.
+# Aquí la recuperación se hace UNA vez con un conjunto de candidatos holgado; se mide el coste en
+# tokens de cada bloque (fragmentos, entradas del índice, conceptos, andamiaje fijo) y se decide en
+# una pasada qué entra:
+#   1) andamiaje fijo (SYSTEM + pregunta + instrucciones + cabeceras) y respuesta pedida;
+#   2) si no cabe lo mínimo (1 entrada de índice + 1 fragmento recortado), se reduce la respuesta
+#      hasta PACK_MIN_RESP;
+#   3) índice (hasta idx_max, respetando el hueco mínimo del primer fragmento), después fragmentos
+#      EN ORDEN: se para en el primero que no cabe, que se acorta conservando su línea 'Fuente:',
+#      para no romper la numeración [n] de las citas.
+# Devuelve el texto USER, la respuesta concedida y la decisión completa para diagnóstico.
+
+OVERHEAD = 1.15          # margen del chat-format sobre SYSTEM+USER (mismo que antes)
+OVERHEAD_FIXED = 10
+CTX_MARGIN = 64
+PACK_MIN_RESP = int(os.getenv("PACQUI_PACK_MIN_RESP", "96"))
+PACK_FRAG_TOKENS = int(os.getenv("PACQUI_PACK_FRAG_TOKENS", "320"))   # tope del bloque FRAGMENTOS
+MIN_FRAG_TOKENS = 48
+
+FRAG_HEADER = "=== FRAGMENTOS (cítalos como [1], [2], …) ==="
+IDX_HEADER = "=== ÍNDICE (observaciones/rutas del índice) ==="
+IDX_TITLE = "Documentos sugeridos (por palabras clave del índice):"
+CONCEPT_HEADER = "=== CONCEPTOS (semántica corta) ==="
+INSTRUCTIONS = [
+    "Instrucciones de uso:",
+    "- Responde a la PREGUNTA usando exclusivamente los FRAGMENTOS; el ÍNDICE es apoyo contextual.",
+    "- No pidas más datos ni hagas listas genéricas. Responde directamente.",
+    "- Cita con [n] cada punto que derives de un fragmento.",
+    "- Si no hay datos suficientes en los fragmentos para algún apartado, dilo."
+]
+
+_FRAG_SPLIT = re.compile(r"\n+(?=\[\d+\] )")
+
+
+def split_fragments(rag_ctx: str) -> List[str]:
+    """'[1] …\\n    Fuente: …\\n\\n[2] …' → ['[1] …', '[2] …'] (en orden de ranking)."""
+    t = (rag_ctx or "").strip()
+    return [f.strip() for f in _FRAG_SPLIT.split(t) if f.strip()] if t else []
+
+
+def index_entry(s: dict) -> str:
+    """Misma línea que LLMService.build_index_context para un hit del índice."""
+    return f"- {s['name']}  ·  {s['path']}\n  Palabras clave: {s['keywords']}\n  Observaciones: {s['note']}"
+
+
+def trim_fragment(frag: str, budget: int, count: Callable[[str], int]) -> str:
+    """Acorta el texto de un fragmento conservando su línea 'Fuente:' (la cita debe seguir valiendo)."""
+    body, sep, src = frag.rpartition("\n    Fuente:")
+    if not sep:
+        body, src = frag, ""
+    avail = budget - (count(sep + src) if sep else 0)
+    if avail < 16:
+        return ""
+    cut = body
+    for _ in range(3):
+        n = count(cut)
+        if n <= avail:
+            break
+        cut = body[:max(16, int(len(cut) * avail / n) - 2)].rstrip() + "…"
+    return cut + sep + src
+
+
+def build_user_text(user_text: str, frags: Sequence[str], idx_entries: Sequence[str], concept_block: str = "") -> str:
+    parts = [f"Pregunta del usuario:\n{user_text}"]
+    if frags:
+        parts += [FRAG_HEADER, "\n".join(frags)]
+    if idx_entries:
+        parts += [IDX_HEADER, IDX_TITLE + "\n" + "\n".join(idx_entries)]
+    if not frags and (concept_block or "").strip():
+        parts += [CONCEPT_HEADER, concept_block]
+    parts += INSTRUCTIONS
+    return "\n\n".join(parts).strip()
+
+
+def pack(user_text: str, sys_text: str, frags: Sequence[str], idx_hits: Sequence[dict], count: Callable[[str], int],
+         ctx: int, max_tokens: int, concept_block: str = "", frag_max: int = 3, idx_max: int = 2,
+         frag_tokens: int = PACK_FRAG_TOKENS, min_resp: int = PACK_MIN_RESP) -> dict:
+    """
+    Reparto en una pasada. Devuelve {'user', 'resp_budget', 'used', 'hits', 'decision'}.
+    `used` estima los tokens de entrada con el mismo margen que el bucle antiguo.
+    """
+    frags = list(frags)[:max(0, int(frag_max))]
+    hits = list(idx_hits)[:max(0, int(idx_max))]
+    entries = [index_entry(h) for h in hits]
+
+    # costes (cada bloque se cuenta una vez; LLMService.count_tokens memoiza)
+    sep = 2                                                     # "\n\n" entre partes ≈ 1–2 tokens
+    fixed = count(sys_text) + count(build_user_text(user_text, [], [], ""))
+    frag_cost = [count(f) + 1 for f in frags]
+    idx_cost = [count(e) + 1 for e in entries]
+    frag_hdr = count(FRAG_HEADER) + sep if frags else 0
+    idx_hdr = count(IDX_HEADER) + count(IDX_TITLE) + 2 * sep if entries else 0
+    concept_cost = count(concept_block) + count(CONCEPT_HEADER) + 2 * sep if (concept_block or "").strip() else 0
+
+    def room(resp: int) -> int:
+        """Tokens de contexto (sin el fijo) que caben con `resp` tokens de respuesta."""
+        return int((ctx - CTX_MARGIN - resp - OVERHEAD_FIXED) / OVERHEAD) - fixed
+
+    resp = int(max_tokens)
+    minimum = (idx_hdr + idx_cost[0] if entries else 0) + (frag_hdr + min(frag_cost[0], MIN_FRAG_TOKENS) if frags else 0)
+    if room(resp) < minimum:
+        # lo que falte se quita de la respuesta (hasta min_resp), como hacía el último paso del bucle
+        need = minimum - room(resp)
+        resp = max(min(min_resp, resp), resp - int(need * OVERHEAD) - 1)
+    budget = room(resp)
+
+    decision = {"ctx": ctx, "resp_requested": int(max_tokens), "resp_budget": resp, "fixed": fixed,
+                "budget": budget, "idx": [], "frags": [], "concepts": "off"}
+    left = budget
+
+    # índice (sin comerse el hueco mínimo reservado al primer fragmento)
+    frag_reserve = frag_hdr + min(frag_cost[0], MIN_FRAG_TOKENS) if frags else 0
+    kept_idx = []
+    if entries and left - frag_reserve >= idx_hdr + idx_cost[0]:
+        left -= idx_hdr
+        for i, (e, c) in enumerate(zip(entries, idx_cost)):
+            if c <= left - frag_reserve:
+                kept_idx.append(i); left -= c
+                decision["idx"].append((i + 1, c, "full"))
+            else:
+                decision["idx"].append((i + 1, c, "dropped"))
+                break
+    else:
+        decision["idx"] = [(i + 1, c, "dropped") for i, c in enumerate(idx_cost)]
+
+    # fragmentos (prefijo en orden; el primero que no cabe se recorta y se para)
+    kept_frags: List[str] = []
+    if frags:
+        left_f = min(left - frag_hdr, int(frag_tokens))
+        for i, (f, c) in enumerate(zip(frags, frag_cost)):
+            if c <= left_f:
+                kept_frags.append(f); left_f -= c
+                decision["frags"].append((i + 1, c, "full"))
+                continue
+            if left_f >= min(MIN_FRAG_TOKENS, c):
+                cut = trim_fragment(f, left_f - 1, count)
+                if cut.strip():
+                    kept_frags.append(cut)
+                    decision["frags"].append((i + 1, c, f"trimmed→{count(cut) + 1}"))
+                    left_f = 0
+                    continue
+            decision["frags"].append((i + 1, c, "dropped"))
+            left_f = -1
+        if kept_frags:
+            left -= frag_hdr + sum(count(f) + 1 for f in kept_frags)
+
+    # conceptos: sólo si no hay fragmentos y caben
+    concept = ""
+    if not kept_frags and concept_cost:
+        if concept_cost <= left:
+            concept = concept_block; left -= concept_cost
+            decision["concepts"] = f"full {concept_cost}"
+        else:
+            decision["concepts"] = f"dropped {concept_cost}"
+
+    user = build_user_text(user_text, kept_frags, [entries[i] for i in kept_idx], concept)
+    used = int(OVERHEAD * (count(sys_text) + count(user))) + OVERHEAD_FIXED
+    decision.update(left=left, used=used)
+    return {"user": user, "resp_budget": resp, "used": used, "hits": [hits[i] for i in kept_idx],
+            "decision": decision}
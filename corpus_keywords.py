@@ -0,0 +1,183 @@
+
+# corpus_keywords.py — keywords por TF-IDF sobre el almacén de chunks (trabajo por lotes incremental)
+from __future__ import annotations
+import os, math, time, zlib, sqlite3, collections
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+#PACqui 1.3.0
+# Las keywords salían de frecuencias de sustantivos por documento (umbral ≥2) o de la ruta, así que
+# dominaban los términos genéricos ("solicitud", "documento"...). Aquí:
+#   * kw_doc_terms guarda por fichero sus términos y frecuencias (blob zlib "term\ttf\n...") y el
+#     mtime de sus chunks; kw_df guarda la frecuencia documental de cada término en el corpus;
+#   * run() sólo procesa ficheros nuevos/reindexados (mtime distinto) o desaparecidos, ajustando
+#     kw_df con deltas → incremental;
+#   * con el DF ya actualizado, propone las K mejores por TF-IDF de los ficheros tocados y las deja
+#     en la cola de revisión de MetaStore (source="tfidf", puntuación en la columna score; la
+#     revisión las marca por defecto si score ≥ PACQUI_TFIDF_MIN_SCORE).
+
+TOP_K = int(os.getenv("PACQUI_TFIDF_TOPK", "12"))
+MIN_DF = int(os.getenv("PACQUI_TFIDF_MIN_DF", "2"))          # términos de un solo doc = ruido/erratas
+MAX_DF_RATIO = float(os.getenv("PACQUI_TFIDF_MAX_DF", "0.5"))  # en más de la mitad de docs = genérico
+# umbral por defecto de la revisión: con tf=1 exige idf ≥ 4 (término en ≲5 % de los docs)
+MIN_SCORE = float(os.getenv("PACQUI_TFIDF_MIN_SCORE", "4.0"))
+BATCH = 500
+
+
+def ensure_schema(conn):
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS kw_df(term TEXT PRIMARY KEY, df INTEGER NOT NULL DEFAULT 0)")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS kw_doc_terms(
+            file_path TEXT PRIMARY KEY,
+            mtime REAL,
+            n_terms INTEGER,
+            terms BLOB
+        )
+    """)
+    conn.commit()
+
+
+def doc_terms(text: str) -> Dict[str, int]:
+    from nlp_es import _simple_tokenize_es, _is_probable_noun_es
+    tf = collections.Counter(t for t in _simple_tokenize_es(text or "") if _is_probable_noun_es(t))
+    return dict(tf)
+
+
+def _pack(tf: Dict[str, int]) -> bytes:
+    return zlib.compress("\n".join(f"{t}\t{n}" for t, n in tf.items()).encode("utf-8"), 6)
+
+
+def _unpack(blob) -> Dict[str, int]:
+    if not blob:
+        return {}
+    out = {}
+    for line in zlib.decompress(blob).decode("utf-8").splitlines():
+        t, _, n = line.partition("\t")
+        if t:
+            out[t] = int(n or 1)
+    return out
+
+
+def _stale(conn) -> Tuple[List[Tuple[str, float]], List[str]]:
+    """(ficheros a (re)calcular con su mtime, ficheros que ya no están en chunks)."""
+    cur = conn.cursor()
+    todo = cur.execute("""
+        SELECT c.file_path, MAX(c.mtime) FROM chunks c
+        LEFT JOIN kw_doc_terms k ON k.file_path = c.file_path
+        GROUP BY c.file_path
+        HAVING MAX(k.mtime) IS NULL OR MAX(k.mtime) <> MAX(c.mtime)
+    """).fetchall()
+    gone = [r[0] for r in cur.execute(
+        "SELECT file_path FROM kw_doc_terms WHERE file_path NOT IN (SELECT DISTINCT file_path FROM chunks)")]
+    return [(r[0], float(r[1] or 0.0)) for r in todo], gone
+
+
+def update_df(conn, cancel_event=None, progress: Optional[Callable[[str, object], None]] = None) -> List[str]:
+    """Actualiza kw_doc_terms/kw_df para lo que ha cambiado. Devuelve las rutas (re)calculadas."""
+    ensure_schema(conn)
+    todo, gone = _stale(conn)
+    cur = conn.cursor()
+    delta = collections.Counter()
+    done: List[str] = []
+    if progress:
+        progress("total", len(todo) + len(gone))
+
+    for path in gone:
+        row = cur.execute("SELECT terms FROM kw_doc_terms WHERE file_path=?", (path,)).fetchone()
+        for t in _unpack(row[0] if row else None):
+            delta[t] -= 1
+    if gone:
+        cur.executemany("DELETE FROM kw_doc_terms WHERE file_path=?", [(p,) for p in gone])
+
+    for i in range(0, len(todo), BATCH):
+        if cancel_event is not None and cancel_event.is_set():
+            break
+        part = todo[i:i + BATCH]
+        rows = []
+        for path, mtime in part:
+            old = cur.execute("SELECT terms FROM kw_doc_terms WHERE file_path=?", (path,)).fetchone()
+            for t in _unpack(old[0] if old else None):
+                delta[t] -= 1
+            text = "\n".join(r[0] or "" for r in cur.execute(
+                "SELECT text FROM chunks WHERE file_path=? ORDER BY id", (path,)))
+            tf = doc_terms(text)
+            for t in tf:
+                delta[t] += 1
+            rows.append((path, mtime, len(tf), _pack(tf)))
+            done.append(path)
+        cur.executemany("INSERT OR REPLACE INTO kw_doc_terms(file_path, mtime, n_terms, terms) VALUES(?,?,?,?)", rows)
+        _flush_df(cur, delta)
+        delta.clear()
+        conn.commit()
+        if progress:
+            progress("inc", len(part))
+    _flush_df(cur, delta)
+    cur.execute("DELETE FROM kw_df WHERE df <= 0")
+    conn.commit()
+    return done
+
+
+def _flush_df(cur, delta: Dict[str, int]):
+    if not delta:
+        return
+    cur.executemany("""
+        INSERT INTO kw_df(term, df) VALUES(?, ?)
+        ON CONFLICT(term) DO UPDATE SET df = df + excluded.df
+    """, [(t, int(d)) for t, d in delta.items() if d])
+
+
+def tfidf_keywords(conn, paths: Iterable[str], top_k: int = TOP_K) -> Dict[str, Dict[str, float]]:
+    """{ruta: {término: puntuación}} con tf-idf sublineal: (1+log tf)·(1+log((N+1)/(df+1)))."""
+    cur = conn.cursor()
+    N = int(cur.execute("SELECT COUNT(*) FROM kw_doc_terms").fetchone()[0] or 0)
+    if N == 0:
+        return {}
+    max_df = max(MIN_DF, int(N * MAX_DF_RATIO)) if N >= 10 else N
+    out: Dict[str, Dict[str, float]] = {}
+    paths = list(paths)
+    for i in range(0, len(paths), BATCH):
+        part = paths[i:i + BATCH]
+        docs = {p: _unpack(b) for p, b in cur.execute(
+            "SELECT file_path, terms FROM kw_doc_terms WHERE file_path IN (%s)" % ",".join("?" * len(part)), part)}
+        vocab = sorted({t for tf in docs.values() for t in tf})
+        df = {}
+        for j in range(0, len(vocab), 900):
+            sub = vocab[j:j + 900]
+            df.update(cur.execute("SELECT term, df FROM kw_df WHERE term IN (%s)" % ",".join("?" * len(sub)), sub))
+        idf = {t: math.log((N + 1) / (d + 1)) + 1.0 for t, d in df.items()
+               if (d >= MIN_DF or N < 10) and d <= max_df}
+        for p, tf in docs.items():
+            scored = [((1.0 + math.log(n)) * idf[t], t) for t, n in tf.items() if t in idf]
+            scored.sort(reverse=True)
+            out[p] = {t: round(s, 3) for s, t in scored[:top_k]}
+    return out
+
+
+def run(db_path: str, meta_db_path: Optional[str] = None, cancel_event=None,
+        progress: Optional[Callable[[str, object], None]] = None, top_k: int = TOP_K) -> dict:
+    """
+    Trabajo completo (pensado para un hilo en segundo plano): DF incremental + propuestas TF-IDF
+    de los ficheros tocados a la cola de revisión de MetaStore. Devuelve estadísticas.
+    """
+    t0 = time.perf_counter()
+    conn = sqlite3.connect(db_path, timeout=30.0)
+    try:
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+        except Exception:
+            pass
+        changed = update_df(conn, cancel_event=cancel_event, progress=progress)
+        kws = tfidf_keywords(conn, changed, top_k=top_k) if changed else {}
+    finally:
+        conn.close()
+    queued = 0
+    if kws:
+        from meta_store import MetaStore
+        # la puntuación va a su propia columna (score); freq queda para los recuentos del scraper
+        items = [(p, d) for p, d in kws.items() if d]
+        queued = MetaStore(meta_db_path or db_path).queue_keyword_suggestions(items, source="tfidf")
+    dt = time.perf_counter() - t0
+    st = {"docs": len(changed), "suggested": len(kws), "queued": queued, "seconds": dt,
+          "docs_per_s": len(changed) / max(dt, 1e-6)}
+    if progress:
+        progress("status", f"TF-IDF: {len(changed)} docs en {dt:0.1f}s ({st['docs_per_s']:0.0f} docs/s)")
+    return st
@@ -0,0 +1,419 @@
+
+# doc_extract.py — extracción de texto de documentos (funciones de módulo, aptas para ProcessPool)
+from __future__ import annotations
+import os, re, zipfile
+import xml.etree.ElementTree as ET
+#PACqui 1.3.0
+# Mismo comportamiento que OrganizadorFrame._extract_text_generic y sus helpers *_zip, pero
+# sin depender de la instancia Tk: así se pueden lanzar en procesos hijo (pickle por nombre).
+
+TEXT_EXTS = {'.txt', '.py', '.md', '.csv', '.log', '.ini', '.json', '.xml', '.yaml', '.yml', '.sql', '.html', '.htm'}
+XLSX_EXTS = {'.xlsx', '.xlsm', '.xltx'}
+PPTX_EXTS = {'.pptx', '.pptm', '.ppsx'}
+# Subir al cambiar cualquier extractor: invalida la caché de texto (text_cache)
+EXTRACTOR_VERSION = "4"
+
+_NS_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_NS_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+
+
+# ----------------------------------------------------------------------------- OOXML
+# Extractores en streaming con ElementTree.iterparse: el XML se lee del zip por trozos, se emite
+# texto por párrafo / diapositiva / fila según se cierra cada elemento (se vacía y se quita de su
+# padre, así el árbol no crece con el documento) y se para en cuanto se alcanza max_chars. Antes se leía la parte entera en memoria y se
+# quitaban las etiquetas con re.sub(r'<[^>]+>', ...), perdiendo párrafos y celdas.
+
+def _local(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+def _iterparse(z, name, release=()):
+    """
+    (tag local, elemento, tag local del padre) al cerrarse cada elemento. Los de `release`
+    (párrafo, fila…) se vacían y se quitan de su padre después de procesarlos.
+    """
+    with z.open(name) as f:
+        stack = []
+        for ev, el in ET.iterparse(f, events=("start", "end")):
+            if ev == "start":
+                stack.append(el)
+                continue
+            stack.pop()
+            tag = _local(el.tag)
+            yield tag, el, (_local(stack[-1].tag) if stack else "")
+            if tag in release:
+                el.clear()
+                if stack:
+                    try:
+                        stack[-1].remove(el)
+                    except ValueError:
+                        pass
+
+
+def iter_docx_paragraphs(ruta):
+    """Párrafos (w:p) de word/document.xml, con tabuladores y saltos de línea."""
+    with zipfile.ZipFile(ruta) as z:
+        buf = []
+        for tag, el, parent in _iterparse(z, "word/document.xml", release=("p", "tbl")):
+            if tag == "t":
+                buf.append(el.text or "")
+            elif tag == "tab" and parent == "r":      # w:pPr/w:tabs/w:tab es una tabulación definida, no texto
+                buf.append("\t")
+            elif tag in ("br", "cr") and parent == "r":
+                buf.append("\n")
+            elif tag == "p":
+                yield "".join(buf)
+                buf = []
+
+
+def _slide_names(z):
+    rx = re.compile(r"ppt/slides/slide(\d+)\.xml$")
+    names = [(int(m.group(1)), n) for n in z.namelist() for m in [rx.match(n)] if m]
+    return [n for _i, n in sorted(names)]
+
+
+def iter_pptx_slides(ruta):
+    """(nº diapositiva, texto) con un párrafo (a:p) por línea."""
+    with zipfile.ZipFile(ruta) as z:
+        for i, name in enumerate(_slide_names(z), start=1):
+            paras, buf = [], []
+            for tag, el, _parent in _iterparse(z, name, release=("p",)):
+                if tag == "t":
+                    buf.append(el.text or "")
+                elif tag == "p":
+                    if buf:
+                        paras.append("".join(buf))
+                    buf = []
+            yield i, "\n".join(p for p in paras if p.strip())
+
+
+def _xlsx_shared_strings(z):
+    sst = []
+    try:
+        buf = []
+        for tag, el, _parent in _iterparse(z, "xl/sharedStrings.xml", release=("si",)):
+            if tag == "t":
+                buf.append(el.text or "")
+            elif tag == "rPh":          # guía fonética: no es texto de la celda
+                buf = buf[:-1] if buf else buf
+            elif tag == "si":
+                sst.append("".join(buf)); buf = []    # runs enriquecidos → una sola cadena
+    except KeyError:
+        pass
+    return sst
+
+
+def _xlsx_sheets(z):
+    """Partes de hoja en el orden del libro (workbook.xml + rels)."""
+    try:
+        wb = ET.fromstring(z.read("xl/workbook.xml"))
+        rels = ET.fromstring(z.read("xl/_rels/workbook.xml.rels"))
+        targets = {r.attrib.get("Id"): r.attrib.get("Target", "") for r in rels}
+        out = []
+        for sh in wb.iter(f"{_NS_MAIN}sheet"):
+            t = targets.get(sh.attrib.get(f"{_NS_REL}id"), "")
+            if t:
+                t = t.lstrip("/")
+                out.append(t if t.startswith("xl/") else "xl/" + t)
+        if out:
+            return out
+    except Exception:
+        pass
+    return sorted(n for n in z.namelist() if n.startswith("xl/worksheets/") and n.endswith(".xml"))
+
+
+def iter_xlsx_rows(ruta, max_cols=None, sheets=None):
+    """Filas (lista de valores str) de las hojas del libro, resolviendo sharedStrings e inlineStr."""
+    with zipfile.ZipFile(ruta) as z:
+        sst = _xlsx_shared_strings(z)
+        names = _xlsx_sheets(z)
+        if sheets:
+            names = names[:sheets]
+        for name in names:
+            row, val, inl = [], None, []
+            for tag, el, _parent in _iterparse(z, name, release=("row",)):
+                if tag == "v":
+                    val = el.text
+                elif tag == "t":
+                    inl.append(el.text or "")
+                elif tag == "c":
+                    t_attr = el.attrib.get("t")
+                    if t_attr == "s" and val is not None:
+                        try:
+                            idx = int(val); val = sst[idx] if 0 <= idx < len(sst) else ""
+                        except Exception:
+                            pass
+                    elif t_attr == "inlineStr":
+                        val = "".join(inl)
+                    if max_cols is None or len(row) < max_cols:
+                        row.append("" if val is None else str(val))
+                    val, inl = None, []
+                    el.clear()
+                elif tag == "row":
+                    if row:
+                        yield row
+                    row = []
+
+
+def _take(parts, max_chars, sep="\n") -> str:
+    """Concatena trozos hasta max_chars (parada temprana del generador)."""
+    out, total = [], 0
+    for p in parts:
+        out.append(p); total += len(p) + len(sep)
+        if max_chars and total >= max_chars:
+            break
+    txt = sep.join(out)
+    return txt[:max_chars] if max_chars else txt
+
+
+def docx_text(ruta, max_paras=60, max_chars=None, raise_errors=False) -> str:
+    try:
+        paras = (p.strip() for p in iter_docx_paragraphs(ruta))
+        paras = (p for p in paras if p)
+        if max_paras:
+            import itertools
+            paras = itertools.islice(paras, max_paras)
+        return _take(paras, max_chars)
+    except Exception:
+        if raise_errors:
+            raise
+        return ""
+
+
+def xlsx_text(ruta, max_rows=20, max_cols=8, max_chars=None, sheets=1, raise_errors=False) -> str:
+    try:
+        rows = ("\t".join(r) for r in iter_xlsx_rows(ruta, max_cols=max_cols, sheets=sheets))
+        if max_rows:
+            import itertools
+            rows = itertools.islice(rows, max_rows)
+        return _take(rows, max_chars)
+    except Exception:
+        if raise_errors:
+            raise
+        return ""
+
+
+def pptx_text(ruta, max_slides=6, max_chars=None, raise_errors=False) -> str:
+    try:
+        slides = (f"[{i}] {t}" for i, t in iter_pptx_slides(ruta) if not max_slides or i <= max_slides)
+        if max_slides:
+            import itertools
+            slides = itertools.islice(slides, max_slides)
+        return _take(slides, max_chars, sep="\n\n")
+    except Exception:
+        if raise_errors:
+            raise
+        return ""
+
+
+def _regex_ooxml_text(ruta, max_chars=300_000) -> str:
+    """Versión antigua (parte XML entera + re.sub de etiquetas); sólo para el benchmark."""
+    ext = os.path.splitext(str(ruta))[1].lower()
+    pref = {'.docx': ('word/',), '.pptx': ('ppt/slides/',)}.get(ext, ('xl/sharedStrings.xml', 'xl/worksheets/'))
+    z = zipfile.ZipFile(ruta); t = []
+    for n in z.namelist():
+        if n.startswith(pref) and n.endswith('.xml'):
+            s = z.read(n).decode('utf-8', 'ignore'); t.append(re.sub(r'<[^>]+>', ' ', s))
+    return ' '.join(t)[:max_chars]
+
+
+# ----------------------------------------------------------------------------- PDF
+# Las páginas se devuelven separadas por "\f" (convención de pdftotext): así el texto sigue siendo
+# un str (cacheable, picklable) y el troceado RAG puede recuperar el nº de página de cada chunk.
+PAGE_SEP = "\f"
+PDF_TIMEOUT = float(os.getenv("PACQUI_PDF_TIMEOUT", "20"))       # s por fichero
+PDF_MAX_PAGES = int(os.getenv("PACQUI_PDF_MAX_PAGES", "0"))      # 0 = sin límite (manda max_chars)
+PDF_ISOLATE = os.getenv("PACQUI_PDF_ISOLATE", "1") != "0"        # extraer en subproceso matable
+
+
+def iter_pdf_pages(ruta, max_chars=250_000, max_pages=None, time_budget=None):
+    """
+    Generador (nº página 1-based, texto) con PyMuPDF o, si falta, PyPDF2.
+    Para al alcanzar max_chars, max_pages o time_budget segundos (presupuesto por fichero).
+    """
+    import time
+    max_pages = PDF_MAX_PAGES if max_pages is None else max_pages
+    deadline = (time.monotonic() + time_budget) if time_budget else None
+    total = 0
+
+    def _pages():
+        try:
+            import fitz
+            doc = fitz.open(ruta)
+        except Exception:
+            doc = None
+        if doc is not None:
+            try:
+                for i, page in enumerate(doc, start=1):
+                    yield i, (page.get_text() or "")
+            finally:
+                doc.close()
+            return
+        import PyPDF2
+        with open(ruta, 'rb') as f:
+            reader = PyPDF2.PdfReader(f)
+            for i, p in enumerate(reader.pages, start=1):
+                try:
+                    yield i, (p.extract_text() or "")
+                except Exception:
+                    yield i, ""
+
+    try:
+        for i, t in _pages():
+            if max_pages and i > max_pages:
+                break
+            t = t.replace(PAGE_SEP, "\n")
+            if total + len(t) > max_chars:
+                t = t[:max(0, max_chars - total)]
+            total += len(t)
+            yield i, t
+            if total >= max_chars or (deadline and time.monotonic() > deadline):
+                break
+    except Exception:
+        return
+
+
+def _pdf_child(ruta, max_chars, max_pages, conn):
+    try:
+        for i, t in iter_pdf_pages(ruta, max_chars=max_chars, max_pages=max_pages):
+            conn.send((i, t))
+    except Exception:
+        pass
+    finally:
+        try:
+            conn.send(None); conn.close()
+        except Exception:
+            pass
+
+
+def pdf_pages_isolated(ruta, max_chars=250_000, max_pages=None, timeout=PDF_TIMEOUT):
+    """
+    Igual que iter_pdf_pages pero en un subproceso: las páginas llegan por una tubería según se
+    extraen y, si se agota `timeout`, el proceso se mata y se devuelven las páginas recibidas.
+    Nunca "fork": el proceso Tk tiene hilos (y sus locks) que el hijo heredaría a medias;
+    forkserver donde exista (POSIX) y spawn en el resto (Windows).
+    """
+    import time, multiprocessing as mp
+    try:
+        ctx = mp.get_context("forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn")
+        rx, tx = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_pdf_child, args=(str(ruta), max_chars, max_pages, tx), daemon=True)
+        proc.start()
+        tx.close()
+    except Exception:
+        return list(iter_pdf_pages(ruta, max_chars=max_chars, max_pages=max_pages, time_budget=timeout))
+    pages = []
+    deadline = time.monotonic() + float(timeout or PDF_TIMEOUT)
+    try:
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0 or not rx.poll(left):
+                break                       # fichero patológico: nos quedamos con lo que haya
+            try:
+                item = rx.recv()
+            except EOFError:
+                break
+            if item is None:
+                break
+            pages.append(item)
+    finally:
+        try: rx.close()
+        except Exception: pass
+        if proc.is_alive():
+            proc.kill()
+        proc.join(timeout=1.0)
+    return pages
+
+
+def pdf_text(ruta, max_chars=250_000, max_pages=None, timeout=PDF_TIMEOUT) -> str:
+    """Texto del PDF con las páginas separadas por PAGE_SEP; presupuesto de caracteres y tiempo."""
+    if PDF_ISOLATE:
+        pages = pdf_pages_isolated(ruta, max_chars=max_chars, max_pages=max_pages, timeout=timeout)
+    else:
+        pages = list(iter_pdf_pages(ruta, max_chars=max_chars, max_pages=max_pages, time_budget=timeout))
+    return PAGE_SEP.join(t for _i, t in pages)
+
+
+def split_pages(text: str, ruta=None):
+    """
+    (nº página, texto). Sólo se trocea por PAGE_SEP el texto de un PDF (pdf_text ya cambia los "\f"
+    internos por "\n"), así que un PDF de una página es [(1, texto)]; cualquier otro fichero
+    (un .txt con saltos de página incluido) es [(None, texto)].
+    """
+    if not str(ruta or "").lower().endswith(".pdf"):
+        return [(None, text or "")]
+    return [(i, t) for i, t in enumerate((text or "").split(PAGE_SEP), start=1)]
+
+
+def _extract_text_raw(ruta: str, ext: str, max_chars: int) -> str:
+    if ext in TEXT_EXTS:
+        with open(ruta, 'r', encoding='utf-8', errors='ignore') as f:
+            return f.read(max_chars)
+    # para RAG/keywords sin tope de párrafos/diapositivas/filas: manda max_chars (parada temprana)
+    if ext == '.docx':
+        return docx_text(ruta, max_paras=None, max_chars=max_chars)
+    if ext in PPTX_EXTS:
+        return pptx_text(ruta, max_slides=None, max_chars=max_chars)
+    if ext in XLSX_EXTS:
+        return xlsx_text(ruta, max_rows=None, max_cols=None, max_chars=max_chars, sheets=None)
+    if ext == '.pdf':
+        return pdf_text(ruta, max_chars=max_chars)
+    return ""
+
+
+def extract_text(ruta, max_chars: int = 250_000, use_cache: bool = True) -> str:
+    """Texto plano de un documento (txt/OOXML/PDF). Nunca lanza: "" si no se puede."""
+    ruta = str(ruta)
+    ext = os.path.splitext(ruta)[1].lower()
+    try:
+        if use_cache and ext not in TEXT_EXTS:   # los de texto plano ya se leen directamente
+            from text_cache import cached_text
+            return cached_text(ruta, f"generic:v{EXTRACTOR_VERSION}:{max_chars}",
+                               lambda: _extract_text_raw(ruta, ext, max_chars))
+        return _extract_text_raw(ruta, ext, max_chars)
+    except Exception:
+        pass
+    return ""
+
+
+def cached_part(ruta, kind: str, fn, raise_errors: bool = False) -> str:
+    """Extractor parcial (vista previa, parches) pasando por la caché de texto."""
+    try:
+        from text_cache import cached_text
+    except Exception:
+        cached_text = None
+    try:
+        if cached_text is None:
+            return fn() or ""
+        return cached_text(str(ruta), f"{kind}:v{EXTRACTOR_VERSION}", fn)
+    except Exception:
+        if raise_errors:
+            raise           # la vista previa enseña el motivo ("DOCX sin texto.\n<error>")
+        return ""
+
+
+def bench(paths, repeat: int = 3, max_chars: int = 300_000) -> list:
+    """Compara los extractores iterparse con la versión regex: [(ruta, s_regex, s_iter, chars_regex, chars_iter)]."""
+    import time
+    out = []
+    for p in paths:
+        ext = os.path.splitext(str(p))[1].lower()
+        if ext not in ({'.docx'} | PPTX_EXTS | XLSX_EXTS):
+            continue
+        res = []
+        for fn in (lambda: _regex_ooxml_text(p, max_chars),
+                   lambda: _extract_text_raw(str(p), ext, max_chars)):
+            best, txt = float("inf"), ""
+            for _ in range(max(1, repeat)):
+                t = time.perf_counter(); txt = fn(); best = min(best, time.perf_counter() - t)
+            res.append((best, len(txt)))
+        out.append((str(p), res[0][0], res[1][0], res[0][1], res[1][1]))
+    return out
+
+
+if __name__ == "__main__":
+    # python doc_extract.py fichero.docx hoja.xlsx ...  → benchmark regex vs iterparse
+    import sys
+    for ruta, t_re, t_it, n_re, n_it in bench(sys.argv[1:]):
+        print(f"{os.path.basename(ruta)}: regex {t_re*1000:0.1f} ms ({n_re} car.) · "
+              f"iterparse {t_it*1000:0.1f} ms ({n_it} car.) · x{t_re / max(t_it, 1e-9):0.1f}")
@@ -0,0 +1,82 @@
+
+# hash_embedder.py — embedder "hash:256" rápido (mismos vectores que el original)
+from __future__ import annotations
+import os, re, hashlib
+from functools import lru_cache
+from typing import Iterable, List, Optional
+#PACqui 1.3.0
+# El original hacía, por cada token de cada chunk:
+#     h = int(hashlib.md5(tok).hexdigest(), 16); i = h % dim; s = +1/-1 según el bit 1 de h
+# y acumulaba en una lista Python de `dim` floats. Aquí:
+#   * token -> (bucket, signo) se memoriza en una LRU acotada (PACQUI_HASH_LRU): en un corpus real
+#     el vocabulario se repite muchísimo, así que cada token distinto se hashea una sola vez.
+#   * el hash sigue siendo MD5 (cambiarlo movería los buckets y rompería los índices hash:256 ya
+#     guardados), pero sin pasar por hexdigest → int: para dim potencia de 2 (hasta 65536) bastan
+#     los dos últimos bytes.
+#   * encode_many() acumula todo el lote con numpy.bincount si NumPy está instalado.
+# Los vectores resultantes son idénticos bit a bit a los de _hash_embedder original.
+
+TOKEN_RE = re.compile(r"[A-Za-zÁÉÍÓÚÜáéíóúüÑñ0-9]{2,}")
+HASH_LRU_SIZE = int(os.getenv("PACQUI_HASH_LRU", "200000"))
+
+
+@lru_cache(maxsize=HASH_LRU_SIZE)
+def _bucket_sign(tok: str, dim: int):
+    d = hashlib.md5(tok.encode("utf-8")).digest()
+    if 0 < dim <= 65536 and dim & (dim - 1) == 0:
+        low = int.from_bytes(d[-2:], "big")   # h % 2^k (k ≤ 16) y el bit 1 salen de los 2 últimos bytes
+        return low & (dim - 1), (1.0 if (low >> 1) & 1 else -1.0)
+    h = int.from_bytes(d, "big")
+    return h % dim, (1.0 if (h >> 1) & 1 else -1.0)
+
+
+def _tokens(text, stopwords: Optional[set] = None) -> List[str]:
+    if not text:
+        return []
+    toks = TOKEN_RE.findall(str(text).lower())
+    if stopwords:
+        toks = [t for t in toks if t not in stopwords]
+    return toks
+
+
+def hash_embed(text, dim: int = 256, stopwords: Optional[set] = None) -> List[float]:
+    """Embedding hash L2-normalizado de un texto (idéntico al _hash_embedder histórico)."""
+    v = [0.0] * dim
+    bs = _bucket_sign
+    for tok in _tokens(text, stopwords):
+        i, s = bs(tok, dim)
+        v[i] += s
+    n = (sum(x * x for x in v) ** 0.5) or 1.0
+    return [x / n for x in v]
+
+
+def encode_many(texts: Iterable, dim: int = 256, stopwords: Optional[set] = None) -> List[List[float]]:
+    """Versión por lotes: una sola pasada de bincount para todo el lote (NumPy) o bucle Python."""
+    texts = list(texts)
+    if not texts:
+        return []
+    try:
+        import numpy as np
+    except Exception:
+        return [hash_embed(t, dim=dim, stopwords=stopwords) for t in texts]
+
+    idx, sgn = [], []
+    bs = _bucket_sign
+    for row, t in enumerate(texts):
+        base = row * dim
+        for tok in _tokens(t, stopwords):
+            i, s = bs(tok, dim)
+            idx.append(base + i); sgn.append(s)
+    M = np.bincount(np.asarray(idx, dtype=np.int64), weights=np.asarray(sgn, dtype=np.float64),
+                    minlength=len(texts) * dim).reshape(len(texts), dim)
+    out = []
+    for r in M:
+        # mismas operaciones que el original: suma de cuadrados (exacta, son enteros) ** 0.5
+        n = (float((r * r).sum()) ** 0.5) or 1.0
+        out.append((r / n).tolist())
+    return out
+
+
+def cache_info():
+    """Estadísticas de la LRU token→(bucket, signo): hits, misses, maxsize, currsize."""
+    return _bucket_sign.cache_info()
@@ -0,0 +1,272 @@
+
+# llm_scheduler.py — planificador de peticiones al modelo llama-cpp compartido (prioridades, cancelación, métricas)
+from __future__ import annotations
+import os, time, queue, itertools, threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Iterator, Optional
+#PACqui 1.3.0
+# Todos los usos del modelo (chat de la UI, _llm_eval_invoke, _persona_line_from_llm, warmup) se
+# peleaban por LLMService._model_lock sin orden ni prioridad; además chat(stream=True) devolvía el
+# generador y el lock se soltaba ANTES de generar, así que otra llamada podía colarse a mitad.
+# Aquí un único hilo "dueño" del modelo atiende una cola con prioridad:
+#       chat (interactivo) > persona (frases de cortesía) > eval (banco de pruebas) > warmup
+# y a igual prioridad, por orden de llegada. submit() no bloquea: devuelve un Job con .result()
+# (Future) o .stream() (iterador de chunks). Cada Job lleva un CancelToken; el hilo dueño lo mira
+# entre token y token y cierra el generador de llama-cpp → la CPU se libera de verdad.
+# metrics(): profundidad de cola, espera y duración medias por prioridad, cancelados.
+# Cancelación real: llama_stopping_criteria() mete el CancelToken en el bucle de muestreo de
+# llama-cpp (stopping_criteria se evalúa en CADA token, también sin stream), así que la CPU se
+# libera en un token aunque nadie esté leyendo el stream. La latencia (cancel() → parada efectiva)
+# se mide por trabajo, se acumula en metrics() y se publica a los oyentes on_cancel.
+# El búfer de chunks de cada Job está acotado (PACQUI_LLM_CHUNK_BUFFER): si el consumidor no lee
+# en PACQUI_LLM_STALL_S segundos con el búfer lleno, el trabajo se cancela en vez de acumular texto.
+
+PRIORITIES = {"chat": 0, "persona": 1, "eval": 2, "warmup": 3}
+CHUNK_BUFFER = max(8, int(os.getenv("PACQUI_LLM_CHUNK_BUFFER", "512")))
+STALL_S = float(os.getenv("PACQUI_LLM_STALL_S", "30"))
+_END = object()
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancelToken:
+    def __init__(self):
+        self._ev = threading.Event()
+        self.ts = None                  # cuándo se pidió la cancelación
+        self.stop_ts = None             # cuándo paró de verdad el bucle de tokens
+
+    def cancel(self):
+        if not self._ev.is_set():
+            self.ts = time.perf_counter()
+            self._ev.set()
+
+    def mark_stopped(self):
+        if self.stop_ts is None:
+            self.stop_ts = time.perf_counter()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._ev.is_set()
+
+
+def llama_stopping_criteria(check: Callable[[], bool], on_stop: Optional[Callable[[], None]] = None):
+    """StoppingCriteriaList de llama-cpp que corta en cuanto check() es True (None si no está)."""
+    try:
+        from llama_cpp import StoppingCriteriaList
+    except Exception:
+        return None
+
+    def _crit(_input_ids, _logits) -> bool:
+        if check():
+            if on_stop is not None:
+                on_stop()
+            return True
+        return False
+    return StoppingCriteriaList([_crit])
+
+
+class Job:
+    """Petición encolada. fn(job) → dict (sin stream) o iterador de chunks (stream)."""
+
+    def __init__(self, fn: Callable[["Job"], Any], priority: str = "chat", stream: bool = False,
+                 token: Optional[CancelToken] = None, label: str = ""):
+        self.fn = fn
+        self.priority = priority if priority in PRIORITIES else "chat"
+        self.stream_mode = bool(stream)
+        self.token = token or CancelToken()
+        self.label = label or self.priority
+        self.future: Future = Future()
+        self._chunks: "queue.Queue" = queue.Queue(maxsize=CHUNK_BUFFER)
+        self.t_submit = time.perf_counter()
+        self.t_start = self.t_end = None
+
+    # --- consumidor ---
+    def cancel(self):
+        self.token.cancel()
+
+    def result(self, timeout: Optional[float] = None):
+        return self.future.result(timeout)
+
+    def stream(self) -> Iterator[dict]:
+        """Chunks a medida que el hilo dueño los produce. Si el consumidor deja de leer, se cancela."""
+        try:
+            while True:
+                ch = self._chunks.get()
+                if ch is _END:
+                    break
+                if isinstance(ch, BaseException):
+                    raise ch
+                yield ch
+        finally:
+            if not self.future.done():
+                self.token.cancel()
+
+    @property
+    def wait_s(self) -> Optional[float]:
+        return None if self.t_start is None else self.t_start - self.t_submit
+
+
+class InferenceScheduler:
+    def __init__(self, name: str = "PACquiLLMScheduler", on_cancel: Optional[Callable[[dict], None]] = None):
+        self._q: "queue.PriorityQueue" = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._name = name
+        self.current: Optional[Job] = None
+        self.on_cancel = on_cancel
+        self._m: Dict[str, Dict[str, float]] = {p: {"done": 0, "cancelled": 0, "errors": 0, "wait_s": 0.0,
+                                                      "run_s": 0.0, "max_wait_s": 0.0, "cancel_lat_s": 0.0,
+                                                      "cancel_lat_n": 0, "max_cancel_lat_s": 0.0} for p in PRIORITIES}
+
+    # --- productor ---
+    def submit(self, job: Job) -> Job:
+        self._ensure_thread()
+        self._q.put((PRIORITIES[job.priority], next(self._seq), job))
+        return job
+
+    def in_worker(self) -> bool:
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def cancel_current(self):
+        j = self.current
+        if j is not None:
+            j.cancel()
+
+    def cancel_all(self, priority: Optional[str] = None):
+        """Cancela la actual y las encoladas (todas o sólo las de una prioridad)."""
+        j = self.current
+        if j is not None and (priority is None or j.priority == priority):
+            j.cancel()
+        with self._q.mutex:
+            for _p, _s, qj in list(self._q.queue):
+                if priority is None or qj.priority == priority:
+                    qj.cancel()
+
+    # --- hilo dueño del modelo ---
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name=self._name, daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            _p, _s, job = self._q.get()
+            self._run(job)
+
+    def _run(self, job: Job):
+        m = self._m[job.priority]
+        job.t_start = time.perf_counter()
+        m["wait_s"] += job.wait_s; m["max_wait_s"] = max(m["max_wait_s"], job.wait_s)
+        if job.token.cancelled:
+            self._finish(job, m, cancelled=True)
+            return
+        self.current = job
+        try:
+            out = job.fn(job)
+            if job.stream_mode:
+                gen = iter(out)
+                try:
+                    for ch in gen:
+                        if job.token.cancelled or not self._offer(job, ch):
+                            break
+                finally:
+                    close = getattr(gen, "close", None)
+                    if callable(close):
+                        try:
+                            close()            # detiene el bucle de generación de llama-cpp
+                        except Exception:
+                            pass
+                self._finish(job, m, cancelled=job.token.cancelled)
+            else:
+                self._finish(job, m, result=out, cancelled=job.token.cancelled)
+        except BaseException as e:
+            m["errors"] += 1
+            self._push_last(job, e)
+            self._finish(job, m, error=e)
+        finally:
+            self.current = None
+
+    def _finish(self, job: Job, m, result=None, cancelled=False, error=None):
+        job.t_end = time.perf_counter()
+        m["run_s"] += job.t_end - job.t_start
+        if cancelled:
+            m["cancelled"] += 1
+            self._record_cancel(job, m)
+        elif error is None:
+            m["done"] += 1
+        self._push_last(job, _END)
+        if job.future.done():
+            return
+        if error is not None:
+            job.future.set_exception(error)
+        elif cancelled and not job.stream_mode and result is None:
+            job.future.set_exception(Cancelled("cancelado"))
+        else:
+            job.future.set_result(result)
+
+    @staticmethod
+    def _offer(job: Job, ch) -> bool:
+        """Mete un chunk en el búfer acotado; consumidor parado STALL_S con el búfer lleno → cancela."""
+        deadline = time.perf_counter() + STALL_S
+        while True:
+            try:
+                job._chunks.put(ch, timeout=0.1)
+                return True
+            except queue.Full:
+                if job.token.cancelled or time.perf_counter() >= deadline:
+                    job.token.cancel()
+                    return False
+
+    @staticmethod
+    def _push_last(job: Job, item):
+        """Error/fin de stream sin bloquear: con el búfer lleno se descarta el chunk más antiguo."""
+        while True:
+            try:
+                job._chunks.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    job._chunks.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _record_cancel(self, job: Job, m):
+        """Latencia cancel() → parada, sólo si se canceló con el trabajo ya en marcha."""
+        tk = job.token
+        if tk.ts is None or job.t_start is None or tk.ts < job.t_start:
+            return
+        stopped = tk.stop_ts or job.t_end
+        lat = max(0.0, stopped - tk.ts)
+        m["cancel_lat_s"] += lat; m["cancel_lat_n"] += 1
+        m["max_cancel_lat_s"] = max(m["max_cancel_lat_s"], lat)
+        if self.on_cancel is not None:
+            try:
+                self.on_cancel({"label": job.label, "priority": job.priority, "latency_s": round(lat, 4),
+                                "via": "criteria" if tk.stop_ts is not None else "close",
+                                "run_s": round(job.t_end - job.t_start, 3)})
+            except Exception:
+                pass
+
+    # --- diagnóstico ---
+    def metrics(self) -> dict:
+        depth = {p: 0 for p in PRIORITIES}
+        with self._q.mutex:
+            for _p, _s, j in self._q.queue:
+                depth[j.priority] += 1
+        out = {"queue_depth": sum(depth.values()), "depth_by_priority": depth,
+               "running": self.current.label if self.current else None, "by_priority": {}}
+        for p, m in self._m.items():
+            n = m["done"] + m["cancelled"] + m["errors"]
+            out["by_priority"][p] = {"done": int(m["done"]), "cancelled": int(m["cancelled"]),
+                                     "errors": int(m["errors"]),
+                                     "avg_wait_s": round(m["wait_s"] / n, 3) if n else None,
+                                     "max_wait_s": round(m["max_wait_s"], 3),
+                                     "avg_run_s": round(m["run_s"] / n, 3) if n else None,
+                                     "avg_cancel_latency_s": round(m["cancel_lat_s"] / m["cancel_lat_n"], 4)
+                                     if m["cancel_lat_n"] else None,
+                                     "max_cancel_latency_s": round(m["max_cancel_lat_s"], 4)}
+        return out
@@ -0,0 +1,322 @@
+
+# llm_worker.py — proceso aparte que posee el modelo GGUF; la UI habla con él por un socket local
+from __future__ import annotations
+import os, sys, time, uuid, secrets, argparse, threading, subprocess
+from pathlib import Path
+from typing import Optional
+#PACqui 1.3.0
+# Cargar el GGUF con Llama(...) dentro del proceso Tk hace que la carga, los fallos de página del
+# mmap y la inferencia compitan con el hilo de la UI por el GIL, y un crash de llama-cpp tumba la
+# app entera. Con PACQUI_LLM_WORKER=1, LLMService.load() usa en su lugar RemoteLlama: un proxy con la
+# misma superficie que Llama (tokenize, create_chat_completion, create_completion, n_ctx) que envía
+# cada llamada a este proceso por multiprocessing.connection (127.0.0.1 + clave en CONFIG_DIR).
+#   * El stream llega chunk a chunk; cerrar el generador en la UI (o que el stopping_criteria local
+#     diga "para", también sin stream) envía "cancel" y el worker corta en su bucle de tokens.
+#   * El worker sobrevive a reinicios de la UI (se lanza desacoplado) y puede arrancarse al iniciar
+#     sesión para esconder la carga:  python llm_worker.py serve --model C:\ruta\modelo.gguf
+#   * Todo lo demás de LLMService (planificador, recuento de tokens, RAG, índice) sigue igual en la UI.
+
+PORT = int(os.getenv("PACQUI_LLM_WORKER_PORT", "47653"))
+HOST = "127.0.0.1"
+SPAWN_TIMEOUT = float(os.getenv("PACQUI_LLM_WORKER_SPAWN_TIMEOUT", "180"))
+
+
+def config_dir() -> Path:
+    d = Path(os.getenv("LOCALAPPDATA") or Path.home()) / "PACqui"
+    d.mkdir(parents=True, exist_ok=True)
+    return d
+
+
+def authkey() -> bytes:
+    """Clave compartida (solo procesos del mismo usuario pueden leerla)."""
+    f = config_dir() / "llm_worker.key"
+    if not f.exists():
+        f.write_text(secrets.token_hex(32), encoding="utf-8")
+        try:
+            os.chmod(f, 0o600)
+        except Exception:
+            pass
+    return f.read_text(encoding="utf-8").strip().encode("ascii")
+
+
+# ----------------------------------------------------------------------------- servidor
+class _Server:
+    def __init__(self, model_path: str = "", ctx: int = 0):
+        os.environ["PACQUI_LLM_WORKER"] = "0"     # aquí se carga el Llama de verdad (sin recursión)
+        from pacqui_llm_service_FIX3 import LLMService
+        self.svc = LLMService(os.devnull)
+        self.lock = threading.Lock()              # una generación a la vez (como en la UI)
+        self.cancels = {}                         # id → threading.Event
+        if model_path:
+            self._load(model_path, ctx)
+
+    def _load(self, model_path: str, ctx: int = 0):
+        with self.lock:
+            self.svc.load(model_path, ctx=int(ctx or os.getenv("PACQUI_CTX", "8192")))
+
+    def serve(self, port: int = PORT):
+        from multiprocessing.connection import Listener
+        with Listener((HOST, port), authkey=authkey()) as lst:
+            print(f"[llm_worker] escuchando en {HOST}:{port} (modelo: {self.svc.model_path or '—'})", flush=True)
+            while True:
+                try:
+                    conn = lst.accept()
+                except Exception:
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        try:
+            while True:
+                try:
+                    req = conn.recv()
+                except (EOFError, OSError):
+                    return
+                op = req.get("op")
+                try:
+                    if op == "ping":
+                        conn.send({"ok": True, "pid": os.getpid(), "model": self.svc.model_path,
+                                   "ctx": self.svc.ctx if self.svc.model else 0,
+                                   "threads": self.svc.threads, "n_batch": self.svc.n_batch})
+                    elif op == "load":
+                        self._load(req["model_path"], req.get("ctx", 0))
+                        conn.send({"ok": True, "model": self.svc.model_path, "ctx": self.svc.ctx,
+                                   "threads": self.svc.threads, "n_batch": self.svc.n_batch})
+                    elif op == "tokenize":
+                        toks = self.svc.model.tokenize(req["text"], add_bos=req.get("add_bos", False))
+                        conn.send({"ok": True, "tokens": list(toks)})
+                    elif op == "cancel":
+                        ev = self.cancels.get(req.get("id"))
+                        if ev is not None:
+                            ev.set()
+                        conn.send({"ok": True})
+                    elif op in ("chat", "completion"):
+                        self._generate(conn, req)
+                    elif op == "shutdown":
+                        conn.send({"ok": True})
+                        os._exit(0)
+                    else:
+                        conn.send({"ok": False, "error": f"op desconocida: {op}"})
+                except Exception as e:
+                    conn.send({"ok": False, "error": f"{type(e).__name__}: {e}"})
+        finally:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _generate(self, conn, req):
+        if self.svc.model is None:
+            raise RuntimeError("Modelo no cargado en el worker.")
+        rid = req.get("id") or uuid.uuid4().hex
+        ev = self.cancels[rid] = threading.Event()
+        kw = dict(req.get("kwargs") or {})
+        from llm_scheduler import llama_stopping_criteria
+        crit = llama_stopping_criteria(ev.is_set)
+        if crit is not None:
+            kw["stopping_criteria"] = crit
+        try:
+            with self.lock:
+                fn = (self.svc.model.create_chat_completion if req["op"] == "chat"
+                      else self.svc.model.create_completion)
+                if not kw.get("stream"):
+                    conn.send({"ok": True, "result": fn(**kw)})
+                    return
+                gen = fn(**kw)
+                try:
+                    for ch in gen:
+                        if ev.is_set():
+                            break
+                        conn.send({"ok": True, "chunk": ch})
+                finally:
+                    try:
+                        gen.close()
+                    except Exception:
+                        pass
+                conn.send({"ok": True, "done": True, "cancelled": ev.is_set()})
+        finally:
+            self.cancels.pop(rid, None)
+
+
+# ----------------------------------------------------------------------------- cliente
+class RemoteLlama:
+    """Proxy de llama_cpp.Llama que ejecuta en el proceso worker."""
+
+    def __init__(self, port: int = PORT):
+        self.port = port
+        self._ctl = None
+        self._ctl_lock = threading.Lock()
+        self.model_path = ""
+        self._n_ctx = 0
+        self.cache = None
+        self.threads = self.n_batch = None        # efectivos en el worker (para logs/diagnóstico)
+
+    # --- conexión ---
+    def _connect(self):
+        from multiprocessing.connection import Client
+        return Client((HOST, self.port), authkey=authkey())
+
+    def _call(self, req: dict) -> dict:
+        with self._ctl_lock:
+            for attempt in (0, 1):
+                try:
+                    if self._ctl is None:
+                        self._ctl = self._connect()
+                    self._ctl.send(req)
+                    resp = self._ctl.recv()
+                    break
+                except (EOFError, OSError, ConnectionError):
+                    self._ctl = None
+                    if attempt:
+                        raise
+        if not resp.get("ok"):
+            raise RuntimeError(resp.get("error") or "error en llm_worker")
+        return resp
+
+    def ping(self) -> Optional[dict]:
+        try:
+            return self._call({"op": "ping"})
+        except Exception:
+            return None
+
+    @classmethod
+    def connect(cls, model_path: str, ctx: int, spawn: bool = True, port: int = PORT) -> "RemoteLlama":
+        """Conecta con el worker (lo lanza desacoplado si no está) y se asegura de que tiene este modelo."""
+        rm = cls(port)
+        info = rm.ping()
+        if info is None and spawn:
+            spawn_worker(port=port)
+            t0 = time.time()
+            while info is None and time.time() - t0 < SPAWN_TIMEOUT:
+                time.sleep(0.5)
+                info = rm.ping()
+        if info is None:
+            raise RuntimeError("No se pudo contactar con llm_worker.")
+        if info.get("model") != model_path or int(info.get("ctx") or 0) != int(ctx):
+            info = rm._call({"op": "load", "model_path": model_path, "ctx": int(ctx)})
+        rm.model_path, rm._n_ctx = info.get("model") or model_path, int(info.get("ctx") or ctx)
+        rm.threads, rm.n_batch = info.get("threads"), info.get("n_batch")
+        return rm
+
+    # --- superficie tipo Llama ---
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False):
+        return self._call({"op": "tokenize", "text": text, "add_bos": add_bos})["tokens"]
+
+    def create_chat_completion(self, **kw):
+        return self._generate("chat", kw)
+
+    def create_completion(self, **kw):
+        return self._generate("completion", kw)
+
+    def _generate(self, op: str, kw: dict):
+        # lo que no se puede serializar (callbacks) se queda en este lado; el stopping_criteria se
+        # vigila aquí y se traduce en un "cancel" al worker
+        crit = kw.get("stopping_criteria")
+        kw = {k: v for k, v in kw.items() if k not in ("stopping_criteria", "logits_processor", "grammar")}
+        rid = uuid.uuid4().hex
+        conn = self._connect()
+        conn.send({"op": op, "id": rid, "kwargs": kw})
+        done = threading.Event()
+        if crit is not None:
+            threading.Thread(target=self._watch, args=(crit, rid, done), daemon=True).start()
+        if not kw.get("stream"):
+            try:
+                resp = conn.recv()
+            finally:
+                done.set()
+                conn.close()
+            if not resp.get("ok"):
+                raise RuntimeError(resp.get("error") or "error en llm_worker")
+            return resp["result"]
+        return self._stream(conn, rid, done)
+
+    def _watch(self, crit, rid: str, done: threading.Event, every: float = 0.02):
+        while not done.wait(every):
+            try:
+                stop = crit(None, None)
+            except Exception:
+                return
+            if stop:
+                try:
+                    self._call({"op": "cancel", "id": rid})
+                except Exception:
+                    pass
+                return
+
+    def _stream(self, conn, rid: str, done: Optional[threading.Event] = None):
+        finished = False
+        try:
+            while True:
+                resp = conn.recv()
+                if not resp.get("ok"):
+                    raise RuntimeError(resp.get("error") or "error en llm_worker")
+                if resp.get("done"):
+                    finished = True
+                    return
+                yield resp["chunk"]
+        finally:
+            if done is not None:
+                done.set()
+            if not finished:
+                try:
+                    self._call({"op": "cancel", "id": rid})   # el consumidor cortó → el worker para
+                except Exception:
+                    pass
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def close(self):
+        """Cierra la conexión; el worker sigue vivo para la próxima sesión de la UI."""
+        with self._ctl_lock:
+            if self._ctl is not None:
+                try:
+                    self._ctl.close()
+                except Exception:
+                    pass
+                self._ctl = None
+
+
+def spawn_worker(model_path: str = "", ctx: int = 0, port: int = PORT):
+    """Lanza el worker desacoplado de este proceso (sobrevive al cierre de la UI)."""
+    args = [sys.executable, str(Path(__file__).resolve()), "serve", "--port", str(port)]
+    if model_path:
+        args += ["--model", model_path, "--ctx", str(int(ctx or 0))]
+    kw = dict(stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+              cwd=str(Path(__file__).resolve().parent))
+    if os.name == "nt":
+        kw["creationflags"] = getattr(subprocess, "DETACHED_PROCESS", 0x8) | getattr(subprocess, "CREATE_NEW_PROCESS_GROUP", 0x200)
+    else:
+        kw["start_new_session"] = True
+    return subprocess.Popen(args, **kw)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Worker de inferencia de PACqui (modelo GGUF fuera del proceso de la UI).")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    s = sub.add_parser("serve", help="arranca el worker (p. ej. al iniciar sesión)")
+    s.add_argument("--model", default=os.getenv("PACQUI_MODEL", ""))
+    s.add_argument("--ctx", type=int, default=0)
+    s.add_argument("--port", type=int, default=PORT)
+    p = sub.add_parser("ping", help="comprueba si hay un worker escuchando")
+    p.add_argument("--port", type=int, default=PORT)
+    q = sub.add_parser("stop", help="detiene el worker")
+    q.add_argument("--port", type=int, default=PORT)
+    a = ap.parse_args(argv)
+    if a.cmd == "serve":
+        _Server(a.model, a.ctx).serve(a.port)
+    elif a.cmd == "ping":
+        print(RemoteLlama(a.port).ping() or "sin worker")
+    elif a.cmd == "stop":
+        try:
+            RemoteLlama(a.port)._call({"op": "shutdown"})
+        except Exception:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -365,6 +365,23 @@ class MetaStore:
                 )
             """)
             c.execute("CREATE INDEX IF NOT EXISTS idx_concept_sources_path ON concept_sources( lower(path) )")
+
+            # --- Cola de revisión de keywords sugeridas (scraper por lotes) ---
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS kw_suggestions (
+                    fullpath   TEXT NOT NULL,
+                    keyword    TEXT NOT NULL,
+                    freq       INTEGER DEFAULT 1,
+                    source     TEXT DEFAULT '',
+                    status     TEXT NOT NULL DEFAULT 'pending',   -- pending | accepted | rejected
+                    created_at TEXT DEFAULT (strftime('%Y-%m-%d %H:%M:%f','now','localtime')),
+                    score      REAL,                               -- puntuación TF-IDF (source='tfidf')
+                    PRIMARY KEY (fullpath, keyword)
+                )
+            """)
+            if "score" not in {row[1].lower() for row in c.execute("PRAGMA table_info(kw_suggestions)")}:
+                c.execute("ALTER TABLE kw_suggestions ADD COLUMN score REAL")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_kw_suggestions_status ON kw_suggestions(status, fullpath)")
             conn.commit()
 
 
@@ -392,6 +409,65 @@ class MetaStore:
             conn.commit()
             return n
 
+    # ---------- cola de revisión (sugerencias) ----------
+    def queue_keyword_suggestions(self, items: Iterable[tuple], source: str = "scraper") -> int:
+        """
+        items: (fullpath, {keyword: valor}). Con source="tfidf" el valor es la puntuación TF-IDF y va a
+        la columna score; si no, es la frecuencia (freq). Las ya aceptadas/rechazadas no vuelven a la cola.
+        """
+        tfidf = source == "tfidf"
+        rows = []
+        for fullpath, freqs in items:
+            kpath = _norm(fullpath)
+            rows.extend((kpath, k.strip().lower(), None if tfidf else int(f or 1),
+                         float(f or 0.0) if tfidf else None, source or "")
+                        for k, f in (freqs or {}).items() if k and k.strip())
+        if not rows:
+            return 0
+        with self._lock, self._connect() as conn:
+            before = conn.total_changes
+            conn.executemany("""
+                INSERT INTO kw_suggestions(fullpath, keyword, freq, score, source) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(fullpath, keyword) DO UPDATE SET
+                    freq = COALESCE(excluded.freq, kw_suggestions.freq),
+                    score = COALESCE(excluded.score, kw_suggestions.score)
+                WHERE kw_suggestions.status = 'pending'
+            """, rows)
+            conn.commit()
+            return conn.total_changes - before
+
+    def list_keyword_suggestions(self, status: str = "pending", limit: int = 5000) -> dict:
+        """{fullpath: [(keyword, freq, score), ...]}; freq o score pueden ser None según el origen."""
+        with self._lock, self._connect() as conn:
+            rows = conn.execute("""
+                SELECT fullpath, keyword, freq, score FROM kw_suggestions
+                WHERE status = ? ORDER BY fullpath, COALESCE(freq, 0) DESC, COALESCE(score, 0) DESC, keyword LIMIT ?
+            """, (status, int(limit or 5000))).fetchall()
+        out: dict = {}
+        for fp, kw, f, sc in rows:
+            out.setdefault(fp, []).append((kw, None if f is None else int(f), None if sc is None else float(sc)))
+        return out
+
+    def resolve_keyword_suggestions(self, decisions: Iterable[tuple], source: str = "scraper") -> int:
+        """
+        decisions: (fullpath, [aceptadas], [rechazadas]). Las aceptadas pasan a doc_keywords
+        (misma transacción); todas salen de la cola. Devuelve nº de keywords guardadas.
+        """
+        acc, upd = [], []
+        for fullpath, accepted, rejected in decisions:
+            kpath = _norm(fullpath)
+            for k in accepted or ():
+                acc.append((kpath, k, source or "")); upd.append(("accepted", kpath, k.lower()))
+            for k in rejected or ():
+                upd.append(("rejected", kpath, k.lower()))
+        with self._lock, self._connect() as conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO doc_keywords(fullpath, keyword, source) VALUES (?, ?, ?)", acc)
+            n = conn.total_changes - before
+            conn.executemany("UPDATE kw_suggestions SET status=? WHERE fullpath=? AND keyword=?", upd)
+            conn.commit()
+            return n
+
     def get_keywords(self, fullpath: str) -> List[str]:
         with self._lock, self._connect() as conn:
             kpath = _norm(fullpath)
@@ -0,0 +1,224 @@
+
+# nlp_es.py — lingüística mínima en español: stopwords, heurística de sustantivos y spaCy por lotes
+from __future__ import annotations
+import os, re, time, threading, collections
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional
+#PACqui 1.3.0
+# Antes vivía dentro del Visor y _extract_noun_frequencies hacía spacy.load() en CADA llamada.
+# Aquí el pipeline se carga una sola vez por proceso (sin parser/ner, que no hacen falta para
+# sacar sustantivos) y hay API por lotes: nlp.pipe(n_process=...) o, sin spaCy, la heurística en
+# un pool de procesos.
+# Servicio de proceso: warmup_async() lo carga en un hilo tras el arranque (el import de spaCy +
+# modelo tarda segundos) y add_listener() engancha el bus de eventos de la app, que recibe
+# "nlp_load" (modelo, segundos) y "nlp_batch" (docs, docs/s, motor). status() para el panel.
+
+SPACY_MODELS = ("es_core_news_sm", "es_core_news_md")
+NLP_MAX_CHARS = 200_000
+NOUN_WORKERS = int(os.getenv("PACQUI_NLP_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+
+SPANISH_STOPWORDS = {
+    'a','acá','ahí','al','algo','algún','alguna','algunas','alguno','algunos','allá','allí','ambas','ambos',
+    'ante','anteayer','antes','aquel','aquella','aquellas','aquello','aquellos','aquí','arriba','así','atrás',
+    'aun','aunque','bajo','bastante','bien','cada','casi','como','con','conmigo','contigo','contra','cual',
+    'cuales','cualquier','cualquiera','cuyas','cuyos','cuya','cuyo','de','dejar','del','demasiado','demás',
+    'dentro','deprisa','desde','despacio','donde','dos','el','él','ella','ellas','ello','ellos','emplear',
+    'en','encima','entonces','entre','era','eran','es','esa','esas','ese','eso','esos','esta','está','estaba',
+    'estaban','estado','estar','estará','estas','este','esto','estos','estoy','fin','fue','fueron','fui','fuimos',
+    'gracias','gran','grande','ha','haber','había','habían','hace','hacen','hacer','hacerlo','hacia','han','hasta',
+    'hay','hoy','la','las','le','lo','los','luego','mal','más','me','menos','mi','mis','mío','mía','míos','mías',
+    'mientras','muy','nada','nadie','ni','ningún','ninguna','ninguno','no','nos','nosotras','nosotros','nuestra',
+    'nuestras','nuestro','nuestros','nunca','o','os','otra','otras','otro','otros','para','pero','poco','por',
+    'porque','primero','puede','pueden','pues','qué','que','quien','quién','quienes','saber','se','según','ser',
+    'si','sí','siempre','siendo','sin','sobre','sois','solamente','solo','su','sus','tal','también','tampoco',
+    'tan','tanto','te','tenéis','tengo','tener','tiene','tienen','todo','todos','tras','tu','tus','tuya','tuyo',
+    'tuyos','tuyas','un','una','unas','uno','unos','usted','ustedes','va','vamos','van','varias','varios','vosotras',
+    'vosotros','voy','ya','yo'
+}
+
+def _simple_tokenize_es(text: str):
+    if not text:
+        return []
+    tokens = re.findall(r"[A-Za-zÁÉÍÓÚÜáéíóúüÑñ0-9]{3,}", text, flags=re.UNICODE)
+    return [t.lower() for t in tokens]
+
+def _is_probable_noun_es(token: str):
+    # Solo sustantivos (heurística). Excluimos verbos/tiempos comunes.
+    if not token or len(token) < 3:
+        return False
+    # No números puros
+    if token.isdigit():
+        return False
+    # Stopwords fuera
+    if token in SPANISH_STOPWORDS:
+        return False
+    # Adverbios y derivados largos
+    if token.endswith(("mente","amiento","imientos","imiento","aciones","ación","sión","mente")):
+        return False
+    # Gerundios y participios
+    if token.endswith(("ando","iendo","yendo","ado","ada","ados","adas","ido","ida","idos","idas")):
+        return False
+    # Infinitivos
+    if token.endswith(("ar","er","ir")):
+        return False
+    # Conjugaciones frecuentes (muy simple; puede sobrefiltrar algunos sustantivos cortos)
+    if token.endswith(("aré","arás","ará","aremos","arán",
+                       "eré","erás","erá","eremos","erán",
+                       "iré","irás","irá","iremos","irán",
+                       "aba","abas","aban","íamos","ías","ían",
+                       "aste","aron","iste","ieron","amos","imos",
+                       "aré","ería","erías","erían","iría","irías","irían")):
+        return False
+    # Aceptamos siglas/palabras alfanuméricas si no pasan filtros anteriores
+    return True
+
+
+
+# ----------------------------------------------------------------------------- spaCy (una vez)
+_NLP = None
+_NLP_TRIED = False
+_NLP_LOCK = threading.Lock()
+_STATS = {"model": None, "load_s": None, "docs": 0, "seconds": 0.0, "last_docs_per_s": None}
+_LISTENERS: List = []
+
+
+def add_listener(fn):
+    """fn(tipo, **datos) recibe los eventos del servicio (p. ej. AppRoot._log)."""
+    if callable(fn) and fn not in _LISTENERS:
+        _LISTENERS.append(fn)
+
+
+def _emit(typ: str, **data):
+    for fn in list(_LISTENERS):
+        try:
+            fn(typ, **data)
+        except Exception:
+            pass
+
+
+def load_spacy():
+    """Pipeline español cargado una sola vez (None si spaCy o el modelo no están)."""
+    global _NLP, _NLP_TRIED
+    if _NLP_TRIED:
+        return _NLP
+    with _NLP_LOCK:
+        if _NLP_TRIED:
+            return _NLP
+        t0 = time.perf_counter()
+        try:
+            import spacy
+            for name in SPACY_MODELS:
+                try:
+                    _NLP = spacy.load(name, disable=["parser", "ner"])
+                    _STATS["model"] = name
+                    break
+                except Exception:
+                    continue
+        except Exception:
+            _NLP = None
+        _STATS["load_s"] = time.perf_counter() - t0
+        _NLP_TRIED = True
+    _emit("nlp_load", model=_STATS["model"] or "heurística", seconds=round(_STATS["load_s"], 3),
+          ok=_NLP is not None)
+    return _NLP
+
+
+def warmup_async(delay: float = 0.0) -> threading.Thread:
+    """Carga el pipeline en un hilo de fondo (no bloquea la UI); las llamadas posteriores lo reutilizan."""
+    def _run():
+        if delay:
+            time.sleep(delay)
+        load_spacy()
+    th = threading.Thread(target=_run, name="nlp-warmup", daemon=True)
+    th.start()
+    return th
+
+
+def status() -> dict:
+    out = dict(_STATS)
+    out["loaded"] = _NLP_TRIED
+    out["spacy"] = _NLP is not None
+    out["docs_per_s"] = (_STATS["docs"] / _STATS["seconds"]) if _STATS["seconds"] else None
+    return out
+
+
+def _record_batch(n: int, dt: float, engine: str):
+    _STATS["docs"] += n
+    _STATS["seconds"] += dt
+    _STATS["last_docs_per_s"] = n / max(dt, 1e-6)
+    _emit("nlp_batch", docs=n, seconds=round(dt, 3), docs_per_s=round(_STATS["last_docs_per_s"], 1),
+          engine=engine)
+
+
+def _doc_nouns(doc) -> Dict[str, int]:
+    freqs = collections.Counter()
+    for tok in doc:
+        if tok.pos_ in ("NOUN", "PROPN"):
+            w = tok.lemma_.lower().strip()
+            if w and w not in SPANISH_STOPWORDS and len(w) >= 3 and not w.endswith("mente"):
+                freqs[w] += 1
+    return dict(freqs)
+
+
+def heuristic_noun_frequencies(text: str) -> Dict[str, int]:
+    """Sin spaCy: tokens que pasan _is_probable_noun_es (función de módulo → apta para ProcessPool)."""
+    freqs = collections.Counter()
+    for t in _simple_tokenize_es(text or ""):
+        if _is_probable_noun_es(t):
+            freqs[t] += 1
+    return dict(freqs)
+
+
+def noun_frequencies(text: str, use_spacy: bool = True) -> Dict[str, int]:
+    if not text or len(text) < 10:
+        return {}
+    nlp = load_spacy() if use_spacy else None
+    t0 = time.perf_counter()
+    if nlp is not None:
+        try:
+            out = _doc_nouns(nlp(text[:NLP_MAX_CHARS]))
+            _record_batch(1, time.perf_counter() - t0, "spacy")
+            return out
+        except Exception:
+            pass
+    out = heuristic_noun_frequencies(text)
+    _record_batch(1, time.perf_counter() - t0, "heurística")
+    return out
+
+
+def noun_frequencies_many(texts: Iterable[str], use_spacy: bool = True, n_process: Optional[int] = None,
+                          batch_size: int = 16, progress=None) -> List[Dict[str, int]]:
+    """
+    Sustantivos de muchos textos de una vez (mismo orden de entrada).
+    spaCy → nlp.pipe(n_process=n_process); sin spaCy → heurística en un pool de procesos.
+    progress(hechos) opcional tras cada documento.
+    """
+    texts = [(t or "")[:NLP_MAX_CHARS] for t in texts]
+    n_process = max(1, int(n_process or NOUN_WORKERS))
+    out: List[Dict[str, int]] = []
+    nlp = load_spacy() if use_spacy else None
+    t0 = time.perf_counter()
+    if nlp is not None:
+        try:
+            for doc in nlp.pipe(texts, n_process=n_process, batch_size=batch_size):
+                out.append(_doc_nouns(doc))
+                if progress: progress(len(out))
+            _record_batch(len(out), time.perf_counter() - t0, "spacy")
+            return out
+        except Exception:
+            out = []
+    if n_process > 1 and len(texts) > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=n_process) as ex:
+                for d in ex.map(heuristic_noun_frequencies, texts, chunksize=4):
+                    out.append(d)
+                    if progress: progress(len(out))
+            _record_batch(len(out), time.perf_counter() - t0, "heurística")
+            return out
+        except Exception:
+            out = []
+    for t in texts:
+        out.append(heuristic_noun_frequencies(t))
+        if progress: progress(len(out))
+    _record_batch(len(out), time.perf_counter() - t0, "heurística")
+    return out
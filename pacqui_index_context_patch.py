@@ -56,24 +56,9 @@ def _patched_worker_chat_stream(self):
                 return len(s) // 3  # estimación grosera como último recurso
 
         def _trim_to_budget(ctx_text: str, budget_tokens: int) -> str:
-            """Recorta priorizando el bloque [FRAGMENTOS]."""
-            if _tok(ctx_text) <= budget_tokens:
-                return ctx_text
-            # separa bloques (si hay)
-            parts = []
-            head, sep, rest = ctx_text.partition("[FRAGMENTOS]")
-            if sep:  # hay fragmentos
-                frag = "[FRAGMENTOS]" + rest
-                # recorta FRAGMENTOS de atrás hacia adelante
-                lines = frag.splitlines()
-                while lines and _tok(head + "\n".join(lines)) > budget_tokens:
-                    lines = lines[:-4]
-                parts = [head, "\n".join(lines)]
-                ctx_text = "".join(parts)
-            # si aún se pasa, recorta líneas del final
-            while _tok(ctx_text) > budget_tokens and "\n" in ctx_text:
-                ctx_text = "\n".join(ctx_text.splitlines()[:-4])
-            return ctx_text
+            """Recorta priorizando el bloque [FRAGMENTOS] (tokenizado una vez por línea + bisect)."""
+            from token_budget import trim_section
+            return trim_section(ctx_text, "[FRAGMENTOS]", budget_tokens, _tok)
 
         # ---- construye mensajes con contexto (ÍNDICE + RAG) ----
         def _msgs_with_context():
@@ -40,14 +40,14 @@ def _get_note(cur, fullpath: str) -> str:
 
 
 def _hash_embedder(text, dim=256):
-    import hashlib
-    v=[0.0]*dim
-    if text:
-        for tok in re.findall(r"[A-Za-zÁÉÍÓÚÜáéíóúüÑñ0-9]{2,}", str(text).lower()):
-            h=int(hashlib.md5(tok.encode("utf-8")).hexdigest(),16)
-            i=h%dim; s=1.0 if (h>>1)&1 else -1.0; v[i]+=s
-    n=(sum(x*x for x in v)**0.5) or 1.0
-    return [x/n for x in v]
+    # Implementación rápida (LRU de tokens + bincount) con vectores idénticos: ver hash_embedder.py
+    from hash_embedder import hash_embed
+    return hash_embed(text, dim=dim)
+
+
+def _hash_encode_many(texts, dim=256):
+    from hash_embedder import encode_many
+    return encode_many(texts, dim=dim)
 
 
 class LLMService:
@@ -61,26 +61,36 @@ class LLMService:
         self.model_path = ""
         self.ctx = 2048
 
-        # Reserva 1–2 cores para la UI
-
-        self.threads = max(2, (os.cpu_count() or 4) - 2)
-
-        # Más conservador para primer run (evita picos)
-        self.n_batch = 256
+        # Hilos/batch EFECTIVOS del modelo cargado (los fija load(): _cpu_autotune + perf_profile);
+        # hasta entonces, la heurística, para no publicar None en logs/diagnóstico
+        _perf = _cpu_autotune(self.ctx)
+        self.threads = _perf["n_threads"]
+        self.n_batch = _perf["n_batch"]
+        self.perf_profile = None
 
         # --- NUEVO: sincronización y flags de warmup ---
         import threading
-        self._model_lock = threading.Lock()  # un solo hilo puede usar el modelo a la vez
+        # un solo hilo usa el modelo a la vez; reentrante porque un trabajo del planificador que ya lo
+        # tiene puede llamar a chat()/complete() en línea (mismo hilo) sin bloquearse a sí mismo
+        self._model_lock = threading.RLock()
         self._warming = False  # warmup en curso
         self._warmed = False  # warmup finalizado
 
         # cache opcional del embedder
         self._embedder_cached = None
 
+        # caché de prefijos del prompt (KV) + métricas por turno (prefix-hit, TTFT)
+        from prompt_cache import PromptCacheStats
+        self._prompt_cache_mode = "off"
+        self.prompt_stats = PromptCacheStats()
+        self._turn_listeners = []
+        self._cancel_listeners = []
+        self._answer_listeners = []
+        self._draft = None              # decodificación especulativa (speculative.py)
+
     # --------- carga ---------
 
     def load(self, model_path: str, ctx: int = 8192):
-        from llama_cpp import Llama
         import os
         name = Path(model_path).name.lower()
         chat_fmt = "llama-2"
@@ -91,8 +101,8 @@ class LLMService:
         elif "phi" in name:
             chat_fmt = "phi3"
 
-        # Idempotencia
-        if self.model and self.model_path == model_path and int(self.ctx) == int(
+        # Idempotencia (contra el ctx PEDIDO: con PACQUI_SPECULATIVE el efectivo puede ser menor)
+        if self.model and self.model_path == model_path and int(getattr(self, "_ctx_req", self.ctx)) == int(
                 ctx or os.getenv("PACQUI_CTX", "8192")):
             return
 
@@ -101,9 +111,30 @@ class LLMService:
         self.model_path = model_path
         # ↑↑ ctx por variable de entorno, default 8192 (antes 2048)
         self.ctx = int(ctx or int(os.getenv("PACQUI_CTX", "8192")))
+        self._ctx_req = self.ctx
+
+        # PACQUI_LLM_WORKER=1 → el GGUF vive en un proceso aparte (llm_worker.py); aquí sólo un proxy
+        if os.getenv("PACQUI_LLM_WORKER", "0") == "1":
+            from llm_worker import RemoteLlama
+            import perf_profile
+            self.model = RemoteLlama.connect(self.model_path, self.ctx)
+            self.ctx = int(self.model.n_ctx() or self.ctx)     # el worker puede acotarlo (PACQUI_SPEC_MAX_CTX)
+            self._prompt_cache_mode = "worker"
+            self._draft = None
+            # los del worker si los informa; si no, lo que él mismo calcula (misma máquina, mismo perfil)
+            self.perf_profile = perf_profile.get(self.model_path)
+            perf = perf_profile.apply(_cpu_autotune(self.ctx), self.perf_profile, self.ctx)
+            self.threads = getattr(self.model, "threads", None) or perf["n_threads"]
+            self.n_batch = getattr(self.model, "n_batch", None) or perf["n_batch"]
+            return
 
-        perf = _cpu_autotune(self.ctx)
-        self.model = Llama(
+        from llama_cpp import Llama
+        from speculative import build_draft, capped_ctx
+        import perf_profile
+        # perfil medido para este modelo en esta máquina (perf_profile.py); si no hay, heurística
+        prof = perf_profile.get(self.model_path)
+        perf = perf_profile.apply(_cpu_autotune(self.ctx), prof, self.ctx)
+        kw = dict(
             model_path=self.model_path,
             n_ctx=self.ctx,
             n_threads=perf["n_threads"],
@@ -116,12 +147,45 @@ class LLMService:
             chat_format=chat_fmt,
             use_mlock=perf["use_mlock"],
         )
+        # PACQUI_SPECULATIVE=lookup|ruta.gguf → borrador que propone tokens y el modelo verifica
+        # draft_model fuerza logits_all (búfer n_ctx × n_vocab float32, GB con ctx grande): se acota n_ctx
+        spec_ctx = capped_ctx(self.ctx)
+        self._draft = build_draft(spec_ctx, perf["n_threads"])
+        if self._draft is not None:
+            try:
+                self.model = Llama(draft_model=self._draft, **dict(kw, n_ctx=spec_ctx))
+                print(f"[SPEC] decodificación especulativa: {self._draft.kind}")
+                if spec_ctx < self.ctx:
+                    print(f"[SPEC] n_ctx {self.ctx} → {spec_ctx} (PACQUI_SPEC_MAX_CTX: logits_all del borrador)")
+                    self.ctx = spec_ctx
+            except TypeError:
+                # build sin 'draft_model'
+                self._draft = None
+        if self._draft is None:
+            self.model = Llama(**kw)
+
+        # primera carga de este modelo aquí: barrido rápido de hilos (se guarda para las siguientes)
+        if prof is None and perf_profile.AUTO and "PACQUI_THREADS" not in os.environ:
+            try:
+                prof = perf_profile.quick_tune(self.model, self.model_path, perf)
+                if prof:
+                    perf["n_threads"] = prof["n_threads"]
+            except Exception as e:
+                print(f"[AUTOTUNE] omitido: {e}")
+        self.threads, self.n_batch, self.perf_profile = perf["n_threads"], perf["n_batch"], prof
+        from prompt_cache import attach
+        self._prompt_cache_mode = attach(self.model)
 
     def is_loaded(self) -> bool:
         return self.model is not None
 
     def cancel(self):
-        """Cancelación best-effort: si la build de llama-cpp expone cancel/reset, intentalo."""
+        """Cancela la petición en curso del planificador (se corta entre token y token).
+        Sin planificador activo: best-effort con cancel/reset si la build de llama-cpp lo expone."""
+        sched = getattr(self, "_scheduler", None)
+        if sched is not None and sched.current is not None:
+            sched.cancel_current()
+            return
         try:
             if hasattr(self.model, "cancel") and callable(self.model.cancel):
                 self.model.cancel()
@@ -130,12 +194,71 @@ class LLMService:
         except Exception:
             pass
 
+    def add_cancel_listener(self, fn):
+        """fn(dict) tras cada cancelación: label, priority, latency_s (cancel → parada), via."""
+        if callable(fn) and fn not in self._cancel_listeners:
+            self._cancel_listeners.append(fn)
+
+    def _on_cancel(self, st: dict):
+        print(f"[CANCEL] {st['label']} parado en {st['latency_s'] * 1000:.0f} ms ({st['via']})")
+        for fn in list(self._cancel_listeners):
+            try:
+                fn(st)
+            except Exception:
+                pass
+
+    def add_answer_listener(self, fn):
+        """fn(dict) al acabar cada respuesta: tokens, tok_s, spec, accept_rate (borrador)."""
+        if callable(fn) and fn not in self._answer_listeners:
+            self._answer_listeners.append(fn)
+
+    def _on_answer(self, st: dict):
+        acc = (f"  aceptación{'≈' if st.get('approx') else '='}{st['accept_rate']:.0%}"
+               f"{' (aprox.: chunks de stream, no tokens)' if st.get('approx') else ''}"
+               if st.get("accept_rate") is not None else "")
+        print(f"[GEN] {st['tokens']} tok  {st['tok_s'] or 0:.1f} tok/s  spec={st['spec']}{acc}")
+        for fn in list(self._answer_listeners):
+            try:
+                fn(st)
+            except Exception:
+                pass
+
+    def add_turn_listener(self, fn):
+        """fn(dict) tras cada turno: prefix, prompt_tokens, prefix_hit_tokens, ttft_s."""
+        if callable(fn) and fn not in self._turn_listeners:
+            self._turn_listeners.append(fn)
+
+    def _on_turn(self, st: dict):
+        st = dict(st, cache=self._prompt_cache_mode)
+        self.prompt_stats.record(st)
+        print(f"[PROMPT-CACHE] {st['cache']} prefijo={st['prefix']} hit={st['prefix_hit_tokens']}/"
+              f"{st['prompt_tokens']} tok  TTFT={st['ttft_s']:.2f}s")
+        for fn in list(self._turn_listeners):
+            try:
+                fn(st)
+            except Exception:
+                pass
+
     # --------- token count util ---------
     def count_tokens(self, text: str) -> int:
+        # memoizado por (modelo, hash del texto): los bloques repetidos no se re-tokenizan
+        if self.model is None:
+            return max(1, len(text or "") // 3)
+        cache = getattr(self, "_tok_cache", None)
+        if cache is None:
+            from token_budget import TokenCountCache
+            cache = self._tok_cache = TokenCountCache()
         try:
-            return len(self.model.tokenize(text.encode("utf-8"), add_bos=False))
+            return cache.count((self.model_path, id(self.model)), text or "", self._tokenize_len)
         except Exception:
-            return max(1, len(text) // 3)
+            return max(1, len(text or "") // 3)
+
+    def _tokenize_len(self, text: str) -> int:
+        return len(self.model.tokenize(text.encode("utf-8"), add_bos=False))
+
+    def token_cache_stats(self) -> dict:
+        cache = getattr(self, "_tok_cache", None)
+        return cache.stats() if cache is not None else {"hits": 0, "misses": 0, "entries": 0, "hit_rate": None}
 
     def _rag_meta_get(self, key: str, default=None):
         try:
@@ -159,7 +282,8 @@ class LLMService:
             def _encode_hash(text: str, _dim=256):
                 return _hash_embedder(text, dim=_dim)
 
-            self._embedder_cached = {"encode": _encode_hash, "dim": 256, "backend": "hash", "sig": "hash:256"}
+            self._embedder_cached = {"encode": _encode_hash, "encode_many": _hash_encode_many,
+                                     "dim": 256, "backend": "hash", "sig": "hash:256"}
             return self._embedder_cached
 
         # cache
@@ -181,22 +305,33 @@ class LLMService:
                     model_path = model_override
                 from sentence_transformers import SentenceTransformer
                 st_model = SentenceTransformer(model_path)
+                from text_chunker import st_token_counter
 
                 def _encode_st(text: str):
                     v = st_model.encode(text or "", normalize_embeddings=True)
                     return v.tolist() if hasattr(v, "tolist") else list(map(float, v))
 
-                self._embedder_cached = {"encode": _encode_st, "dim": dim, "backend": "st", "sig": sig}
+                def _encode_st_many(texts):
+                    M = st_model.encode([t or "" for t in texts], normalize_embeddings=True,
+                                        batch_size=int(os.getenv("PACQUI_EMBED_BATCH", "64")),
+                                        show_progress_bar=False)
+                    return [v.tolist() if hasattr(v, "tolist") else list(map(float, v)) for v in M]
+
+                self._embedder_cached = {"encode": _encode_st, "encode_many": _encode_st_many,
+                                         "dim": dim, "backend": "st", "sig": sig,
+                                         "count_tokens": st_token_counter(st_model)}
                 return self._embedder_cached
             except Exception:
                 # Si el modelo no está instalado → caeremos a hash y anotaremos aviso en el contexto
                 self._embedder_cached = {"encode": lambda t: _hash_embedder(t, dim=256),
+                                         "encode_many": _hash_encode_many,
                                          "dim": 256, "backend": "hash", "sig": "hash:256",
                                          "warn": f"[aviso] El índice usa {sig} pero no se pudo cargar el modelo local. Instala sentence-transformers o define PACQUI_EMBED_DIR."}
                 return self._embedder_cached
 
         # Fallback por defecto (hash)
         self._embedder_cached = {"encode": lambda t: _hash_embedder(t, dim=256),
+                                 "encode_many": _hash_encode_many,
                                  "dim": 256, "backend": "hash", "sig": "hash:256"}
         return self._embedder_cached
 
@@ -475,149 +610,54 @@ class LLMService:
         return "Documentos sugeridos (por palabras clave del índice):\n" + "\n".join(lines), hits
 
     # --------- RAG simplificado (hash-embeddings) ---------
+    def _rag_engine(self, candidates: str = "hybrid", reranker: str = "rrf", max_candidates: int = 600):
+        """Motor único de recuperación (rag_retrieval) con el embedder activo."""
+        from rag_retrieval import RetrievalEngine
+        emb = self._get_embedder()
+        return RetrievalEngine(db_path=self.db_path, encode=emb["encode"], candidates=candidates,
+                               reranker=reranker, max_candidates=max_candidates, ext_filter=True)
+
     def _rag_rows(self, query: str | None = None, max_candidates: int = 600):
-        import re, sqlite3
-        con = sqlite3.connect(self.db_path, check_same_thread=False)
+        if not (query or "").strip():
+            return []
         try:
-            cur = con.cursor()
-            if not (query or "").strip():
-                return []
-
-            # tokens significativos de la query
-            toks = [t.lower() for t in re.findall(r"[A-Za-zÁÉÍÓÚÜáéíóúüÑñ0-9]{3,}", (query or ""))]
-            STOP = {"para", "con", "por", "unos", "unas", "este", "esta", "esto", "sobre", "desde", "hasta",
-                    "entre", "que", "como", "cual", "cuales", "de", "la", "el", "los", "las", "y", "o", "u",
-                    "del", "al"}
-            toks = [t for t in toks if t not in STOP][:6]  # un poco más laxo y hasta 6 términos
-
-            # ⚑ whitelists útiles del dominio
-            qlow = (query or "").lower()
-            if "mic" in qlow and "mic" not in toks:
-                toks.append("mic")
-            if "fega" in qlow and "feaga" not in toks:
-                toks.append("feaga")
-            if "feader" in qlow and "feader" not in toks:
-                toks.append("feader")
-
-            if toks:
-                clauses, params = [], []
-                for tok in toks:
-                    pat = f"%{tok}%"
-                    clauses.append("c.text LIKE ?");
-                    params.append(pat)
-                    clauses.append("c.file_path LIKE ?");
-                    params.append(pat)
-                where = " WHERE " + " OR ".join(clauses)
-                sql = ("SELECT c.id, c.text, c.file_path, e.vec "
-                       "FROM chunks c JOIN embeddings e ON e.chunk_id=c.id" + where +
-                       " ORDER BY c.id DESC LIMIT ?")
-                params.append(int(max_candidates))
-                rows = cur.execute(sql, params).fetchall()
-            else:
-                rows = cur.execute(
-                    "SELECT c.id, c.text, c.file_path, e.vec "
-                    "FROM chunks c JOIN embeddings e ON e.chunk_id=c.id "
-                    "ORDER BY c.id DESC LIMIT ?", (int(max_candidates),)
-                ).fetchall()
-
-            return rows
+            return self._rag_engine(max_candidates=max_candidates).candidate_rows(query)
         except Exception:
             return []
-        finally:
-            con.close()
-
-
 
     def _rag_retrieve(self, query: str, k: int = 8, max_chars: int = 1200) -> str:
         """
-        Recupera k fragmentos re-ordenando por similitud + preferencia de extensión (PDF/DOCX),
-        SIN depender de self.rag (usa chunks/embeddings del SQLite).
+        Recupera k fragmentos fusionando por RRF el ranking BM25 (FTS5), el coseno y las
+        heurísticas de dominio (PDF/DOCX, PAC/MIC…). SIN depender de self.rag.
+        El desglose de puntuaciones queda en self._last_rag_hits.
         """
-        import re, os, struct
-        from pathlib import Path
-
-        rows = self._rag_rows(query, max_candidates=900)
-
-        if not rows:
+        self._last_rag_hits = []
+        if not (query or "").strip():
             return ""
-
-        emb = self._get_embedder()
-        qv = emb["encode"](query or "")
-
-        def cos(a, b):
-            s = 0.0
-            m = min(len(a), len(b))
-            for i in range(m):
-                s += a[i] * b[i]
-            return s
-
-        qlow = (query or "").lower()
-        ext_filter = set()
-        if "pdf" in qlow: ext_filter.add(".pdf")
-        if "docx" in qlow: ext_filter.add(".docx")
-        if "doc" in qlow and ".docx" not in qlow: ext_filter.add(".doc")
-
-        EXT_BONUS = {".pdf": 3, ".docx": 3, ".doc": 2, ".pptx": 1}
-        EXT_MALUS = {".png": -2, ".jpg": -2, ".jpeg": -2, ".gif": -2, ".py": -2, ".java": -1, ".sql": -1}
-        toks = re.findall(r"[A-Za-zÁÉÍÓÚÜáéíóúüÑñ0-9]{3,}", qlow)
-
-
-        scored = []
-        for _cid, text, path, vec_blob in rows:
-            try:
-                vec = list(struct.unpack(f"{len(vec_blob) // 4}f", vec_blob)) if isinstance(vec_blob, (
-                bytes, bytearray)) else list(vec_blob)
-            except Exception:
-                continue
-            ext = Path(path or "").suffix.lower()
-            if ext_filter and ext not in ext_filter:
-                continue
-            txt_low = (text or "").lower()
-            # si hay términos de la consulta y ninguno aparece en el texto -> descarta (ruido)
-            if toks and not any(t in txt_low for t in toks):
-                continue
-
-            base = cos(qv, vec)
-            fname = os.path.basename(path or "").lower()
-            fname_bonus = sum(1 for t in toks if t in fname)
-            ext_adj = EXT_BONUS.get(ext, 0) + EXT_MALUS.get(ext, 0)
-
-            txt_low = (text or "").lower()
-
-            # --- BOOST dominio PAC/MIC/SICOP/PEPAC ---
-            mic_terms = (
-            " mic ", " ficheros de pago ", " fichero de pago ", " sicop ", " pepac ", " feaga ", " feader ")
-            dom_boost = 1.5 if (
-                        any(t in txt_low for t in mic_terms) or any(t.strip() in fname for t in mic_terms)) else 0.0
-
-            # --- PENALIZA chunks de metadatos/cabeceras (suelen dar respuestas tipo "Ref./Versión/Pág.") ---
-            meta_terms = (
-            "ref.:", "ref.", "versión", "version", "pág.", "pag.", "control del documento", "índice", "indice")
-            meta_hits = sum(1 for mt in meta_terms if mt in txt_low)
-            meta_penalty = -8.0 * meta_hits
-
-            # penaliza también fragmentos demasiado cortos (suelen ser cabeceras sueltas)
-            if len((text or "").strip()) < 120:
-                meta_penalty -= 6.0
-
-            score = (base * 10) + (ext_adj * 5) + (fname_bonus * 2) + dom_boost + meta_penalty
-            scored.append((score, text or "", path or ""))
-
-        if not scored:
+        try:
+            picked = self._rag_engine(max_candidates=900).search(query, k=k)
+        except Exception:
+            return ""
+        if not picked:
             return ""
+        self._last_rag_hits = picked
 
-        scored.sort(key=lambda x: -x[0])
-        picked = scored[:max(1, int(k))]
+        if os.getenv("PACQUI_DIAG_RAG", "0") == "1":
+            for h in picked:
+                print(f"[RAG] rrf={h.get('rrf', h['score']):.4f} bm25={h.get('bm25')} (#{h.get('rank_bm25')}) "
+                      f"cos={h.get('cos', 0.0):.3f} (#{h.get('rank_vec')}) heur={h.get('heur')} "
+                      f"(#{h.get('rank_heur')})  {h['path']}")
 
+        from rag_retrieval import cite
         frags, used = [], 0
-        for i, (_, text, path) in enumerate(picked, start=1):
-            t = (text or "").strip()
+        for i, h in enumerate(picked, start=1):
+            t = (h["text"] or "").strip()
             if not t:
                 continue
             if len(t) > 420:
                 t = t[:420] + "…"
 
-            frag = f"[{i}] {t}\n    Fuente: {path}"
+            frag = f"[{i}] {t}\n    Fuente: {cite(h)}"
             if used + len(frag) > max_chars * k:
                 break
             frags.append(frag)
@@ -637,48 +677,21 @@ class LLMService:
     # pacqui_llm_service_FIX3.py  (dentro de class LLMService)
 
     def _trim_to_tokens(self, text: str, max_tokens: int) -> str:
-        if max_tokens <= 0 or not text:
-            return ""
-        toks = self.count_tokens(text)
-        if toks <= max_tokens:
-            return text
-        # recorte por líneas conservador
-        lines = text.splitlines()
-        out = []
-        for ln in lines:
-            out.append(ln)
-            if self.count_tokens("\n".join(out)) > max_tokens:
-                out.pop()
-                break
-        if not out:  # último recurso: por caracteres
-            ratio = max_tokens / max(1, toks)
-            cut = max(64, int(len(text) * ratio))
-            return text[:cut]
-        return "\n".join(out)
+        # cada línea se tokeniza una vez; corte por sumas acumuladas + bisect (token_budget)
+        from token_budget import trim_lines
+        return trim_lines(text, max_tokens, self.count_tokens)
 
     def _shrink_messages(self, messages, budget_in_tokens: int):
         """Intenta recortar SOLO el bloque de contexto del 'user'.
-        Busca [FRAGMENTOS] primero y luego [ÍNDICE]."""
+        Recorta primero [FRAGMENTOS] (desde el final) y, si no basta, todo el 'user'."""
         if not messages:
             return messages
+        from token_budget import trim_section
         msgs = list(messages)
         for i in range(len(msgs) - 1, -1, -1):
             m = msgs[i]
             if m.get("role") == "user":
-                content = m.get("content", "")
-                # prioridad: recortar fragmentos RAG
-                parts = content.split("[FRAGMENTOS]")
-                if len(parts) > 1:
-                    head = parts[0]
-                    rest = "[FRAGMENTOS]".join(parts[1:])
-                    # recorta primero FRAGMENTOS
-                    keep = rest
-                    while self.count_tokens(head + "[FRAGMENTOS]" + keep) > budget_in_tokens and "\n" in keep:
-                        keep = "\n".join(keep.splitlines()[:-4])  # quita 4 líneas por iteración
-                    content = head + "[FRAGMENTOS]" + keep
-                # si sigue pasando, recorta todo el 'user' al presupuesto
-                if self.count_tokens(content) > budget_in_tokens:
-                    content = self._trim_to_tokens(content, budget_in_tokens)
+                content = trim_section(m.get("content", ""), "[FRAGMENTOS]", budget_in_tokens, self.count_tokens)
                 msgs[i] = {"role": "user", "content": content}
                 break
         return msgs
@@ -707,18 +720,19 @@ class LLMService:
             except Exception:
                 pass
 
-            # 3) micro-chat para compilar grafo/KV — SIEMPRE bajo lock
-            # 3) micro-warmup SIN chat-format para compilar grafo/KV — SIEMPRE bajo lock
+            # 3) micro-warmup SIN chat-format para compilar grafo/KV — en el planificador, prioridad mínima
             try:
                 if self.model is not None:
-                    with self._model_lock:
-                        try:
-                            _ = self.model.create_completion(
-                                prompt="ok", max_tokens=1, temperature=0.0
-                            )
-                        except Exception:
-                            # Si tu build no expone 'create_completion', ignora el warmup
-                            pass
+                    from llm_scheduler import Job
+
+                    def _micro(_job):
+                        with self._model_lock:
+                            try:
+                                return self.model.create_completion(prompt="ok", max_tokens=1, temperature=0.0)
+                            except Exception:
+                                # Si tu build no expone 'create_completion', ignora el warmup
+                                return None
+                    self._get_scheduler().submit(Job(_micro, priority="warmup", label="warmup")).result()
             except Exception:
                 pass
 
@@ -728,11 +742,84 @@ class LLMService:
 
     # === PEGAR DENTRO DE class LLMService, sustituyendo a los métodos existentes ===
 
-    def chat(self, messages, temperature: float = 0.3, max_tokens: int = 768, stream: bool = True, stop=None):
-
+    def chat(self, messages, temperature: float = 0.3, max_tokens: int = 768, stream: bool = True, stop=None,
+             priority: str = "chat", cancel=None):
+        """
+        Pasa por el planificador (llm_scheduler): con stream devuelve el iterador de chunks, sin stream
+        espera al resultado. priority: chat > persona > eval > warmup. cancel: CancelToken opcional.
+        """
+        job = self.submit(messages, temperature=temperature, max_tokens=max_tokens, stream=stream, stop=stop,
+                          priority=priority, cancel=cancel)
+        if job is None:                                  # ya estamos en el hilo dueño del modelo
+            return self._chat_job_fn(*self._chat_prepare(messages, temperature, max_tokens, stream, stop))(None)
+        return job.stream() if stream else job.result()
+
+    def submit(self, messages, temperature: float = 0.3, max_tokens: int = 768, stream: bool = True, stop=None,
+               priority: str = "chat", cancel=None):
+        """
+        No bloqueante: encola la petición y devuelve el Job (.result() / .stream() / .cancel()).
+        Devuelve None si se llama desde el propio hilo del planificador (encolar ahí sería esperar a
+        sí mismo): el llamante debe ejecutar en línea, como hace chat().
+        """
+        if not self.model:
+            raise RuntimeError("Modelo no cargado. Elige un .gguf antes de chatear.")
+        sched = self._get_scheduler()
+        if sched.in_worker():
+            return None
+        from llm_scheduler import Job
+        fn = self._chat_job_fn(*self._chat_prepare(messages, temperature, max_tokens, stream, stop))
+        return sched.submit(Job(fn, priority=priority, stream=stream, token=cancel))
+
+    def complete(self, prompt: str, temperature: float = 0.3, max_tokens: int = 768, stream: bool = True,
+                 stop=None, priority: str = "chat", cancel=None):
+        """create_completion (modo instruct, sin plantilla de chat) por el planificador, como chat()."""
         if not self.model:
             raise RuntimeError("Modelo no cargado. Elige un .gguf antes de chatear.")
+        from llm_scheduler import Job, llama_stopping_criteria
+        kw = dict(prompt=prompt, temperature=float(temperature), max_tokens=int(max_tokens), stream=bool(stream))
+        if stop:
+            kw["stop"] = list(stop)
+
+        def _create(job):
+            opts = dict(kw)
+            crit = llama_stopping_criteria(lambda: job.token.cancelled, job.token.mark_stopped) if job else None
+            if crit is not None:
+                opts["stopping_criteria"] = crit
+            try:
+                return self.model.create_completion(**opts)
+            except TypeError as e:
+                if "stopping_criteria" not in str(e) or "stopping_criteria" not in opts:
+                    raise
+                opts.pop("stopping_criteria")
+                return self.model.create_completion(**opts)
+
+        def _run_stream(job):
+            with self._model_lock:
+                yield from _create(job)
 
+        def _run_once(job):
+            with self._model_lock:
+                return _create(job)
+
+        fn = _run_stream if stream else _run_once
+        sched = self._get_scheduler()
+        if sched.in_worker():                            # ya estamos en el hilo dueño del modelo
+            return fn(None)
+        job = sched.submit(Job(fn, priority=priority, stream=stream, token=cancel, label=f"{priority}:completion"))
+        return job.stream() if stream else job.result()
+
+    def _get_scheduler(self):
+        sched = getattr(self, "_scheduler", None)
+        if sched is None:
+            from llm_scheduler import InferenceScheduler
+            sched = self._scheduler = InferenceScheduler(on_cancel=self._on_cancel)
+        return sched
+
+    def scheduler_metrics(self) -> dict:
+        sched = getattr(self, "_scheduler", None)
+        return sched.metrics() if sched is not None else {}
+
+    def _chat_prepare(self, messages, temperature, max_tokens, stream, stop):
         ES_POLICY = ("Eres el asistente de PACqui. Responde SIEMPRE en español neutro. "
                      "Si el usuario escribe en otro idioma, traduce mentalmente y contesta en español.")
 
@@ -754,6 +841,10 @@ class LLMService:
         if not has_es:
             messages = [{"role": "system", "content": ES_POLICY}] + list(messages or [])
 
+        # Prefijo estable: SYSTEM (política/perfil) siempre delante → su KV se reaprovecha entre turnos
+        from prompt_cache import stable_order
+        messages = stable_order(messages)
+
         # Traza de tokens de entrada
         try:
             user_blob = "\n".join(m.get("content", "") for m in messages if m.get("role") == "user")
@@ -762,41 +853,54 @@ class LLMService:
         except Exception:
             pass
 
-        out_tok = int(max_tokens)
-        try:
+        # Opciones comunes (sin 'cache_prompt': llama-cpp-python no lo tiene; el KV lo reutiliza set_cache)
+        opts = dict(
+            messages=messages,
+            temperature=float(temperature),
+            max_tokens=int(max_tokens),
+            stream=bool(stream),
+            # Cortafuegos contra listas/enum repetitivas y clones de apertura
+            repeat_penalty=1.15,
+            stop=stops_list,
+        )
+        return messages, opts
+
+    def _chat_job_fn(self, messages, opts):
+        """Función que ejecuta el hilo dueño del modelo; el lock se mantiene TODA la generación."""
+        from prompt_cache import prefix_key, Turn
+        from llm_scheduler import llama_stopping_criteria
+
+        def _create(job):
+            kw = dict(opts)
+            # el CancelToken entra en el bucle de tokens de llama-cpp: para en 1 token, con o sin stream
+            crit = llama_stopping_criteria(lambda: job.token.cancelled, job.token.mark_stopped) if job else None
+            if crit is not None:
+                kw["stopping_criteria"] = crit
+            try:
+                return self.model.create_chat_completion(**kw)
+            except TypeError as e:
+                # wrapper sin 'stopping_criteria': reintento sin él (sólo si es de lo que se queja)
+                if "stopping_criteria" not in str(e) or "stopping_criteria" not in kw:
+                    raise
+                kw.pop("stopping_criteria")
+                return self.model.create_chat_completion(**kw)
+
+        from speculative import AnswerMeter
+
+        if opts.get("stream"):
+            def _run(job):
+                with self._model_lock:
+                    turn = Turn(self.model, prefix_key(messages), on_done=self._on_turn)
+                    meter = AnswerMeter(self._draft, on_done=self._on_answer)
+                    yield from meter.wrap_stream(turn.wrap_stream(_create(job)))
+            return lambda job: _run(job)
+
+        def _run_once(job):
             with self._model_lock:
-                import inspect
-
-                # Opciones comunes (sin 'cache_prompt')
-                opts = dict(
-                    messages=messages,
-                    temperature=float(temperature),
-                    max_tokens=int(out_tok),
-                    stream=bool(stream),
-                    # Cortafuegos contra listas/enum repetitivas y clones de apertura
-                    repeat_penalty=1.15,
-                    stop=stops_list,
-
-
-                )
-
-                # Solo añadimos 'cache_prompt' si la build lo soporta
-                try:
-                    sig = inspect.signature(self.model.create_chat_completion)
-                    if "cache_prompt" in sig.parameters:
-                        opts["cache_prompt"] = False  # desactivado adrede
-                except Exception:
-                    pass
-
-                try:
-                    return self.model.create_chat_completion(**opts)
-                except TypeError:
-                    # Retry ultra-compatible: sin 'cache_prompt' por si el wrapper no lo admite
-                    opts.pop("cache_prompt", None)
-                    return self.model.create_chat_completion(**opts)
-
-        except (RuntimeError, ValueError) as e:
-            raise
+                turn = Turn(self.model, prefix_key(messages), on_done=self._on_turn)
+                meter = AnswerMeter(self._draft, on_done=self._on_answer)
+                return meter.finish(turn.finish(_create(job)))
+        return _run_once
 
     # --- justo bajo LLMService.chat(...) ---
     def stream_chat(self, *, messages, temperature=0.2, max_tokens=256, stop=None, **kw):
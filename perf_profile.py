@@ -0,0 +1,206 @@
+
+# perf_profile.py — autoajuste de hilos/batch por modelo+máquina, persistido en CONFIG_DIR
+from __future__ import annotations
+import os, sys, json, time, platform, argparse
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+#PACqui 1.3.0
+# _cpu_autotune elegía n_threads por nº de cores y n_batch=192 fijo, sin medir nada; en CPUs con SMT
+# o núcleos P/E lo óptimo suele ser MENOS hilos que cores lógicos, y depende del modelo (cuantización).
+# Aquí se mide:
+#   * pp_tok_s: evaluación del prompt (llm.eval de P tokens, troceado en n_batch);
+#   * tg_tok_s: generación (decodificar de 1 en 1 token, que es lo que cuesta en CPU);
+# y se elige la combinación que minimiza el tiempo de un turno típico
+#       TUNE_PROMPT / pp_tok_s + TUNE_GEN / tg_tok_s     (RAG ≈ 1500 tokens de entrada, 300 de salida)
+# El ganador se guarda en LOCALAPPDATA/PACqui/perf_profile.json con clave modelo (nombre+tamaño) +
+# máquina (host, CPU, cores) y LLMService.load() lo aplica en las cargas siguientes.
+#   - primera carga (PACQUI_AUTOTUNE=1, por defecto): barrido RÁPIDO de hilos sobre el modelo ya
+#     cargado (llama_set_n_threads, sin recargar);
+#   - CLI:  python perf_profile.py --model C:\ruta\modelo.gguf   → barrido completo hilos × n_batch
+#           python perf_profile.py --show
+# PACQUI_THREADS / PACQUI_N_BATCH explícitos siguen mandando sobre el perfil. n_ubatch no se toca
+# (el valor bajo evita 'invalid logits id' en algunas builds Windows).
+
+AUTO = os.getenv("PACQUI_AUTOTUNE", "1") == "1"
+TUNE_PROMPT = int(os.getenv("PACQUI_TUNE_PROMPT", "1500"))
+TUNE_GEN = int(os.getenv("PACQUI_TUNE_GEN", "300"))
+BENCH_PP = 96            # tokens de prompt por medición
+BENCH_TG = 12            # tokens generados por medición
+BATCHES = (128, 192, 256, 512)
+_TEXT = ("El expediente de contratación incluye el pliego de prescripciones técnicas, la memoria "
+         "justificativa y el informe de fiscalización previa de la intervención. ")
+
+
+def profile_path() -> Path:
+    d = Path(os.getenv("LOCALAPPDATA") or Path.home()) / "PACqui"
+    d.mkdir(parents=True, exist_ok=True)
+    return d / "perf_profile.json"
+
+
+def machine_id() -> str:
+    cpu = platform.processor() or platform.machine()
+    return f"{platform.node()}|{cpu}|{os.cpu_count() or 0}"
+
+
+def profile_key(model_path: str) -> str:
+    p = Path(model_path)
+    try:
+        size = p.stat().st_size
+    except Exception:
+        size = 0
+    return f"{p.name.lower()}|{size}|{machine_id()}"
+
+
+def _load_all() -> Dict[str, dict]:
+    try:
+        return json.loads(profile_path().read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+
+
+def get(model_path: str) -> Optional[dict]:
+    return _load_all().get(profile_key(model_path))
+
+
+def save(model_path: str, prof: dict):
+    data = _load_all()
+    data[profile_key(model_path)] = prof
+    try:
+        profile_path().write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    except Exception:
+        pass
+
+
+def apply(perf: dict, prof: Optional[dict], ctx: int) -> dict:
+    """Mezcla el perfil guardado en la salida de _cpu_autotune (las variables de entorno mandan)."""
+    out = dict(perf)
+    if not prof:
+        return out
+    if "PACQUI_THREADS" not in os.environ and prof.get("n_threads"):
+        out["n_threads"] = int(prof["n_threads"])
+    if "PACQUI_N_BATCH" not in os.environ and prof.get("n_batch"):
+        out["n_batch"] = min(int(ctx), int(prof["n_batch"]))
+    return out
+
+
+def thread_candidates(cores: Optional[int] = None) -> List[int]:
+    c = int(cores or os.cpu_count() or 4)
+    cand = {max(1, c // 2), max(1, c - 2), max(1, c - 1), c}
+    return sorted(cand)
+
+
+def turn_seconds(pp: float, tg: float) -> float:
+    return TUNE_PROMPT / max(pp, 1e-6) + TUNE_GEN / max(tg, 1e-6)
+
+
+# ----------------------------------------------------------------------------- medición
+def _set_threads(llm, n: int) -> bool:
+    try:
+        import llama_cpp
+        llama_cpp.llama_set_n_threads(llm._ctx.ctx, int(n), int(n))
+        return True
+    except Exception:
+        return False
+
+
+def bench(llm, n_pp: int = BENCH_PP, n_tg: int = BENCH_TG) -> dict:
+    """pp_tok_s y tg_tok_s con el estado actual del modelo (lo deja reseteado)."""
+    toks = llm.tokenize((_TEXT * 40).encode("utf-8"), add_bos=True)[:n_pp]
+    llm.reset()
+    t = time.perf_counter()
+    llm.eval(toks)
+    pp = len(toks) / max(1e-6, time.perf_counter() - t)
+    t = time.perf_counter()
+    for _ in range(n_tg):
+        llm.eval([toks[-1]])
+    tg = n_tg / max(1e-6, time.perf_counter() - t)
+    llm.reset()
+    return {"pp_tok_s": round(pp, 2), "tg_tok_s": round(tg, 2), "turn_s": round(turn_seconds(pp, tg), 1)}
+
+
+def sweep_threads(llm, n_batch: int, current: int, log: Callable[[str], None] = print) -> List[dict]:
+    """Mide cada nº de hilos candidato sobre el MISMO modelo (sin recargar)."""
+    res = []
+    cands = thread_candidates() if _set_threads(llm, current) else [current]
+    for n in cands:
+        if not _set_threads(llm, n) and n != current:
+            continue
+        try:
+            r = dict(bench(llm), n_threads=n, n_batch=n_batch)
+        except Exception as e:
+            log(f"[AUTOTUNE] hilos={n} batch={n_batch}: error {e}")
+            continue
+        log(f"[AUTOTUNE] hilos={n} batch={n_batch}: prompt {r['pp_tok_s']} tok/s · gen {r['tg_tok_s']} tok/s"
+            f" · turno≈{r['turn_s']} s")
+        res.append(r)
+    return res
+
+
+def _best(results: List[dict]) -> Optional[dict]:
+    return min(results, key=lambda r: r["turn_s"]) if results else None
+
+
+def quick_tune(llm, model_path: str, perf: dict, log: Callable[[str], None] = print) -> Optional[dict]:
+    """Primera carga: barrido de hilos con el n_batch actual; aplica el ganador al modelo y lo guarda."""
+    t0 = time.perf_counter()
+    res = sweep_threads(llm, perf["n_batch"], perf["n_threads"], log)
+    best = _best(res)
+    if best is None:
+        return None
+    _set_threads(llm, best["n_threads"])
+    prof = dict(best, mode="quick", ts=int(time.time()), seconds=round(time.perf_counter() - t0, 1),
+                candidates=res)
+    save(model_path, prof)
+    log(f"[AUTOTUNE] perfil guardado: hilos={best['n_threads']} batch={best['n_batch']}")
+    return prof
+
+
+def full_tune(model_path: str, ctx: int = 1024, log: Callable[[str], None] = print) -> Optional[dict]:
+    """CLI: hilos × n_batch (un Llama por n_batch; los hilos se cambian sin recargar)."""
+    from llama_cpp import Llama
+    from pacqui_llm_service_FIX3 import _cpu_autotune
+    base = _cpu_autotune(ctx)
+    t0 = time.perf_counter()
+    res = []
+    for nb in [b for b in BATCHES if b <= ctx]:
+        try:
+            llm = Llama(model_path=model_path, n_ctx=ctx, n_threads=base["n_threads"], n_batch=nb,
+                        n_ubatch=min(nb, base["n_ubatch"]), n_gpu_layers=0, use_mmap=True, verbose=False)
+        except Exception as e:
+            log(f"[AUTOTUNE] batch={nb}: no carga ({e})")
+            continue
+        try:
+            res += sweep_threads(llm, nb, base["n_threads"], log)
+        finally:
+            try:
+                llm.close()
+            except Exception:
+                pass
+            del llm
+    best = _best(res)
+    if best is None:
+        return None
+    prof = dict(best, mode="full", ts=int(time.time()), seconds=round(time.perf_counter() - t0, 1),
+                candidates=res)
+    save(model_path, prof)
+    log(f"[AUTOTUNE] perfil guardado: hilos={best['n_threads']} batch={best['n_batch']}")
+    return prof
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Autoajuste de hilos/batch de PACqui para un modelo GGUF en esta máquina.")
+    ap.add_argument("--model", help="ruta del .gguf (vuelve a medir y guarda el perfil)")
+    ap.add_argument("--ctx", type=int, default=1024, help="contexto para las mediciones")
+    ap.add_argument("--show", action="store_true", help="muestra los perfiles guardados")
+    a = ap.parse_args(argv)
+    if a.show or not a.model:
+        for k, v in _load_all().items():
+            print(f"{k}\n   hilos={v.get('n_threads')} batch={v.get('n_batch')} prompt={v.get('pp_tok_s')} tok/s "
+                  f"gen={v.get('tg_tok_s')} tok/s ({v.get('mode')})")
+        return
+    if full_tune(a.model, a.ctx) is None:
+        sys.exit("No se pudo medir ninguna combinación.")
+
+
+if __name__ == "__main__":
+    main()
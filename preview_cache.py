@@ -0,0 +1,211 @@
+
+# preview_cache.py — caché en disco de miniaturas de la vista previa del Visor
+from __future__ import annotations
+import os, io, time, hashlib, threading
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+#PACqui 1.3.0
+# _preview_first_page_to_image vuelve a renderizar en cada selección (fitz a 120 dpi, Office COM
+# para DOC/XLS/PPT...). Aquí la imagen resultante se guarda reducida y comprimida en un directorio
+# aparte, con clave (ruta, mtime, tamaño, tamaño objetivo):
+#   * WebP si Pillow lo soporta, si no PNG; escritura atómica (tmp + os.replace);
+#   * LRU por bytes totales (PACQUI_PREVIEW_CACHE_MB): cada acierto "toca" el fichero y al pasarse
+#     del tope se borran los menos usados;
+#   * también se recuerdan los ficheros que no dieron imagen (marcador .none) para no reintentar
+#     la automatización de Office en cada clic; como casi siempre es algo pasajero (Office ocupado,
+#     falta una dependencia, render que no terminó), el marcador caduca a los
+#     PACQUI_PREVIEW_NONE_TTL segundos y se vuelve a intentar.
+
+MAX_BYTES = int(float(os.getenv("PACQUI_PREVIEW_CACHE_MB", "200")) * 1024 * 1024)
+TARGET = (int(os.getenv("PACQUI_PREVIEW_MAX_W", "1000")), int(os.getenv("PACQUI_PREVIEW_MAX_H", "1400")))
+ENABLED = os.getenv("PACQUI_PREVIEW_CACHE", "1") != "0"
+NONE_TTL = float(os.getenv("PACQUI_PREVIEW_NONE_TTL", "900"))
+
+
+def default_dir() -> str:
+    p = os.getenv("PACQUI_PREVIEW_CACHE_DIR")
+    if p:
+        return p
+    return str(Path(os.getenv("LOCALAPPDATA") or Path.home()) / "PACqui" / "preview_cache")
+
+
+class PreviewCache:
+    def __init__(self, root: Optional[str] = None, max_bytes: int = MAX_BYTES, target: Tuple[int, int] = TARGET):
+        self.root = root or default_dir()
+        self.max_bytes = int(max_bytes)
+        self.target = (int(target[0]), int(target[1]))
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._total = None          # bytes en disco (estimado; se recalcula al expulsar)
+        self._ext = None
+
+    # --- clave / ficheros ---
+    def _fmt(self):
+        if self._ext is None:
+            try:
+                from PIL import features
+                self._ext = "webp" if features.check("webp") else "png"
+            except Exception:
+                self._ext = "png"
+        return self._ext
+
+    def _key(self, path: str) -> Optional[str]:
+        try:
+            st = os.stat(path)
+        except Exception:
+            return None
+        mt = int(getattr(st, "st_mtime_ns", int(st.st_mtime * 1e9)))
+        raw = f"{os.path.abspath(path)}|{mt}|{st.st_size}|{self.target[0]}x{self.target[1]}"
+        return hashlib.blake2b(raw.encode("utf-8", "ignore"), digest_size=16).hexdigest()
+
+    def _file(self, key: str, ext: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.{ext}")
+
+    # --- API ---
+    def _none_fresh(self, f: str) -> bool:
+        """El marcador .none guarda su hora de creación (el mtime lo mueve el LRU); caducado → se borra."""
+        try:
+            with open(f, "rb") as fh:
+                created = float(fh.read().decode("ascii") or 0)
+        except Exception:
+            created = 0.0
+        if time.time() - created < NONE_TTL:
+            return True
+        try:
+            os.remove(f)
+        except Exception:
+            pass
+        return False
+
+    def get(self, path: str, count: bool = True):
+        """
+        (True, PIL.Image | None) si hay entrada (None = sabemos que no hay miniatura); (False, None) si no.
+        count=False no suma aciertos/fallos (segunda consulta de la misma petición).
+        """
+        key = self._key(path)
+        found, img = False, None
+        if key is not None:
+            for ext in (self._fmt(), "png", "none"):
+                f = self._file(key, ext)
+                if not os.path.exists(f):
+                    continue
+                if ext == "none":
+                    found = self._none_fresh(f)
+                    break
+                try:
+                    os.utime(f, None)                  # LRU: marca como usado
+                except Exception:
+                    pass
+                try:
+                    from PIL import Image
+                    with open(f, "rb") as fh:
+                        img = Image.open(io.BytesIO(fh.read()))
+                        img.load()
+                    found = True
+                except Exception:
+                    img = None
+                break
+        if count:
+            with self._lock:
+                if found:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return found, img
+
+    def put(self, path: str, img):
+        key = self._key(path)
+        if key is None:
+            return
+        try:
+            if img is None:
+                data, ext = str(time.time()).encode("ascii"), "none"
+            else:
+                img = img.copy()
+                if img.mode not in ("RGB", "RGBA"):
+                    img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+                img.thumbnail(self.target)
+                buf = io.BytesIO()
+                ext = self._fmt()
+                if ext == "webp":
+                    img.save(buf, "WEBP", quality=82, method=4)
+                else:
+                    img.save(buf, "PNG", optimize=True)
+                data = buf.getvalue()
+            f = self._file(key, ext)
+            os.makedirs(os.path.dirname(f), exist_ok=True)
+            tmp = f"{f}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp, f)
+        except Exception:
+            return
+        with self._lock:
+            if self._total is None:
+                self._total = self._scan()[1]
+            else:
+                self._total += len(data)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def get_or_render(self, path: str, render: Callable[[str], object]):
+        """Imagen desde la caché o render(path) (y se guarda, también el 'no hay imagen')."""
+        if not ENABLED:
+            return render(path)
+        found, img = self.get(path)
+        if found:
+            return img
+        img = render(path)
+        self.put(path, img)
+        return img
+
+    def has(self, path: str) -> bool:
+        key = self._key(path)
+        if not key:
+            return False
+        if any(os.path.exists(self._file(key, e)) for e in (self._fmt(), "png")):
+            return True
+        f = self._file(key, "none")
+        return os.path.exists(f) and self._none_fresh(f)
+
+    # --- LRU por bytes ---
+    def _scan(self):
+        files, total = [], 0
+        for d, _dirs, names in os.walk(self.root):
+            for n in names:
+                if n.endswith(".tmp"):
+                    continue
+                f = os.path.join(d, n)
+                try:
+                    st = os.stat(f)
+                except Exception:
+                    continue
+                files.append((st.st_mtime, st.st_size, f)); total += st.st_size
+        return files, total
+
+    def _evict(self):
+        files, total = self._scan()
+        target = int(self.max_bytes * 0.8)
+        for _mt, size, f in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.remove(f); total -= size
+            except Exception:
+                pass
+        self._total = total
+
+    def stats(self) -> dict:
+        files, total = self._scan()
+        return {"hits": self.hits, "misses": self.misses, "entries": len(files), "bytes": total,
+                "max_bytes": self.max_bytes, "dir": self.root}
+
+
+_CACHE: Optional[PreviewCache] = None
+
+
+def get_cache() -> PreviewCache:
+    global _CACHE
+    if _CACHE is None:
+        _CACHE = PreviewCache()
+    return _CACHE
@@ -0,0 +1,166 @@
+
+# prompt_cache.py — reutilización del KV de prefijos estables del prompt (llama-cpp) + métricas por turno
+from __future__ import annotations
+import os, time, hashlib, threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+#PACqui 1.3.0
+# Cada turno volvía a evaluar en CPU la política SYSTEM completa (ES_POLICY + base_sys, cientos de
+# tokens) antes del primer token: chat() pasaba cache_prompt=False y cualquier llamada intermedia
+# (línea de persona, evaluación, warmup) machacaba el estado del modelo. Aquí:
+#   * attach() instala en el Llama una caché de estados (LlamaRAMCache; PACQUI_PROMPT_CACHE=disk →
+#     LlamaDiskCache en LOCALAPPDATA/PACqui/prompt_cache). llama-cpp busca el estado guardado con el
+#     prefijo de tokens más largo y sólo evalúa lo que cambia;
+#   * stable_order() deja los mensajes SYSTEM (política/perfil, invariables) siempre delante y en
+#     orden fijo, para que el prefijo coincida de un turno a otro;
+#   * Turn mide por turno los tokens del prompt, los reaprovechados del prefijo y el tiempo hasta el
+#     primer token (TTFT), y los publica a los oyentes (bus de eventos del front).
+# PACQUI_PROMPT_CACHE=0 lo desactiva; PACQUI_PROMPT_CACHE_MB fija la capacidad.
+
+MODE = os.getenv("PACQUI_PROMPT_CACHE", "ram").lower()
+CAPACITY_MB = int(os.getenv("PACQUI_PROMPT_CACHE_MB", "1024"))
+
+
+def default_dir() -> str:
+    return str(Path(os.getenv("LOCALAPPDATA") or Path.home()) / "PACqui" / "prompt_cache")
+
+
+def attach(model, mode: str = MODE, capacity_mb: int = CAPACITY_MB) -> str:
+    """Instala la caché de estados en `model`. Devuelve el modo efectivo ('ram', 'disk' u 'off')."""
+    if model is None or mode in ("0", "off", "no", "false"):
+        return "off"
+    try:
+        import llama_cpp
+        cap = int(capacity_mb) * 1024 * 1024
+        if mode == "disk":
+            cache = llama_cpp.LlamaDiskCache(cache_dir=default_dir(), capacity_bytes=cap)
+        else:
+            cache = llama_cpp.LlamaRAMCache(capacity_bytes=cap)
+            mode = "ram"
+        model.set_cache(cache)
+        return mode
+    except Exception:
+        return "off"
+
+
+def stable_order(messages: List[dict]) -> List[dict]:
+    """SYSTEM primero (en su orden relativo), luego el resto: el prefijo estable queda delante."""
+    msgs = list(messages or [])
+    sys_ = [m for m in msgs if m.get("role") == "system"]
+    return sys_ + [m for m in msgs if m.get("role") != "system"]
+
+
+def prefix_key(messages: List[dict]) -> str:
+    """Identidad del prefijo estable (perfil/política): hash de los mensajes SYSTEM."""
+    h = hashlib.blake2b(digest_size=8)
+    for m in messages or []:
+        if m.get("role") == "system":
+            h.update((m.get("content") or "").encode("utf-8", "ignore")); h.update(b"\0")
+    return h.hexdigest()
+
+
+def _lcp(a, b) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _ids(model) -> list:
+    """Tokens ya evaluados: Llama.input_ids es el búfer entero (n_ctx); sólo vale [:n_tokens]."""
+    try:
+        ids = model.input_ids
+        n = getattr(model, "n_tokens", None)
+        if n is not None:
+            ids = ids[:int(n)]
+        return ids.tolist() if hasattr(ids, "tolist") else list(ids)
+    except Exception:
+        return []
+
+
+class Turn:
+    """
+    Medición de un turno: se crea justo antes de llamar al modelo (foto del estado/caché) y se
+    cierra en el primer token (stream) o al terminar (sin stream).
+    """
+
+    def __init__(self, model, key: str, on_done: Optional[Callable[[dict], None]] = None):
+        self.model = model
+        self.key = key
+        self.on_done = on_done
+        self.t0 = time.perf_counter()
+        self.stats: Dict = {}
+        self._prev = _ids(model)
+        self._keys = []
+        try:
+            cs = getattr(getattr(model, "cache", None), "cache_state", None)
+            if cs:
+                self._keys = list(cs.keys())
+        except Exception:
+            pass
+
+    def first_token(self, n_prompt: Optional[int] = None):
+        if self.stats:
+            return self.stats
+        ttft = time.perf_counter() - self.t0
+        ids = _ids(self.model)
+        if n_prompt:
+            ids = ids[:int(n_prompt)]
+        hit = _lcp(self._prev, ids)
+        for k in self._keys:
+            hit = max(hit, _lcp(k, ids))
+        self.stats = {"prefix": self.key, "prompt_tokens": len(ids), "prefix_hit_tokens": min(hit, len(ids)),
+                      "ttft_s": round(ttft, 3)}
+        if self.on_done:
+            try:
+                self.on_done(self.stats)
+            except Exception:
+                pass
+        return self.stats
+
+    def wrap_stream(self, stream):
+        """Generador transparente que marca el primer chunk."""
+        first = True
+        for ch in stream:
+            if first:
+                first = False
+                self.first_token()
+            yield ch
+
+    def finish(self, resp):
+        n = None
+        try:
+            n = int(resp["usage"]["prompt_tokens"])
+        except Exception:
+            pass
+        self.first_token(n)
+        return resp
+
+
+class PromptCacheStats:
+    """Acumulado por prefijo (perfil) para diagnóstico: turnos, tokens reaprovechados, TTFT medio."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.by_prefix: Dict[str, dict] = {}
+        self.last: Dict = {}
+
+    def record(self, st: dict):
+        with self._lock:
+            self.last = dict(st)
+            d = self.by_prefix.setdefault(st.get("prefix", ""), {"turns": 0, "prompt_tokens": 0,
+                                                                  "hit_tokens": 0, "ttft_s": 0.0})
+            d["turns"] += 1
+            d["prompt_tokens"] += int(st.get("prompt_tokens") or 0)
+            d["hit_tokens"] += int(st.get("prefix_hit_tokens") or 0)
+            d["ttft_s"] += float(st.get("ttft_s") or 0.0)
+
+    def summary(self) -> dict:
+        with self._lock:
+            out = {}
+            for k, d in self.by_prefix.items():
+                t = max(1, d["turns"])
+                out[k] = {"turns": d["turns"], "hit_ratio": round(d["hit_tokens"] / max(1, d["prompt_tokens"]), 3),
+                          "avg_ttft_s": round(d["ttft_s"] / t, 3)}
+            return out
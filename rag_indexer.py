@@ -0,0 +1,574 @@
+
+# rag_indexer.py — pipeline de indexación RAG (extraer → trocear → embeber → escribir en SQLite)
+from __future__ import annotations
+import os, time, queue, pickle, hashlib, sqlite3, threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+#PACqui 1.3.0
+# Antes cada chunk se embebía suelto (st_model.encode(chunk) por chunk): se tiraba el batching
+# de sentence-transformers. Aquí los chunks de VARIOS ficheros se acumulan y se embeben en lotes
+# de PACQUI_EMBED_BATCH en un pool de PACQUI_EMBED_WORKERS hilos (por defecto, nº de cores),
+# y el ritmo (chunks/s) se publica en el progreso del escaneo.
+# La extracción (PDF/DOCX/XLSX, CPU-bound) va en un pool de procesos, los embeddings en su hilo
+# y un único escritor SQLite inserta con executemany; colas acotadas entre etapas.
+
+EMBED_BATCH = int(os.getenv("PACQUI_EMBED_BATCH", "64"))
+EMBED_WORKERS = int(os.getenv("PACQUI_EMBED_WORKERS", str(os.cpu_count() or 2)))
+EXTRACT_WORKERS = int(os.getenv("PACQUI_EXTRACT_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+QUEUE_MAX = int(os.getenv("PACQUI_RAG_QUEUE", "64"))            # ficheros troceados en espera de embeber
+COMMIT_EVERY = int(os.getenv("PACQUI_RAG_COMMIT_EVERY", "25"))  # ficheros por commit
+INLINE_MAX = int(os.getenv("PACQUI_RAG_INLINE_MAX", "1"))     # hasta N ficheros: sin pools ni hilos
+
+
+# ----------------------------------------------------------------------------- embedders
+def _hash_embedder_dict() -> dict:
+    from hash_embedder import hash_embed, encode_many
+    return {"encode": lambda t: hash_embed(t, dim=256),
+            "encode_many": lambda ts: encode_many(ts, dim=256),
+            "dim": 256, "backend": "hash", "sig": "hash:256"}
+
+
+def st_embedder_dict(model_path: str, batch_size: int = EMBED_BATCH) -> dict:
+    """Sentence-Transformers con encode por lotes (normalize_embeddings=True)."""
+    from sentence_transformers import SentenceTransformer
+    st_model = SentenceTransformer(model_path)
+    dim = int(getattr(st_model, "get_sentence_embedding_dimension", lambda: 384)())
+
+    def _encode_many(texts):
+        M = st_model.encode([t or "" for t in texts], batch_size=int(batch_size),
+                            normalize_embeddings=True, show_progress_bar=False)
+        return [v.tolist() if hasattr(v, "tolist") else list(map(float, v)) for v in M]
+
+    def _encode(text):
+        return _encode_many([text])[0]
+
+    from text_chunker import st_token_counter
+    return {"encode": _encode, "encode_many": _encode_many, "dim": dim, "backend": "st",
+            "sig": f"st:{dim}:{model_path}", "count_tokens": st_token_counter(st_model)}
+
+
+def default_embedder() -> dict:
+    """Mismo criterio que LLMService: PACQUI_FORCE_HASH=1 (defecto) → hash:256; si no, ST local."""
+    if os.getenv("PACQUI_FORCE_HASH", "1") == "1":
+        return _hash_embedder_dict()
+    try:
+        model = os.getenv("PACQUI_EMBED_DIR", "") or os.getenv("PACQUI_EMBED_MODEL",
+                                                             "sentence-transformers/all-MiniLM-L6-v2")
+        return st_embedder_dict(model)
+    except Exception:
+        return _hash_embedder_dict()
+
+
+def _encode_many_fn(embedder: dict):
+    """encode_many del embedder (o encode texto a texto si no lo tiene)."""
+    enc_many = embedder.get("encode_many")
+    if callable(enc_many):
+        return enc_many
+    enc = embedder["encode"]
+    return lambda ts: [enc(t) for t in ts]
+
+
+# ----------------------------------------------------------------------------- lotes
+class BatchEmbedder:
+    """
+    Embebe lotes de textos en un pool de hilos conservando el orden de llegada.
+      be = BatchEmbedder(embedder)
+      be.submit(payload, textos) ...; for payload, vecs in be.ready(): ...
+      for payload, vecs in be.finish(): ...
+    Como mucho 2×workers lotes en vuelo (contrapresión sobre el productor).
+    """
+
+    def __init__(self, embedder: dict, workers: int = EMBED_WORKERS):
+        self._encode_many = _encode_many_fn(embedder)
+        self.workers = max(1, int(workers))
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="rag-embed")
+        self._inflight = deque()
+        self.chunks = 0
+        self.embed_s = 0.0
+        self.t0 = time.perf_counter()
+
+    def _run(self, texts):
+        t = time.perf_counter()
+        vecs = self._encode_many(texts) if texts else []
+        return vecs, time.perf_counter() - t
+
+    def _collect(self, item):
+        payload, fut = item
+        vecs, dt = fut.result()
+        self.chunks += len(vecs)
+        self.embed_s += dt
+        return payload, vecs
+
+    def submit(self, payload, texts: List[str]):
+        self._inflight.append((payload, self._pool.submit(self._run, list(texts))))
+
+    def ready(self):
+        """Resultados ya terminados (en orden). Si hay demasiados lotes en vuelo, espera al más antiguo."""
+        out = []
+        while self._inflight and (self._inflight[0][1].done() or len(self._inflight) > 2 * self.workers):
+            out.append(self._collect(self._inflight.popleft()))
+        return out
+
+    def finish(self):
+        out = []
+        while self._inflight:
+            out.append(self._collect(self._inflight.popleft()))
+        return out
+
+    def close(self):
+        try:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        except Exception:
+            pass
+
+    @property
+    def rate(self) -> float:
+        """chunks/s desde el arranque (reloj de pared)."""
+        return self.chunks / max(1e-6, time.perf_counter() - self.t0)
+
+
+# ----------------------------------------------------------------------------- SQLite
+def ensure_schema(conn):
+    from rag_retrieval import ensure_store_schema
+    ensure_store_schema(conn)
+    c = conn.cursor()
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chunks_path ON chunks(file_path)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chunks_mtime ON chunks(mtime)")
+    # huella por fichero: si (size, mtime) o el hash rápido no cambian, no se reindexa
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS rag_files(
+            file_path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            fhash TEXT,
+            n_chunks INTEGER DEFAULT 0,
+            indexed_at TEXT DEFAULT (datetime('now'))
+        )
+    """)
+    conn.commit()
+    try:
+        from rag_retrieval import ensure_fts
+        ensure_fts(conn)
+    except Exception:
+        pass
+
+
+def check_signature(conn, embedder: dict) -> bool:
+    """Si el índice se creó con otro backend/dim, purga vectores y huellas. True si hubo purga."""
+    from rag_retrieval import rag_meta_get, rag_meta_set
+    sig = embedder.get("sig", "")
+    if rag_meta_get(conn, "embedding_sig") == sig:
+        return False
+    conn.execute("DELETE FROM embeddings")
+    conn.execute("DELETE FROM chunk_vecs")
+    conn.execute("DELETE FROM rag_files")   # todo debe re-embeberse con el nuevo backend
+    rag_meta_set(conn, "embedding_sig", sig)
+    return True
+
+
+def fast_file_hash(path: str, sample: int = 65536) -> str:
+    """Hash rápido de contenido: tamaño + primeros y últimos `sample` bytes (blake2b)."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        h.update(str(size).encode())
+        f.seek(0)
+        h.update(f.read(sample))
+        if size > sample:
+            f.seek(max(sample, size - sample))
+            h.update(f.read(sample))
+    return h.hexdigest()
+
+
+def _db_file(conn) -> str:
+    try:
+        for _seq, name, fname in conn.execute("PRAGMA database_list"):
+            if name == "main":
+                return fname or ""
+    except Exception:
+        pass
+    return ""
+
+
+def _known_vec_hashes(side, hashes: Sequence[str]) -> set:
+    found = set()
+    if side is None or not hashes:
+        return found
+    hs = list(hashes)
+    for i in range(0, len(hs), 500):
+        part = hs[i:i + 500]
+        try:
+            found.update(r[0] for r in side.execute(
+                "SELECT chash FROM chunk_vecs WHERE chash IN (%s)" % ",".join("?" * len(part)), part))
+        except Exception:
+            break
+    return found
+
+
+def gc_chunk_vecs(conn, hashes: Optional[Iterable[str]] = None) -> int:
+    """
+    Borra vectores que ya no referencia ningún chunk. Con `hashes` sólo mira esos (los que tenían
+    los ficheros reemplazados; usa idx_chunks_chash); sin ellos, barrido completo (mantenimiento).
+    """
+    if hashes is None:
+        cur = conn.execute("DELETE FROM chunk_vecs WHERE chash NOT IN "
+                           "(SELECT chash FROM chunks WHERE chash IS NOT NULL)")
+        conn.commit()
+        return cur.rowcount or 0
+    hs, n = [h for h in set(hashes) if h], 0
+    for i in range(0, len(hs), 500):
+        part = hs[i:i + 500]
+        marks = ",".join("?" * len(part))
+        cur = conn.execute(f"DELETE FROM chunk_vecs WHERE chash IN ({marks}) AND chash NOT IN "
+                           f"(SELECT chash FROM chunks WHERE chash IN ({marks}))", part + part)
+        n += cur.rowcount or 0
+    conn.commit()
+    return n
+
+
+def _timed_extract(extract, path):
+    """Se ejecuta en el proceso/hilo de extracción: devuelve (texto, segundos)."""
+    t = time.perf_counter()
+    try:
+        txt = extract(path) or ""
+    except Exception:
+        txt = ""
+    return txt, time.perf_counter() - t
+
+
+def _picklable(fn) -> bool:
+    try:
+        pickle.dumps(fn)
+        return True
+    except Exception:
+        return False
+
+
+_END = object()
+
+
+def index_files(conn, items: Iterable[Tuple[str, float]], extract: Callable[[str], str],
+                chunker: Callable[[str], Sequence[str]], embedder: Optional[dict] = None,
+                cancel_event=None, progress: Optional[Callable[[str, object], None]] = None,
+                extract_workers: int = EXTRACT_WORKERS, force: bool = False,
+                chunker_sig: str = "") -> dict:
+    """
+    Indexa en RAG una lista de (ruta, mtime) con un pipeline de tres etapas:
+
+      huella (size, mtime, hash rápido) → extracción (ProcessPool si `extract` es una función
+        de módulo; si no, hilos) + troceado
+        → cola acotada → hilo de embeddings (lotes que cruzan ficheros, pool BatchEmbedder;
+          sólo textos cuyo chash aún no está en chunk_vecs)
+        → cola acotada → escritor único SQLite (este hilo) con executemany
+
+    Con un solo fichero (o INLINE_MAX) no se montan pools ni hilos: las mismas etapas se
+    ejecutan seguidas en este hilo (el Visor indexa así fichero a fichero).
+    Ficheros sin cambios (misma huella en rag_files) se saltan salvo force=True o si cambia
+    chunker_sig (otro troceado → hay que volver a trocear todo). Si la extracción falla o no da
+    texto no se guarda huella (y las de índices antiguos con n_chunks=0 no cuentan): se reintenta.
+    El chunker puede devolver str o text_chunker.Chunk (offsets y títulos se guardan por chunk).
+    Las colas acotadas dan contrapresión; cancel_event detiene todas las etapas.
+    Los vectores huérfanos se purgan una vez al final, sólo entre los chash de los ficheros reemplazados.
+    progress(kind, payload): ("file", ruta) · ("status", texto con chunks/s y tiempos) · ("msg", texto)
+    Devuelve {'files','chunks','skipped','dedup','seconds','chunks_per_s',
+              'embed_s','extract_s','chunk_s','write_s','cancelled'}.
+    """
+    from rag_retrieval import chunk_hash, vec_to_blob
+    from doc_extract import split_pages
+    embedder = embedder or default_embedder()
+    ensure_schema(conn)
+    if check_signature(conn, embedder) and progress:
+        progress("msg", f"RAG: firma embeddings cambiada → {embedder.get('sig')}. Reindexando…")
+
+    if chunker_sig:
+        from rag_retrieval import rag_meta_get, rag_meta_set
+        if rag_meta_get(conn, "chunker_sig") != chunker_sig:
+            conn.execute("DELETE FROM rag_files")
+            rag_meta_set(conn, "chunker_sig", chunker_sig)
+
+    items = list(items)
+    inline = len(items) <= INLINE_MAX
+    if force:
+        known = {}
+    elif inline:
+        known = {r[0]: (r[1], r[2], r[3]) for r in conn.execute(
+            "SELECT file_path, size, mtime, fhash FROM rag_files WHERE n_chunks > 0 AND file_path IN (%s)"
+            % ",".join("?" * len(items)), [p for p, _m in items])} if items else {}
+    else:
+        known = {r[0]: (r[1], r[2], r[3]) for r in
+                 conn.execute("SELECT file_path, size, mtime, fhash FROM rag_files WHERE n_chunks > 0")}
+    t0 = time.perf_counter()
+    stop = threading.Event()
+    times = {"extract_s": 0.0, "chunk_s": 0.0, "embed_s": 0.0, "write_s": 0.0}
+    counters = {"skipped": 0, "dedup": 0}
+    errors: List[BaseException] = []
+
+    def cancelled() -> bool:
+        return stop.is_set() or (cancel_event is not None and cancel_event.is_set())
+
+    def probe(path, mtime):
+        """Huella del fichero: None si no existe o no ha cambiado; (mtime, huella, ¿extraer?) si no."""
+        try:
+            st = os.stat(path)
+            size, mt = int(st.st_size), float(mtime or st.st_mtime)
+        except Exception:
+            return None
+        old = known.get(path)
+        if old and old[0] == size and old[1] == mt:
+            counters["skipped"] += 1
+            return None
+        try:
+            fh = fast_file_hash(path)
+        except Exception:
+            fh = ""
+        if old and fh and old[2] == fh:
+            # mismo contenido, sólo ha cambiado el mtime → actualizar huella
+            counters["skipped"] += 1
+            return mt, (size, mt, fh), False
+        return mt, (size, mt, fh), True
+
+    def chunk_item(path, mtime, fp, txt, dt):
+        times["extract_s"] += dt
+        t = time.perf_counter()
+        chunks, pages = [], []
+        # PDFs: texto con páginas separadas por "\f" → se trocea página a página y
+        # cada chunk recuerda su nº de página (citas "p. N")
+        for pg, seg in (split_pages(txt, path) if txt else ()):
+            for ch in (chunker(seg) if seg else ()):
+                chunks.append(ch); pages.append(pg)
+        times["chunk_s"] += time.perf_counter() - t
+        return path, mtime, chunks, fp + (pages,)
+
+    # --- escritor (común a ambos caminos) ---
+    c = conn.cursor()
+    w = {"files": 0, "chunks": 0, "since_commit": 0, "next_id": None}
+    old_hashes: set = set()
+
+    def write_group(group, hashes, pending, vecs):
+        t = time.perf_counter()
+        try:
+            if w["next_id"] is None:
+                w["next_id"] = int(c.execute("SELECT COALESCE(MAX(id), 0) FROM chunks").fetchone()[0]) + 1
+            changed = [(p,) for p, _m, chunks, _f in group if chunks is not None]
+            for (p,) in changed:
+                old_hashes.update(r[0] for r in c.execute(
+                    "SELECT chash FROM chunks WHERE file_path=? AND chash IS NOT NULL", (p,)))
+            c.executemany("DELETE FROM embeddings WHERE chunk_id IN (SELECT id FROM chunks WHERE file_path=?)", changed)
+            c.executemany("DELETE FROM chunks WHERE file_path=?", changed)
+            rows_c = []
+            for (path, mtime, chunks, fp), hs in zip(group, hashes):
+                pages = fp[3] if len(fp) > 3 else ()
+                for j, (ch, h) in enumerate(zip(chunks or (), hs)):
+                    rows_c.append((w["next_id"], path, float(mtime or 0.0), str(ch), h,
+                                   pages[j] if j < len(pages) else None,
+                                   getattr(ch, "start", None), getattr(ch, "end", None),
+                                   getattr(ch, "heading", None) or None))
+                    w["next_id"] += 1
+            c.executemany("INSERT INTO chunks(id, file_path, mtime, text, chash, page, start_off, end_off, heading) "
+                          "VALUES(?,?,?,?,?,?,?,?,?)", rows_c)
+            c.executemany("INSERT OR IGNORE INTO chunk_vecs(chash, vec) VALUES(?,?)",
+                          [(h, vec_to_blob(v)) for h, v in zip(pending, vecs)])
+            # extracción fallida o vacía (timeout, OCR pendiente, fichero bloqueado…) → sin huella,
+            # para que el próximo escaneo lo vuelva a intentar en vez de saltarlo para siempre
+            c.executemany("DELETE FROM rag_files WHERE file_path=?",
+                          [(p,) for p, _m, chunks, _f in group if chunks is not None and not chunks])
+            c.executemany("INSERT OR REPLACE INTO rag_files(file_path, size, mtime, fhash, n_chunks, indexed_at) "
+                          "VALUES(?,?,?,?,?,datetime('now'))",
+                          [(p, fp[0], fp[1], fp[2], len(chunks) if chunks is not None else
+                            (c.execute("SELECT COUNT(*) FROM chunks WHERE file_path=?", (p,)).fetchone()[0]))
+                           for p, _m, chunks, fp in group if chunks is None or chunks])
+            w["files"] += len(changed); w["since_commit"] += len(group); w["chunks"] += len(rows_c)
+            if w["since_commit"] >= COMMIT_EVERY:
+                conn.commit(); w["since_commit"] = 0
+            return True
+        except Exception as e:
+            errors.append(e); stop.set()
+            return False
+        finally:
+            times["write_s"] += time.perf_counter() - t
+
+    def run_inline():
+        """Pocos ficheros: extraer, trocear, embeber y escribir en este hilo (sin pools, colas ni hilos)."""
+        encode_many = _encode_many_fn(embedder)
+        for path, mtime in items:
+            if cancelled():
+                break
+            pr = probe(path, mtime)
+            if pr is None:
+                continue
+            mt, fp, needs_extract = pr
+            it = chunk_item(path, mt, fp, *_timed_extract(extract, path)) if needs_extract else (path, mt, None, fp)
+            hs = [chunk_hash(ch) for ch in (it[2] or ())]
+            flat = dict(zip(hs, it[2] or ()))
+            have = _known_vec_hashes(conn, list(flat))
+            pending = [h for h in flat if h not in have]
+            counters["dedup"] += len(hs) - len(pending)
+            t = time.perf_counter()
+            vecs = encode_many([flat[h] for h in pending]) if pending else []
+            times["embed_s"] += time.perf_counter() - t
+            if cancelled() or not write_group([it], [hs], pending, vecs):
+                break
+            if progress:
+                progress("file", path)
+
+    def run_pipelined():
+        """Muchos ficheros: extracción en pool → hilo de embeddings → escritor (este hilo), colas acotadas."""
+        q_chunks: queue.Queue = queue.Queue(maxsize=QUEUE_MAX)                 # (ruta, mtime, [chunks]|None, huella)
+        q_write: queue.Queue = queue.Queue(maxsize=max(2, QUEUE_MAX // 8))     # ((grupo, hashes, nuevos), vecs)
+
+        def put(q, item):
+            while not cancelled():
+                try:
+                    q.put(item, timeout=0.2)
+                    return
+                except queue.Full:
+                    continue
+
+        # --- etapa 1: huella + extracción + troceado ---
+        def extract_stage():
+            workers = max(1, int(extract_workers))
+            Pool = ProcessPoolExecutor if (workers > 1 and _picklable(extract)) else ThreadPoolExecutor
+            try:
+                with Pool(max_workers=workers) as pool:
+                    inflight = deque()
+
+                    def drain_one():
+                        (path, mtime, fp), fut = inflight.popleft()
+                        try:
+                            txt, dt = fut.result()
+                        except Exception:
+                            txt, dt = "", 0.0
+                        put(q_chunks, chunk_item(path, mtime, fp, txt, dt))
+
+                    for path, mtime in items:
+                        if cancelled():
+                            break
+                        pr = probe(path, mtime)
+                        if pr is None:
+                            continue
+                        mt, fp, needs_extract = pr
+                        if not needs_extract:
+                            put(q_chunks, (path, mt, None, fp))
+                            continue
+                        inflight.append(((path, mt, fp), pool.submit(_timed_extract, extract, path)))
+                        if len(inflight) >= 2 * workers:
+                            drain_one()
+                    while inflight and not cancelled():
+                        drain_one()
+                    for _it, fut in inflight:
+                        fut.cancel()
+            except Exception as e:
+                errors.append(e); stop.set()
+            finally:
+                q_chunks.put(_END)
+
+        # --- etapa 2: embeddings por lotes (sólo textos nuevos) ---
+        be = BatchEmbedder(embedder)
+        db_file = _db_file(conn)
+
+        def embed_stage():
+            side = None
+            if db_file:
+                try:
+                    side = sqlite3.connect(db_file, timeout=5.0)
+                except Exception:
+                    side = None
+            seen = set()
+            group, n = [], 0
+            try:
+                def flush():
+                    nonlocal group, n
+                    if group:
+                        hashes = [[chunk_hash(ch) for ch in (chunks or ())] for _p, _m, chunks, _f in group]
+                        flat = {h: ch for (_p, _m, chunks, _f), hs in zip(group, hashes)
+                                for h, ch in zip(hs, chunks or ())}
+                        pending = [h for h in flat if h not in seen]
+                        have = _known_vec_hashes(side, pending)
+                        pending = [h for h in pending if h not in have]
+                        seen.update(flat)
+                        counters["dedup"] += sum(len(hs) for hs in hashes) - len(pending)
+                        be.submit((group, hashes, pending), [flat[h] for h in pending])
+                        group, n = [], 0
+                    for payload, vecs in be.ready():
+                        put(q_write, (payload, vecs))
+
+                while True:
+                    it = q_chunks.get()
+                    if it is _END:
+                        break
+                    if cancelled():
+                        continue
+                    group.append(it); n += len(it[2] or ())
+                    if n >= EMBED_BATCH:
+                        flush()
+                if not cancelled():
+                    flush()
+                    for payload, vecs in be.finish():
+                        put(q_write, (payload, vecs))
+            except Exception as e:
+                errors.append(e); stop.set()
+            finally:
+                times["embed_s"] = be.embed_s
+                if side is not None:
+                    try: side.close()
+                    except Exception: pass
+                q_write.put(_END)
+
+        th_x = threading.Thread(target=extract_stage, name="rag-extract", daemon=True)
+        th_e = threading.Thread(target=embed_stage, name="rag-embed", daemon=True)
+        th_x.start(); th_e.start()
+
+        # --- etapa 3: escritor único (este hilo) ---
+        last_report = 0.0
+        try:
+            while True:
+                it = q_write.get()
+                if it is _END:
+                    break
+                if cancelled():
+                    continue
+                (group, hashes, pending), vecs = it
+                if not write_group(group, hashes, pending, vecs):
+                    continue
+                if progress:
+                    for p, _m, _c, _f in group:
+                        progress("file", p)
+                    now = time.perf_counter()
+                    if now - last_report > 0.5:
+                        last_report = now
+                        rate = w["chunks"] / max(1e-6, now - t0)
+                        progress("status", f"RAG: {w['files'] + counters['skipped']}/{len(items)} ficheros · "
+                                           f"{w['chunks']} chunks · {rate:0.1f} chunks/s")
+        finally:
+            stop.set()  # libera a los productores si el escritor salió antes de tiempo
+            th_x.join(timeout=5.0); th_e.join(timeout=5.0)
+            be.close()
+
+    if inline:
+        run_inline()
+    else:
+        run_pipelined()
+    was_cancelled = bool(cancel_event is not None and cancel_event.is_set())
+    conn.commit()
+    if old_hashes:
+        try:
+            gc_chunk_vecs(conn, old_hashes)
+        except Exception:
+            pass
+
+    dt = time.perf_counter() - t0
+    files, chunks_written = w["files"], w["chunks"]
+    stats = {"files": files, "chunks": chunks_written, "skipped": counters["skipped"],
+             "dedup": counters["dedup"], "seconds": dt,
+             "chunks_per_s": chunks_written / max(1e-6, dt), "cancelled": was_cancelled}
+    stats.update(times)
+    if progress:
+        progress("status", f"RAG: {chunks_written} chunks en {dt:0.1f}s · {stats['chunks_per_s']:0.1f} chunks/s "
+                           f"· {stats['skipped']} sin cambios · {stats['dedup']} chunks reutilizados "
+                           f"(extraer {times['extract_s']:0.1f}s · trocear {times['chunk_s']:0.1f}s · "
+                           f"embeber {times['embed_s']:0.1f}s · escribir {times['write_s']:0.1f}s)")
+        if errors:
+            progress("msg", f"RAG: errores en el pipeline: {errors[0]!r}")
+    return stats
@@ -0,0 +1,609 @@
+
+# rag_retrieval.py — motor único de recuperación RAG sobre chunks/embeddings (SQLite)
+from __future__ import annotations
+import os, re, math, heapq, hashlib, sqlite3, operator, threading
+from array import array
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+#PACqui 1.3.0
+# Un solo camino caliente para las tres rutas de recuperación que había en PACqui:
+#   - OrganizadorFrame._retrieve_context        (Visor, escaneo completo)
+#   - __RAG__retrieve_context                   (monkey-patch, filtro por carpeta base)
+#   - LLMService._rag_retrieve                  (preselección LIKE + heurísticas de dominio)
+#
+# Piezas:
+#   * Generador de candidatos enchufable: "lexical" | "bm25" | "vector" | "hybrid"
+#   * Reranker enchufable: cosine_rerank (coseno puro) | heuristic_rerank (PAC/MIC, extensiones…)
+#     | rrf_rerank (fusión por rangos BM25 + coseno + heurística, con desglose de puntuaciones)
+#   * Índice léxico BM25 con FTS5 (chunks_fts, sincronizado por triggers con chunks).
+#   * Almacén direccionado por contenido: chunks.chash → chunk_vecs(chash, vec). Un texto idéntico
+#     (copias del mismo documento en varias carpetas) se embebe y guarda UNA vez. Los índices
+#     antiguos siguen leyéndose de embeddings(chunk_id, vec).
+#   * Vectores guardados YA normalizados (norma 1): el coseno es un producto escalar.
+#     ensure_unit_norm() migra una sola vez índices antiguos y lo marca en rag_meta.
+#   * prepare_db(): esquema + migración a norma 1 + FTS5 UNA vez por BD y proceso (no en cada consulta).
+
+TOKEN_RE = re.compile(r"[A-Za-zÁÉÍÓÚÜáéíóúüÑñ0-9]{3,}")
+
+QUERY_STOP = {"para", "con", "por", "unos", "unas", "este", "esta", "esto", "sobre", "desde", "hasta",
+              "entre", "que", "como", "cual", "cuales", "de", "la", "el", "los", "las", "y", "o", "u",
+              "del", "al"}
+
+UNIT_NORM_KEY = "vec_unit_norm"
+
+# Filas de candidatos: (chunk_id, text, file_path, vec_blob[, bm25])
+Row = tuple
+
+RRF_K = int(os.getenv("PACQUI_RRF_K", "60"))
+
+
+# ----------------------------------------------------------------------------- vectores
+def vec_to_blob(v: Sequence[float]) -> bytes:
+    return array('f', [float(x) for x in v]).tobytes()
+
+
+def blob_to_vec(b) -> array:
+    a = array('f')
+    if isinstance(b, (bytes, bytearray, memoryview)):
+        a.frombytes(bytes(b)[: (len(b) // 4) * 4])
+    elif b:
+        a.extend(float(x) for x in b)
+    return a
+
+
+def unit_norm(v: Sequence[float]) -> List[float]:
+    n = math.sqrt(sum(x * x for x in v)) or 1.0
+    return [x / n for x in v]
+
+
+def _dot_many(qv: Sequence[float], blobs: List) -> List[float]:
+    """Producto escalar de la query contra muchos vectores (NumPy si está, si no Python puro)."""
+    if not blobs:
+        return []
+    try:
+        import numpy as np
+        dim = len(qv)
+        if all(isinstance(b, (bytes, bytearray)) and len(b) == dim * 4 for b in blobs):
+            M = np.frombuffer(b"".join(blobs), dtype="<f4").reshape(len(blobs), dim)
+            return (M @ np.asarray(qv, dtype="<f4")).tolist()
+    except Exception:
+        pass
+    mul = operator.mul
+    return [sum(map(mul, qv, blob_to_vec(b))) for b in blobs]
+
+
+def rag_meta_get(conn, key: str, default=None):
+    try:
+        c = conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS rag_meta(key TEXT PRIMARY KEY, value TEXT)")
+        row = c.execute("SELECT value FROM rag_meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else default
+    except Exception:
+        return default
+
+
+def rag_meta_set(conn, key: str, value: str):
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS rag_meta(key TEXT PRIMARY KEY, value TEXT)")
+    c.execute("INSERT INTO rag_meta(key, value) VALUES(?,?) "
+              "ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value))
+    conn.commit()
+
+
+def ensure_unit_norm(conn, batch: int = 2000) -> int:
+    """
+    Migra (una sola vez por BD) los embeddings a norma 1 para que la recuperación
+    no tenga que normalizar cada vector en cada consulta. Devuelve nº de vectores reescritos.
+    """
+    try:
+        if rag_meta_get(conn, UNIT_NORM_KEY) == "1":
+            return 0
+        c = conn.cursor()
+        fixed, last = 0, -1
+        while True:
+            rows = c.execute("SELECT chunk_id, vec FROM embeddings WHERE chunk_id>? ORDER BY chunk_id LIMIT ?",
+                             (last, int(batch))).fetchall()
+            if not rows:
+                break
+            upd = []
+            for cid, blob in rows:
+                last = cid
+                v = blob_to_vec(blob)
+                n = math.sqrt(sum(x * x for x in v))
+                if n > 0 and abs(n - 1.0) > 1e-3:
+                    upd.append((vec_to_blob([x / n for x in v]), cid))
+            if upd:
+                c.executemany("UPDATE embeddings SET vec=? WHERE chunk_id=?", upd)
+                fixed += len(upd)
+        rag_meta_set(conn, UNIT_NORM_KEY, "1")
+        return fixed
+    except Exception:
+        return 0
+
+
+# ----------------------------------------------------------------------------- candidatos
+def query_terms(query: str, max_terms: int = 6) -> List[str]:
+    """Términos significativos de la consulta (+ whitelist de dominio PAC)."""
+    toks = [t.lower() for t in TOKEN_RE.findall(query or "")]
+    toks = [t for t in toks if t not in QUERY_STOP][:max_terms]
+    qlow = (query or "").lower()
+    if "mic" in qlow and "mic" not in toks:
+        toks.append("mic")
+    if "fega" in qlow and "feaga" not in toks:
+        toks.append("feaga")
+    if "feader" in qlow and "feader" not in toks:
+        toks.append("feader")
+    return toks
+
+
+_VEC = "COALESCE(v.vec, e.vec)"
+_FROM = ("FROM chunks c LEFT JOIN chunk_vecs v ON v.chash=c.chash "
+         "LEFT JOIN embeddings e ON e.chunk_id=c.id")
+_BASE_SQL = f"SELECT c.id, c.text, c.file_path, {_VEC} AS vec {_FROM}"
+_HAS_VEC = f"{_VEC} IS NOT NULL"
+
+
+def chunk_hash(text: str) -> str:
+    """Clave del almacén direccionado por contenido (texto exacto del chunk)."""
+    return hashlib.blake2b((text or "").encode("utf-8", "ignore"), digest_size=16).hexdigest()
+
+
+def ensure_store_schema(conn):
+    """chunks/embeddings históricos + columnas chunks.chash/page/offsets/heading y tabla chunk_vecs (idempotente)."""
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS chunks(id INTEGER PRIMARY KEY, file_path TEXT, mtime REAL, text TEXT)")
+    c.execute("CREATE TABLE IF NOT EXISTS embeddings(chunk_id INTEGER PRIMARY KEY, vec BLOB)")
+    cols = {r[1] for r in c.execute("PRAGMA table_info(chunks)")}
+    if "chash" not in cols:
+        c.execute("ALTER TABLE chunks ADD COLUMN chash TEXT")
+    if "page" not in cols:
+        c.execute("ALTER TABLE chunks ADD COLUMN page INTEGER")   # nº de página (PDF) para citar
+    # metadatos del troceado semántico: offsets de carácter (en la página si hay página) y títulos
+    for col, typ in (("start_off", "INTEGER"), ("end_off", "INTEGER"), ("heading", "TEXT")):
+        if col not in cols:
+            c.execute(f"ALTER TABLE chunks ADD COLUMN {col} {typ}")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chunks_chash ON chunks(chash)")
+    c.execute("CREATE TABLE IF NOT EXISTS chunk_vecs(chash TEXT PRIMARY KEY, vec BLOB)")
+    conn.commit()
+
+
+def _prefix_clause(path_prefix: Optional[str]):
+    if not path_prefix:
+        return "", []
+    return "c.file_path LIKE ?", [str(path_prefix).rstrip('/\\') + '%']
+
+
+def candidates_lexical(cur, query: str, limit: int = 900, path_prefix: Optional[str] = None, qv=None) -> List[Row]:
+    """
+    Preselección por términos (LIKE sobre texto y ruta), ordenada por nº de términos encontrados
+    (no por antigüedad del chunk). 5º campo = ese recuento, que hace de ranking léxico en RRF.
+    """
+    toks = query_terms(query)
+    where, params, hits, hparams = [], [], [], []
+    if toks:
+        ors = []
+        for tok in toks:
+            pat = f"%{tok}%"
+            ors.append("c.text LIKE ?"); params.append(pat)
+            ors.append("c.file_path LIKE ?"); params.append(pat)
+            hits.append("(c.text LIKE ?) + (c.file_path LIKE ?)"); hparams += [pat, pat]
+        where.append("(" + " OR ".join(ors) + ")")
+    pc, pp = _prefix_clause(path_prefix)
+    if pc:
+        where.append(pc); params.extend(pp)
+    where.append(_HAS_VEC)
+    score = " + ".join(hits) if hits else "0"
+    sql = (f"SELECT c.id, c.text, c.file_path, {_VEC} AS vec, ({score}) AS s {_FROM} WHERE "
+           + " AND ".join(where) + " ORDER BY s DESC, c.id LIMIT ?")
+    return cur.execute(sql, hparams + params + [int(limit)]).fetchall()
+
+
+def candidates_vector(cur, query: str, limit: int = 0, path_prefix: Optional[str] = None, qv=None) -> List[Row]:
+    """
+    Sin límite: todos los chunks (opcionalmente bajo una carpeta base) y el reranker decide.
+    Con límite y vector de query: sólo los `limit` más cercanos (escaneo por lotes de la columna vec).
+    """
+    pc, params = _prefix_clause(path_prefix)
+    if qv is not None and limit and int(limit) > 0:
+        ids = vector_top_ids(cur, qv, int(limit), path_prefix=path_prefix)
+        return _rows_by_ids(cur, ids)
+    sql = _BASE_SQL + " WHERE " + (pc + " AND " if pc else "") + _HAS_VEC
+    if limit and int(limit) > 0:
+        sql += " LIMIT ?"; params = params + [int(limit)]
+    return cur.execute(sql, params).fetchall()
+
+
+def vector_top_ids(cur, qv: Sequence[float], n: int, path_prefix: Optional[str] = None,
+                   batch: int = 4096) -> List[int]:
+    """
+    Top-n chunk_id por producto escalar, leyendo sólo los vectores por lotes.
+    Sin carpeta base se recorren los vectores DISTINTOS (chunk_vecs + embeddings históricos):
+    los duplicados por contenido se puntúan una sola vez.
+    """
+    def top(sql, params=()):
+        c = cur.execute(sql, params)
+        best: List[tuple] = []
+        while True:
+            part = c.fetchmany(batch)
+            if not part:
+                break
+            sims = _dot_many(qv, [r[1] for r in part])
+            best = heapq.nlargest(n, best + [(s, r[0]) for r, s in zip(part, sims)])
+        return best
+
+    pc, params = _prefix_clause(path_prefix)
+    if pc:
+        return [cid for _s, cid in top(f"SELECT c.id, {_VEC} {_FROM} WHERE {pc} AND {_HAS_VEC}", params)]
+
+    best = heapq.nlargest(n, [(s, ("e", k)) for s, k in top("SELECT chunk_id, vec FROM embeddings")] +
+                          [(s, ("v", k)) for s, k in top("SELECT chash, vec FROM chunk_vecs")])
+    ids: List[int] = []
+    for _s, (kind, key) in best:
+        if kind == "e":
+            ids.append(key)
+        else:
+            ids.extend(r[0] for r in cur.execute("SELECT id FROM chunks WHERE chash=? LIMIT 4", (key,)))
+    return ids
+
+
+def _rows_by_ids(cur, ids: Sequence[int]) -> List[Row]:
+    if not ids:
+        return []
+    out = []
+    for i in range(0, len(ids), 500):
+        part = list(ids[i:i + 500])
+        out.extend(cur.execute(_BASE_SQL + " WHERE c.id IN (%s)" % ",".join("?" * len(part)), part).fetchall())
+    return out
+
+
+# --- BM25 (FTS5) ---------------------------------------------------------------
+FTS_TABLE = "chunks_fts"
+
+
+def ensure_fts(conn) -> bool:
+    """
+    Crea (si falta) el índice FTS5 externo sobre chunks(text, file_path) + triggers de sincronía.
+    La primera vez reconstruye el índice con lo que ya hubiera. Devuelve False si no hay FTS5.
+    """
+    try:
+        c = conn.cursor()
+        if c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (FTS_TABLE,)).fetchone():
+            return True
+        c.execute("CREATE TABLE IF NOT EXISTS chunks(id INTEGER PRIMARY KEY, file_path TEXT, mtime REAL, text TEXT)")
+        c.execute(f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                  "text, file_path, content='chunks', content_rowid='id', "
+                  "tokenize='unicode61 remove_diacritics 2')")
+        c.execute(f"CREATE TRIGGER IF NOT EXISTS chunks_fts_ai AFTER INSERT ON chunks BEGIN "
+                  f"INSERT INTO {FTS_TABLE}(rowid, text, file_path) VALUES (new.id, new.text, new.file_path); END")
+        c.execute(f"CREATE TRIGGER IF NOT EXISTS chunks_fts_ad AFTER DELETE ON chunks BEGIN "
+                  f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text, file_path) "
+                  f"VALUES ('delete', old.id, old.text, old.file_path); END")
+        c.execute(f"CREATE TRIGGER IF NOT EXISTS chunks_fts_au AFTER UPDATE ON chunks BEGIN "
+                  f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text, file_path) "
+                  f"VALUES ('delete', old.id, old.text, old.file_path); "
+                  f"INSERT INTO {FTS_TABLE}(rowid, text, file_path) VALUES (new.id, new.text, new.file_path); END")
+        c.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        conn.commit()
+        return True
+    except Exception:
+        try: conn.rollback()
+        except Exception: pass
+        return False
+
+
+def fts_match_expr(query: str) -> str:
+    """Expresión MATCH segura: términos alfanuméricos con prefijo, unidos por OR."""
+    return " OR ".join(f"{t}*" for t in query_terms(query))
+
+
+def candidates_bm25(cur, query: str, limit: int = 900, path_prefix: Optional[str] = None, qv=None) -> List[Row]:
+    """Candidatos ordenados por BM25 (FTS5). Devuelve filas con 5º campo = puntuación BM25 (mayor = mejor)."""
+    expr = fts_match_expr(query)
+    if not expr:
+        return []
+    where, params = [f"{FTS_TABLE} MATCH ?"], [expr]
+    pc, pp = _prefix_clause(path_prefix)
+    if pc:
+        where.append(pc); params.extend(pp)
+    where.append(_HAS_VEC)
+    sql = (f"SELECT c.id, c.text, c.file_path, {_VEC} AS vec, -bm25({FTS_TABLE}) AS s "
+           f"FROM {FTS_TABLE} JOIN chunks c ON c.id={FTS_TABLE}.rowid "
+           f"LEFT JOIN chunk_vecs v ON v.chash=c.chash LEFT JOIN embeddings e ON e.chunk_id=c.id "
+           f"WHERE " + " AND ".join(where) + f" ORDER BY bm25({FTS_TABLE}) LIMIT ?")
+    params.append(int(limit))
+    return cur.execute(sql, params).fetchall()
+
+
+def candidates_hybrid(cur, query: str, limit: int = 900, path_prefix: Optional[str] = None, qv=None) -> List[Row]:
+    """
+    Unión de los mejores por BM25 y los mejores por vector (sin sesgo por antigüedad del chunk).
+    Sin FTS5 cae a la preselección LIKE; sin vector de query, sólo la parte léxica.
+    """
+    try:
+        lex = candidates_bm25(cur, query, limit=limit, path_prefix=path_prefix)
+    except Exception:
+        lex = candidates_lexical(cur, query, limit=limit, path_prefix=path_prefix)
+    if qv is None:
+        return lex or candidates_vector(cur, query, limit=0, path_prefix=path_prefix)
+    seen = {r[0] for r in lex}
+    n_vec = max(1, int(limit) // 3)
+    extra = [i for i in vector_top_ids(cur, qv, n_vec, path_prefix=path_prefix) if i not in seen]
+    return list(lex) + [tuple(r) + (None,) for r in _rows_by_ids(cur, extra)]
+
+
+CANDIDATE_GENERATORS: Dict[str, Callable] = {
+    "lexical": candidates_lexical,
+    "bm25": candidates_bm25,
+    "vector": candidates_vector,
+    "hybrid": candidates_hybrid,
+}
+
+
+_PREPARED: set = set()
+_PREPARED_LOCK = threading.Lock()
+
+
+def _db_key(conn) -> str:
+    try:
+        for _seq, name, path in conn.execute("PRAGMA database_list"):
+            if name == "main":
+                return os.path.normcase(os.path.abspath(path)) if path else f"mem:{id(conn)}"
+    except Exception:
+        pass
+    return f"conn:{id(conn)}"
+
+
+def prepare_db(conn, force: bool = False):
+    """
+    Esquema del almacén, migración a norma 1 y FTS5: escrituras (ALTER/CREATE/UPDATE) que sólo hacen
+    falta una vez por BD. Se recuerda por ruta para no repetirlas en el camino de lectura de cada consulta.
+    """
+    key = _db_key(conn)
+    with _PREPARED_LOCK:
+        if not force and key in _PREPARED:
+            return
+        ensure_store_schema(conn)
+        ensure_unit_norm(conn)
+        ensure_fts(conn)
+        _PREPARED.add(key)
+
+
+# ----------------------------------------------------------------------------- rerankers
+def cosine_rerank(query: str, qv: Sequence[float], rows: List[Row]) -> List[dict]:
+    sims = _dot_many(qv, [r[3] for r in rows])
+    out = [{"id": r[0], "text": r[1] or "", "path": r[2] or "", "score": float(s), "cos": float(s)}
+           for r, s in zip(rows, sims)]
+    out.sort(key=lambda h: -h["score"])
+    return out
+
+
+EXT_BONUS = {".pdf": 3, ".docx": 3, ".doc": 2, ".pptx": 1}
+EXT_MALUS = {".png": -2, ".jpg": -2, ".jpeg": -2, ".gif": -2, ".py": -2, ".java": -1, ".sql": -1}
+MIC_TERMS = (" mic ", " ficheros de pago ", " fichero de pago ", " sicop ", " pepac ", " feaga ", " feader ")
+META_TERMS = ("ref.:", "ref.", "versión", "version", "pág.", "pag.", "control del documento", "índice", "indice")
+
+
+# palabra completa: "documento"/"documentación" no piden .doc, ni "docs" (= documentos)
+_EXT_WORDS = {".pdf": re.compile(r"(?<!\w)\.?pdfs?\b"), ".docx": re.compile(r"(?<!\w)\.?docx\b"),
+              ".doc": re.compile(r"(?<!\w)\.?doc\b")}
+
+
+def ext_filter_for(query: str) -> set:
+    """Extensiones pedidas explícitamente en la consulta ("el pdf de…", "docx", ".doc")."""
+    qlow = (query or "").lower()
+    return {ext for ext, rx in _EXT_WORDS.items() if rx.search(qlow)}
+
+
+def filter_ext(query: str, rows: List[Row]) -> List[Row]:
+    """Si la consulta pide una extensión ("el pdf de…"), quita las filas de otras extensiones."""
+    ext_filter = ext_filter_for(query)
+    if not ext_filter:
+        return rows
+    return [r for r in rows if Path(r[2] or "").suffix.lower() in ext_filter]
+
+
+def filter_noise(query: str, rows: List[Row]) -> List[Row]:
+    """Quita las filas que no contienen ningún término de la consulta."""
+    qlow = (query or "").lower()
+    toks = TOKEN_RE.findall(qlow)
+    keep = []
+    for r in rows:
+        # si hay términos de la consulta y ninguno aparece en el texto -> descarta (ruido)
+        if toks and not any(t in (r[1] or "").lower() for t in toks):
+            continue
+        keep.append(r)
+    return keep
+
+
+def heuristic_rerank(query: str, qv: Sequence[float], rows: List[Row]) -> List[dict]:
+    """
+    Reranker de dominio (el de LLMService): coseno*10 + extensión + nombre de fichero
+    + boost PAC/MIC − penalización de cabeceras/metadatos. Descarta ruido sin términos.
+    """
+    qlow = (query or "").lower()
+    toks = TOKEN_RE.findall(qlow)
+    keep = filter_noise(query, rows)
+
+    sims = _dot_many(qv, [r[3] for r in keep])
+    out = []
+    for r, base in zip(keep, sims):
+        text, path = r[1] or "", r[2] or ""
+        txt_low = text.lower()
+        ext = Path(path).suffix.lower()
+        fname = os.path.basename(path).lower()
+        fname_bonus = sum(1 for t in toks if t in fname)
+        ext_adj = EXT_BONUS.get(ext, 0) + EXT_MALUS.get(ext, 0)
+        dom_boost = 1.5 if (any(t in txt_low for t in MIC_TERMS) or any(t.strip() in fname for t in MIC_TERMS)) else 0.0
+        meta_penalty = -8.0 * sum(1 for mt in META_TERMS if mt in txt_low)
+        if len(text.strip()) < 120:
+            meta_penalty -= 6.0
+        score = (base * 10) + (ext_adj * 5) + (fname_bonus * 2) + dom_boost + meta_penalty
+        out.append({"id": r[0], "text": text, "path": path, "score": float(score), "cos": float(base)})
+    out.sort(key=lambda h: -h["score"])
+    return out
+
+
+def rrf_fuse(rankings: Dict[str, List], k0: int = RRF_K) -> Dict[object, float]:
+    """Reciprocal Rank Fusion: suma 1/(k0 + rango) de cada lista ordenada de ids."""
+    fused: Dict[object, float] = {}
+    for ids in rankings.values():
+        for rank, cid in enumerate(ids, start=1):
+            fused[cid] = fused.get(cid, 0.0) + 1.0 / (k0 + rank)
+    return fused
+
+
+def rrf_rerank(query: str, qv: Sequence[float], rows: List[Row]) -> List[dict]:
+    """
+    Fusiona por RRF tres ordenaciones de los candidatos: BM25 (si viene en la fila),
+    coseno y la heurística de dominio. Cada hit lleva el desglose:
+      {'bm25', 'cos', 'heur', 'rank_bm25', 'rank_vec', 'rank_heur', 'rrf'}
+    El ruido se quita ANTES de fusionar: si no, las listas BM25 y coseno lo reintroducirían.
+    """
+    rows = filter_noise(query, rows)
+    if not rows:
+        return []
+    by_id = {r[0]: r for r in rows}
+    sims = dict(zip((r[0] for r in rows), _dot_many(qv, [r[3] for r in rows])))
+    bm25 = {r[0]: r[4] for r in rows if len(r) > 4 and r[4] is not None}
+    heur = {h["id"]: h["score"] for h in heuristic_rerank(query, qv, rows)}
+
+    rankings = {
+        "bm25": sorted(bm25, key=lambda i: -bm25[i]),
+        "vec": sorted((i for i in sims if sims[i] > 0.0), key=lambda i: -sims[i]),
+        "heur": sorted(heur, key=lambda i: -heur[i]),
+    }
+    fused = rrf_fuse(rankings)
+    pos = {name: {cid: n for n, cid in enumerate(ids, start=1)} for name, ids in rankings.items()}
+
+    out = []
+    for cid, score in fused.items():
+        r = by_id[cid]
+        out.append({"id": cid, "text": r[1] or "", "path": r[2] or "", "score": float(score),
+                    "rrf": float(score), "cos": float(sims.get(cid, 0.0)),
+                    "bm25": bm25.get(cid), "heur": heur.get(cid),
+                    "rank_bm25": pos["bm25"].get(cid), "rank_vec": pos["vec"].get(cid),
+                    "rank_heur": pos["heur"].get(cid)})
+    out.sort(key=lambda h: -h["score"])
+    return out
+
+
+RERANKERS: Dict[str, Callable] = {
+    "cosine": cosine_rerank,
+    "heuristic": heuristic_rerank,
+    "rrf": rrf_rerank,
+}
+
+
+# ----------------------------------------------------------------------------- motor
+class RetrievalEngine:
+    """
+    Motor de recuperación sobre chunks/embeddings.
+      engine = RetrievalEngine(db_path=..., encode=embedder["encode"], candidates="lexical", reranker="heuristic")
+      hits = engine.search("pago anticipado FEADER", k=6)   # -> [{'id','text','path','score','cos', ...}, ...]
+    Se puede pasar una conexión ya abierta (conn=) para reutilizar la del Visor.
+    ext_filter=True: si la consulta nombra una extensión ("el pdf de…"), sólo se rerankean esas.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, conn=None, encode: Optional[Callable] = None,
+                 candidates: str | Callable = "hybrid", reranker: str | Callable = "cosine",
+                 max_candidates: int = 900, ext_filter: bool = False):
+        self.db_path = str(db_path) if db_path else None
+        self.ext_filter = bool(ext_filter)
+        self.conn = conn
+        self.encode = encode
+        self.candidates = CANDIDATE_GENERATORS.get(candidates, candidates) if isinstance(candidates, str) else candidates
+        self.reranker = RERANKERS.get(reranker, reranker) if isinstance(reranker, str) else reranker
+        self.max_candidates = int(max_candidates)
+        if not callable(self.candidates):
+            raise ValueError(f"Generador de candidatos desconocido: {candidates!r}")
+        if not callable(self.reranker):
+            raise ValueError(f"Reranker desconocido: {reranker!r}")
+
+    def _open(self):
+        if self.conn is not None:
+            return self.conn, False
+        return sqlite3.connect(self.db_path, check_same_thread=False), True
+
+    def candidate_rows(self, query: str, path_prefix: Optional[str] = None, qv=None) -> List[Row]:
+        conn, owned = self._open()
+        try:
+            prepare_db(conn)
+            try:
+                return self.candidates(conn.cursor(), query or "", limit=self.max_candidates,
+                                       path_prefix=path_prefix, qv=qv)
+            except sqlite3.OperationalError:
+                # BD recreada en esta sesión (reset del índice): se vuelve a preparar una vez
+                prepare_db(conn, force=True)
+                return self.candidates(conn.cursor(), query or "", limit=self.max_candidates,
+                                       path_prefix=path_prefix, qv=qv)
+        except Exception:
+            return []
+        finally:
+            if owned:
+                try: conn.close()
+                except Exception: pass
+
+    def search(self, query: str, k: int = 6, path_prefix: Optional[str] = None,
+               rows: Optional[List[Row]] = None) -> List[dict]:
+        if self.encode is None:
+            return []
+        # vectores guardados ya en norma 1 → basta normalizar la query una vez
+        qv = unit_norm(self.encode(query or ""))
+        if rows is None:
+            rows = self.candidate_rows(query, path_prefix=path_prefix, qv=qv)
+        if self.ext_filter:
+            rows = filter_ext(query, rows)
+        if not rows:
+            return []
+        hits = self.reranker(query or "", qv, rows)
+        # copias del mismo documento en varias carpetas → un solo fragmento
+        out, seen = [], set()
+        for h in hits:
+            key = (h.get("text") or "").strip()
+            if key in seen:
+                continue
+            seen.add(key)
+            out.append(h)
+            if len(out) >= max(1, int(k)):
+                break
+        self._attach_pages(out)
+        return out
+
+    def _attach_pages(self, hits: List[dict]):
+        """Añade h['page'] (PDF troceado por páginas) y h['heading'] a los aciertos que lo tengan."""
+        ids = [h["id"] for h in hits if h.get("id") is not None]
+        if not ids:
+            return
+        conn, owned = self._open()
+        try:
+            meta = {r[0]: r[1:] for r in conn.execute(
+                "SELECT id, page, heading FROM chunks WHERE id IN (%s)" % ",".join("?" * len(ids)), ids)}
+        except Exception:
+            return
+        finally:
+            if owned:
+                try: conn.close()
+                except Exception: pass
+        for h in hits:
+            page, heading = meta.get(h.get("id"), (None, None))
+            if page is not None:
+                h["page"] = int(page)
+            if heading:
+                h["heading"] = heading
+
+
+def cite(h: dict) -> str:
+    """Ruta de la fuente con la página si se conoce: 'ruta (p. 3)'."""
+    p = h.get("path", "")
+    return f"{p} (p. {h['page']})" if h.get("page") else p
+
+
+def format_quoted(hits: List[dict], max_chars: int = 1200) -> str:
+    """Formato del Visor: [i] ruta + fragmento entre triples comillas."""
+    partes = []
+    for i, h in enumerate(hits, start=1):
+        frag = (h.get("text") or "").strip()
+        if max_chars and len(frag) > max_chars:
+            frag = frag[:max_chars] + "…"
+        partes.append(f"[{i}] {cite(h)}\n\"\"\"\n{frag}\n\"\"\"")
+    return "\n\n".join(partes)
@@ -0,0 +1,144 @@
+
+# speculative.py — decodificación especulativa opcional (prompt-lookup o modelo borrador GGUF) + métricas por respuesta
+from __future__ import annotations
+import os, time, threading
+from pathlib import Path
+from typing import Callable, Dict, Optional
+#PACqui 1.3.0
+# En CPU el 7B saca ~4 tok/s: cada token exige una pasada completa del modelo. Con un "borrador"
+# que propone k tokens y una sola pasada del modelo grande que los verifica, cada acierto es un
+# token gratis. llama-cpp-python lo admite con Llama(draft_model=...):
+#   PACQUI_SPECULATIVE=lookup        → LlamaPromptLookupDecoding: busca el n-grama final en el propio
+#                                      prompt y propone lo que le seguía. Encaja con nuestras respuestas,
+#                                      que copian frases de [FRAGMENTOS] y rutas del ÍNDICE.
+#   PACQUI_SPECULATIVE=C:\…\mini.gguf → modelo pequeño de la MISMA familia (mismo vocabulario) que
+#                                      propone k tokens en greedy reaprovechando su prefijo.
+#   PACQUI_SPECULATIVE=off (defecto)
+# PACQUI_SPEC_TOKENS = k (por defecto 2 con lookup, que es lo que mejor va en CPU; 4 con borrador).
+# COSTE EN RAM: con draft_model, llama-cpp-python fuerza logits_all=True y reserva un búfer de
+# puntuaciones de n_ctx × n_vocab float32: con n_ctx=8192 y el vocabulario de Qwen (~152k) son ~5 GB;
+# con Llama/Mistral (32k), ~1 GB. Por eso, con el modo activo, n_ctx se limita a PACQUI_SPEC_MAX_CTX
+# (por defecto 2048 → ~1.2 GB con Qwen, ~0.25 GB con 32k).
+# CountingDraft cuenta propuestas y pasadas; AnswerMeter mide por respuesta tokens, tok/s efectivos
+# y la tasa de aceptación estimada = (tokens generados − pasadas) / tokens propuestos. En streaming
+# los "tokens" son chunks del stream (casi siempre 1 token, pero no siempre), así que es aproximada.
+
+MODE = os.getenv("PACQUI_SPECULATIVE", "off").strip()
+SPEC_MAX_CTX = int(os.getenv("PACQUI_SPEC_MAX_CTX", "2048"))
+
+
+def enabled(mode: str = MODE) -> bool:
+    return (mode or "off").strip().lower() not in ("", "0", "off", "no", "false")
+
+
+def capped_ctx(ctx: int, mode: str = MODE) -> int:
+    """n_ctx a usar con el modo especulativo activo (búfer de logits n_ctx × n_vocab; ver arriba)."""
+    return min(int(ctx), SPEC_MAX_CTX) if enabled(mode) and SPEC_MAX_CTX > 0 else int(ctx)
+
+
+class CountingDraft:
+    """Envuelve el borrador y cuenta llamadas (≈ pasadas del modelo grande) y tokens propuestos."""
+
+    def __init__(self, inner, kind: str):
+        self.inner = inner
+        self.kind = kind
+        self.calls = 0
+        self.proposed = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, input_ids, **kw):
+        out = self.inner(input_ids, **kw)
+        with self._lock:
+            self.calls += 1
+            self.proposed += len(out)
+        return out
+
+    def snapshot(self) -> tuple:
+        with self._lock:
+            return self.calls, self.proposed
+
+
+class GGUFDraft:
+    """Borrador con un GGUF pequeño: k tokens greedy; Llama.generate(reset=True) reaprovecha el prefijo."""
+
+    def __init__(self, model_path: str, n_ctx: int, n_threads: int, k: int = 4):
+        from llama_cpp import Llama
+        self.k = max(1, int(k))
+        self.llm = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=n_threads, n_batch=256, verbose=False)
+
+    def __call__(self, input_ids, **kw):
+        import numpy as np
+        out = []
+        for tok in self.llm.generate([int(t) for t in input_ids], temp=0.0, reset=True):
+            out.append(tok)
+            if len(out) >= self.k:
+                break
+        return np.array(out, dtype=np.intc)
+
+
+def build_draft(n_ctx: int, n_threads: int, mode: str = MODE) -> Optional[CountingDraft]:
+    """Borrador según PACQUI_SPECULATIVE (None si está desactivado o la build no lo soporta)."""
+    m = (mode or "off").strip()
+    if not enabled(m):
+        return None
+    try:
+        if m.lower() == "lookup":
+            from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+            k = int(os.getenv("PACQUI_SPEC_TOKENS", "2"))
+            return CountingDraft(LlamaPromptLookupDecoding(num_pred_tokens=k), "lookup")
+        if m.lower().endswith(".gguf") and Path(m).exists():
+            k = int(os.getenv("PACQUI_SPEC_TOKENS", "4"))
+            return CountingDraft(GGUFDraft(m, n_ctx, n_threads, k), "draft:" + Path(m).name)
+    except Exception as e:
+        print(f"[SPEC] decodificación especulativa no disponible: {e}")
+    return None
+
+
+class AnswerMeter:
+    """Medición de UNA respuesta: tokens, tok/s efectivos (desde el 1er token) y aceptación del borrador."""
+
+    def __init__(self, draft: Optional[CountingDraft], on_done: Optional[Callable[[dict], None]] = None):
+        self.draft = draft
+        self.on_done = on_done
+        self.t0 = time.perf_counter()
+        self.t_first = None
+        self._snap = draft.snapshot() if draft is not None else (0, 0)
+
+    def wrap_stream(self, stream):
+        n = 0                            # chunks del stream ≈ tokens (accept_rate aproximada)
+        try:
+            for ch in stream:
+                if self.t_first is None:
+                    self.t_first = time.perf_counter()
+                n += 1
+                yield ch
+        finally:
+            self._done(n)
+
+    def finish(self, resp):
+        n = 0
+        try:
+            n = int(resp["usage"]["completion_tokens"])
+        except Exception:
+            pass
+        self._done(n)
+        return resp
+
+    def _done(self, tokens: int):
+        t1 = time.perf_counter()
+        gen_s = t1 - (self.t_first or self.t0)
+        st: Dict = {"tokens": int(tokens), "seconds": round(t1 - self.t0, 3),
+                    "tok_s": round(tokens / gen_s, 2) if tokens and gen_s > 0 else None,
+                    "spec": self.draft.kind if self.draft is not None else "off",
+                    "accept_rate": None, "approx": self.t_first is not None}
+        if self.draft is not None:
+            calls, proposed = self.draft.snapshot()
+            calls -= self._snap[0]; proposed -= self._snap[1]
+            if proposed > 0:
+                st["accept_rate"] = round(min(1.0, max(0.0, (tokens - calls) / proposed)), 3)
+            st["draft_calls"], st["proposed"] = calls, proposed
+        if self.on_done:
+            try:
+                self.on_done(st)
+            except Exception:
+                pass
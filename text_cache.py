@@ -0,0 +1,176 @@
+
+# text_cache.py — caché persistente de texto extraído (RAG, scraper de keywords y vista previa)
+from __future__ import annotations
+import os, time, zlib, sqlite3, threading
+from pathlib import Path
+from typing import Callable, Optional
+#PACqui 1.3.0
+# El mismo documento se extraía una y otra vez (indexado RAG, cmd_scraper, parche RAG y vista
+# previa). Aquí el texto se guarda comprimido con zlib en un SQLite aparte, con clave
+#     (ruta, tamaño, mtime_ns, tipo de extractor + versión + parámetros)
+# de modo que cualquier cambio del fichero o del extractor invalida la entrada sin más.
+# Tamaño acotado (PACQUI_TEXT_CACHE_MB): al pasarse se expulsan las entradas menos usadas (LRU).
+# PACQUI_TEXT_CACHE=0 lo desactiva; PACQUI_TEXT_CACHE_DB cambia la ruta del fichero.
+# Cada proceso abre su propia conexión (los hijos del ProcessPool de rag_indexer también).
+
+ENABLED = os.getenv("PACQUI_TEXT_CACHE", "1") != "0"
+MAX_BYTES = int(float(os.getenv("PACQUI_TEXT_CACHE_MB", "256")) * 1024 * 1024)
+ATIME_GRACE = 60.0          # no reescribir la hora de acceso más de una vez por minuto
+EVICT_EVERY = 64            # comprobar el tamaño cada N inserciones
+
+
+def default_db_path() -> str:
+    p = os.getenv("PACQUI_TEXT_CACHE_DB")
+    if p:
+        return p
+    base = Path(os.getenv("LOCALAPPDATA") or Path.home()) / "PACqui"
+    return str(base / "text_cache.sqlite")
+
+
+class TextCache:
+    def __init__(self, db_path: Optional[str] = None, max_bytes: int = MAX_BYTES):
+        self.db_path = db_path or default_db_path()
+        self.max_bytes = int(max_bytes)
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._puts = 0
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=10.0, check_same_thread=False)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            except Exception:
+                pass
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS text_cache(
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    data BLOB,
+                    nbytes INTEGER,
+                    atime REAL,
+                    PRIMARY KEY(path, kind)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_text_cache_atime ON text_cache(atime)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _stat(path: str):
+        st = os.stat(path)
+        return int(st.st_size), int(getattr(st, "st_mtime_ns", int(st.st_mtime * 1e9)))
+
+    def get(self, path: str, kind: str) -> Optional[str]:
+        try:
+            size, mt = self._stat(path)
+        except Exception:
+            return None
+        with self._lock:
+            try:
+                row = self._db().execute(
+                    "SELECT data, atime FROM text_cache WHERE path=? AND kind=? AND size=? AND mtime_ns=?",
+                    (path, kind, size, mt)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                now = time.time()
+                if now - float(row[1] or 0) > ATIME_GRACE:
+                    self._db().execute("UPDATE text_cache SET atime=? WHERE path=? AND kind=?", (now, path, kind))
+                    self._db().commit()
+                self.hits += 1
+                return zlib.decompress(row[0]).decode("utf-8")
+            except Exception:
+                self.misses += 1
+                return None
+
+    def put(self, path: str, kind: str, text: str):
+        try:
+            size, mt = self._stat(path)
+            blob = zlib.compress((text or "").encode("utf-8"), 6)
+        except Exception:
+            return
+        with self._lock:
+            try:
+                c = self._db()
+                c.execute("INSERT OR REPLACE INTO text_cache(path, size, mtime_ns, kind, data, nbytes, atime) "
+                          "VALUES(?,?,?,?,?,?,?)", (path, size, mt, kind, blob, len(blob), time.time()))
+                c.commit()
+                self._puts += 1
+                if self._puts % EVICT_EVERY == 1:
+                    self._evict(c)
+            except Exception:
+                pass
+
+    def _evict(self, c):
+        """LRU por bytes: si se supera max_bytes, borra las entradas más antiguas hasta quedar al 80%."""
+        total = int(c.execute("SELECT COALESCE(SUM(nbytes), 0) FROM text_cache").fetchone()[0])
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.8)
+        doomed = []
+        for path, kind, nb in c.execute("SELECT path, kind, nbytes FROM text_cache ORDER BY atime ASC"):
+            if total <= target:
+                break
+            doomed.append((path, kind)); total -= int(nb or 0)
+        c.executemany("DELETE FROM text_cache WHERE path=? AND kind=?", doomed)
+        c.commit()
+
+    def cached(self, path: str, kind: str, fn: Callable[[], str]) -> str:
+        """Devuelve el texto cacheado o llama a fn() y lo guarda (los resultados vacíos no se guardan)."""
+        path = str(path)
+        txt = self.get(path, kind)
+        if txt is not None:
+            return txt
+        txt = fn() or ""
+        if txt:
+            self.put(path, kind, txt)
+        return txt
+
+    def stats(self) -> dict:
+        out = {"hits": self.hits, "misses": self.misses, "path": self.db_path}
+        try:
+            with self._lock:
+                n, b = self._db().execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM text_cache").fetchone()
+            out.update(entries=int(n), bytes=int(b), max_bytes=self.max_bytes)
+        except Exception:
+            pass
+        return out
+
+    def clear(self):
+        with self._lock:
+            try:
+                self._db().execute("DELETE FROM text_cache")
+                self._db().commit()
+            except Exception:
+                pass
+
+
+_CACHE: Optional[TextCache] = None
+_CACHE_PID = None
+
+
+def get_cache() -> TextCache:
+    """Instancia única por proceso (se recrea tras fork)."""
+    global _CACHE, _CACHE_PID
+    if _CACHE is None or _CACHE_PID != os.getpid():
+        _CACHE = TextCache()
+        _CACHE_PID = os.getpid()
+    return _CACHE
+
+
+def cached_text(path, kind: str, fn: Callable[[], str]) -> str:
+    """Atajo: texto de `path` para el extractor `kind`, pasando por la caché si está activa."""
+    if not ENABLED:
+        return fn() or ""
+    try:
+        cache = get_cache()
+    except Exception:
+        return fn() or ""
+    return cache.cached(str(path), kind, fn)
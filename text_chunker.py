@@ -0,0 +1,264 @@
+
+# text_chunker.py — troceado semántico para RAG (párrafos / títulos / frases con objetivo de tokens)
+from __future__ import annotations
+import os, re, bisect
+from typing import Callable, List, Optional
+#PACqui 1.3.0
+# Sustituye al troceado fijo de _text_chunks (1000 car. + 200 de solape, cortando a mitad de palabra
+# y de frase). Aquí:
+#   * el texto se divide en bloques (párrafos separados por línea en blanco) y los títulos abren
+#     sección; un bloque demasiado largo se parte por frases, luego por palabras y, si una sola
+#     "palabra" (URL, base64, tabla sin espacios) no cabe, con un corte duro cada max_chars;
+#   * las unidades se agrupan de forma voraz hasta PACQUI_CHUNK_TOKENS tokens (tope
+#     PACQUI_CHUNK_MAX_TOKENS) medidos con el tokenizador del modelo de embeddings si se conoce
+#     (count_tokens) o con una aproximación barata (~4 caracteres por token);
+#   * se trabaja con offsets sobre el texto original y sólo se corta (un slice) al emitir cada chunk;
+#   * cada chunk es un str con metadatos: .start/.end (offsets de carácter en el texto RECIBIDO, con
+#     sus \r\n; el contenido del chunk va con saltos normalizados a \n), .heading (ruta de
+#     títulos "Cap 1 > 1.2 Ámbito") y .page (lo rellena quien trocea por páginas). Se puede pasar
+#     por pickle (pools de procesos).
+
+CHUNK_TOKENS = int(os.getenv("PACQUI_CHUNK_TOKENS", "200"))
+CHUNK_MAX_TOKENS = int(os.getenv("PACQUI_CHUNK_MAX_TOKENS", "256"))
+OVERLAP_SENTS = int(os.getenv("PACQUI_CHUNK_OVERLAP_SENTS", "1"))
+
+_BLOCK_RE = re.compile(r"\S(?:.*?)(?=\n[ \t]*\n|\Z)", re.S)
+_SENT_RE = re.compile(r".+?(?:[.!?;…](?=\s)|\n|$)", re.S)
+_WORD_RE = re.compile(r"\S+")
+_HEAD_MD = re.compile(r"^(#{1,6})\s+\S")
+_HEAD_NUM = re.compile(r"^((?:\d{1,2}\.){1,4}\d{0,2}|[IVXLC]{1,5}\.|(?:CAP[IÍ]TULO|ART[IÍ]CULO|ANEXO|T[IÍ]TULO)\b)\s*\S", re.I)
+
+
+class Chunk(str):
+    """Fragmento de texto (str normal) con offsets y ruta de títulos."""
+    start: int = 0
+    end: int = 0
+    heading: str = ""
+    page: Optional[int] = None
+
+    def __new__(cls, src: str, start: int, end: int, heading: str = "", page: Optional[int] = None):
+        obj = super().__new__(cls, src[start:end])
+        obj.start, obj.end, obj.heading, obj.page = start, end, heading, page
+        return obj
+
+    def __reduce__(self):
+        # __new__ espera el texto fuente completo: se reconstruye desde el propio fragmento
+        return _restore_chunk, (str(self), self.start, self.end, self.heading, self.page)
+
+
+def _restore_chunk(text: str, start: int, end: int, heading: str, page: Optional[int]) -> Chunk:
+    obj = Chunk(text, 0, len(text), heading, page)
+    obj.start, obj.end = start, end
+    return obj
+
+
+def approx_tokens(s: str) -> int:
+    return max(1, (len(s) + 3) // 4)
+
+
+def token_counter(embedder: Optional[dict] = None) -> Callable[[str], int]:
+    """count_tokens del embedder (tokenizador real) o la aproximación por caracteres."""
+    fn = (embedder or {}).get("count_tokens") if isinstance(embedder, dict) else None
+    if not callable(fn):
+        return approx_tokens
+
+    def _count(s: str) -> int:
+        try:
+            return int(fn(s))
+        except Exception:
+            return approx_tokens(s)
+    return _count
+
+
+def st_token_counter(st_model) -> Optional[Callable[[str], int]]:
+    """Contador con el tokenizador de un SentenceTransformer (wordpiece/BPE), o None."""
+    tok = getattr(st_model, "tokenizer", None)
+    if tok is None or not hasattr(tok, "encode"):
+        return None
+    return lambda s: len(tok.encode(s, add_special_tokens=False))
+
+
+def chunker_sig() -> str:
+    """Identifica el troceado activo: si cambia, rag_indexer vuelve a trocear todos los ficheros."""
+    if os.getenv("PACQUI_CHUNKER", "semantic").lower() == "fixed":
+        return "fixed:1200:200"
+    return f"semantic:v1:{CHUNK_TOKENS}:{CHUNK_MAX_TOKENS}:{OVERLAP_SENTS}"
+
+
+def _heading_level(line: str) -> int:
+    """0 si no parece título; si lo parece, su nivel (1 = más alto)."""
+    line = line.strip()
+    if not line or len(line) > 90 or "\n" in line:
+        return 0
+    m = _HEAD_MD.match(line)
+    if m:
+        return len(m.group(1))
+    if line[-1] in ".,;:":
+        return 0
+    m = _HEAD_NUM.match(line)
+    if m and len(line) <= 70:
+        num = m.group(1)
+        return max(1, num.rstrip(".").count(".") + 1) if num[0].isdigit() else 1
+    letters = [c for c in line if c.isalpha()]
+    if len(letters) >= 4 and all(c.isupper() for c in letters) and len(line.split()) <= 10:
+        return 1
+    return 0
+
+
+def _segments(text: str):
+    """(start, end, nivel_título): párrafos (bloques entre líneas en blanco) y títulos de una línea.
+    En textos sin líneas en blanco (DOCX: un párrafo por línea) los títulos se buscan línea a línea."""
+    for m in _BLOCK_RE.finditer(text):
+        b0, b1 = m.start(), m.end()
+        p0 = None; p1 = b0
+        pos = b0
+        while pos < b1:
+            nl = text.find("\n", pos, b1)
+            l1 = b1 if nl < 0 else nl
+            lvl = _heading_level(text[pos:l1])
+            if lvl:
+                if p0 is not None:
+                    yield p0, p1, 0
+                    p0 = None
+                yield pos, l1, lvl
+            elif text[pos:l1].strip():
+                if p0 is None:
+                    p0 = pos
+                p1 = l1
+            pos = l1 + 1
+        if p0 is not None:
+            while p1 > p0 and text[p1 - 1].isspace():
+                p1 -= 1
+            yield p0, p1, 0
+
+
+def _hard_split(w0: int, w1: int, max_chars: int):
+    """Trozos de como mucho max_chars de una "palabra" sin espacios."""
+    step = max(1, int(max_chars))
+    return [(p, min(p + step, w1)) for p in range(w0, w1, step)]
+
+
+def _units(text: str, count, max_tokens: int, max_chars: int):
+    """(start, end, tokens, nivel_título) por bloque; bloques largos → frases → palabras → corte duro."""
+    for b0, b1, lvl in _segments(text):
+        block = text[b0:b1]
+        n = count(block)
+        if lvl or n <= max_tokens:
+            yield b0, b1, n, lvl
+            continue
+        for s in _SENT_RE.finditer(block):
+            s0, s1 = b0 + s.start(), b0 + s.end()
+            while s0 < s1 and text[s0].isspace():
+                s0 += 1
+            while s1 > s0 and text[s1 - 1].isspace():
+                s1 -= 1
+            if s1 <= s0:
+                continue
+            sn = count(text[s0:s1])
+            if sn <= max_tokens:
+                yield s0, s1, sn, 0
+                continue
+            # frase enorme (tablas, listados sin puntuación): cortar por palabras
+            w0 = wl = None; acc = 0
+            for w in _WORD_RE.finditer(text, s0, s1):
+                for p0, p1 in _hard_split(w.start(), w.end(), max_chars):
+                    wn = count(text[p0:p1])
+                    if w0 is not None and acc + wn > max_tokens:
+                        yield w0, wl, acc, 0
+                        w0 = None; acc = 0
+                    if w0 is None:
+                        w0 = p0
+                    wl = p1; acc += wn
+            if w0 is not None:
+                yield w0, wl, acc, 0
+
+
+def _crlf_drops(text: str) -> List[int]:
+    """Posiciones (en el texto normalizado) de los \n que venían de un \r\n (un carácter menos)."""
+    drops, i, k = [], text.find("\r\n"), 0
+    while i >= 0:
+        drops.append(i - k); k += 1
+        i = text.find("\r\n", i + 2)
+    return drops
+
+
+def semantic_chunks(text: str, target_tokens: int = CHUNK_TOKENS, max_tokens: int = CHUNK_MAX_TOKENS,
+                    count: Optional[Callable[[str], int]] = None, overlap_sents: int = OVERLAP_SENTS,
+                    page: Optional[int] = None, max_chars: Optional[int] = None) -> List[Chunk]:
+    """
+    Trocea `text` respetando párrafos, títulos y frases. Devuelve Chunk (str con metadatos) con
+    offsets sobre `text` tal cual llega (se deshace la normalización de \r\n).
+    """
+    drops = _crlf_drops(text or "")
+    text = (text or "").replace("\r\n", "\n").replace("\r", "\n")
+    if not text.strip():
+        return []
+    count = count or approx_tokens
+    max_tokens = max(int(max_tokens), int(target_tokens))
+    max_chars = int(max_chars or max_tokens * 4)
+    out: List[Chunk] = []
+    heads: List[tuple] = []            # pila (nivel, texto)
+    cur: List[tuple] = []              # unidades del chunk en curso
+    cur_tok = 0
+    fresh = 0                          # unidades nuevas (no solape ni título) en el chunk en curso
+
+    def path() -> str:
+        return " > ".join(h for _l, h in heads)
+
+    def emit(keep_tail: bool, room: int = 0):
+        nonlocal cur, cur_tok, fresh
+        if not cur:
+            return
+        body = [u for u in cur if not u[3]]
+        if fresh:
+            out.append(Chunk(text, cur[0][0], cur[-1][1], path(), page))
+        tail = []
+        if keep_tail and overlap_sents > 0 and body:
+            tail = [u for u in body[-overlap_sents:] if u[2] <= target_tokens // 3]
+            if sum(u[2] for u in tail) + room > max_tokens:
+                tail = []                           # el solape no puede pasar el tope
+        cur = tail
+        cur_tok = sum(u[2] for u in tail)
+        fresh = 0
+
+    for u in _units(text, count, max_tokens, max_chars):
+        s0, s1, n, lvl = u
+        if lvl:
+            emit(keep_tail=False)                   # un título nunca queda al final de un chunk
+            while heads and heads[-1][0] >= lvl:
+                heads.pop()
+            heads.append((lvl, text[s0:s1].lstrip("#").strip()[:80]))
+            cur, cur_tok = [u], n                   # el título encabeza el chunk siguiente
+            continue
+        if cur_tok + n > target_tokens and fresh:
+            emit(keep_tail=True, room=n)
+        cur.append(u); cur_tok += n; fresh += 1
+    emit(keep_tail=False)
+    if drops:
+        for ch in out:
+            ch.start += bisect.bisect_right(drops, ch.start)
+            ch.end += bisect.bisect_left(drops, ch.end)
+    return out
+
+
+def fixed_chunks(txt: str, max_chars: int = 1200, overlap: int = 200) -> List[str]:
+    """Troceado antiguo por caracteres (PACQUI_CHUNKER=fixed)."""
+    txt = (txt or "").replace("\r\n", "\n").replace("\r", "\n")
+    parts = []
+    step = max(1, max_chars - overlap)
+    i = 0; N = len(txt)
+    while i < N:
+        parts.append(txt[i:i + max_chars])
+        i += step
+    return parts
+
+
+def chunk_text(txt: str, max_chars: int = 1200, overlap: int = 200, embedder: Optional[dict] = None) -> List[str]:
+    """Punto de entrada para _text_chunks: semántico por defecto, fijo si PACQUI_CHUNKER=fixed."""
+    if os.getenv("PACQUI_CHUNKER", "semantic").lower() == "fixed":
+        return fixed_chunks(txt, max_chars=max_chars, overlap=overlap)
+    count = token_counter(embedder)
+    # max_chars sigue mandando como techo duro con la aproximación por caracteres
+    max_tok = min(CHUNK_MAX_TOKENS, approx_tokens("x" * max_chars)) if count is approx_tokens else CHUNK_MAX_TOKENS
+    return semantic_chunks(txt, target_tokens=min(CHUNK_TOKENS, max_tok), max_tokens=max_tok, count=count,
+                           max_chars=max_chars)
@@ -0,0 +1,124 @@
+
+# token_budget.py — recorte de texto a un presupuesto de tokens en tiempo lineal
+from __future__ import annotations
+import os, bisect, hashlib, itertools, threading
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Sequence
+#PACqui 1.3.0
+# _trim_to_tokens volvía a tokenizar TODO el texto acumulado tras añadir cada línea y
+# _shrink_messages / _trim_to_budget lo mismo tras quitar cada 4 líneas → cuadrático; con contextos
+# RAG largos eran segundos de CPU antes de generar. Aquí cada línea se tokeniza UNA vez, se guardan
+# las sumas acumuladas y el punto de corte sale con una búsqueda binaria (bisect).
+# La suma por líneas (+1 por salto) es una aproximación del recuento del texto unido; al final se
+# comprueba con un recuento real y, si aún sobra algo, se corrige con otra búsqueda.
+# TokenCountCache: LRU de recuentos con clave (identidad del modelo, hash del texto) para que los
+# bloques que no cambian (SYSTEM, fragmentos, líneas del índice) no se vuelvan a tokenizar.
+
+TOKCACHE_SIZE = int(os.getenv("PACQUI_TOKCACHE_SIZE", "20000"))
+
+Counter = Callable[[str], int]
+
+
+def line_costs(lines: Sequence[str], count: Counter) -> List[int]:
+    """Tokens de cada línea + 1 por el salto de línea que la une a la siguiente."""
+    return [count(ln) + 1 if ln else 1 for ln in lines]
+
+
+def cumulative(costs: Sequence[int]) -> List[int]:
+    return list(itertools.accumulate(costs))
+
+
+def fit_count(cum: Sequence[int], budget: int) -> int:
+    """Cuántos elementos iniciales caben en `budget` (cum = sumas acumuladas)."""
+    return bisect.bisect_right(cum, budget)
+
+
+def _cut_lines(lines: List[str], cum: List[int], budget: int, count: Counter) -> str:
+    n = fit_count(cum, budget)
+    out = "\n".join(lines[:n])
+    # verificación con el recuento real (una o dos veces como mucho)
+    for _ in range(2):
+        if n == 0:
+            break
+        real = count(out)
+        if real <= budget:
+            break
+        n = fit_count(cum, budget - (real - budget))
+        out = "\n".join(lines[:n])
+    return out
+
+
+def trim_lines(text: str, max_tokens: int, count: Counter) -> str:
+    """Las primeras líneas de `text` que caben en max_tokens (si no cabe ninguna, corte por caracteres)."""
+    if max_tokens <= 0 or not text:
+        return ""
+    total = count(text)
+    if total <= max_tokens:
+        return text
+    lines = text.splitlines()
+    cum = cumulative(line_costs(lines, count))
+    out = _cut_lines(lines, cum, max_tokens, count)
+    if not out:  # último recurso: por caracteres
+        ratio = max_tokens / max(1, total)
+        return text[:max(64, int(len(text) * ratio))]
+    return out
+
+
+def trim_section(text: str, marker: str, max_tokens: int, count: Counter) -> str:
+    """
+    Recorta priorizando la sección que empieza en `marker` (p. ej. "[FRAGMENTOS]"): se conserva la
+    cabecera y se quitan líneas del final de la sección; si aun así no cabe, recorte global por líneas.
+    """
+    if max_tokens <= 0 or not text:
+        return ""
+    if count(text) <= max_tokens:
+        return text
+    head, sep, rest = text.partition(marker)
+    if sep:
+        head_tok = count(head)
+        lines = (sep + rest).splitlines()
+        cum = cumulative(line_costs(lines, count))
+        keep = _cut_lines(lines, cum, max(0, max_tokens - head_tok), count)
+        text = head + keep
+        if count(text) <= max_tokens:
+            return text
+    return trim_lines(text, max_tokens, count)
+
+
+class TokenCountCache:
+    """LRU (modelo, hash del texto) → nº de tokens, con contadores de aciertos."""
+
+    def __init__(self, maxsize: int = TOKCACHE_SIZE):
+        self.maxsize = max(16, int(maxsize))
+        self.hits = self.misses = 0
+        self._d: "OrderedDict[tuple, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(model_id: Hashable, text: str) -> tuple:
+        return model_id, len(text), hashlib.blake2b(text.encode("utf-8", "ignore"), digest_size=12).digest()
+
+    def count(self, model_id: Hashable, text: str, fn: Counter) -> int:
+        k = self._key(model_id, text or "")
+        with self._lock:
+            n = self._d.get(k)
+            if n is not None:
+                self._d.move_to_end(k)
+                self.hits += 1
+                return n
+            self.misses += 1
+        n = int(fn(text))
+        with self._lock:
+            self._d[k] = n
+            if len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+        return n
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+
+    def stats(self) -> dict:
+        tot = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._d),
+                "hit_rate": round(self.hits / tot, 3) if tot else None}